@@ -0,0 +1,75 @@
+from collections import deque
+
+
+class Automaton:
+    """
+    Aho-Corasick thuần Python trên bytes: tìm mọi pattern trong một lần quét dữ liệu,
+    chi phí O(len(data) + số match) bất kể số pattern (hàng nghìn tên bệnh nhân).
+    Khớp không phân biệt hoa thường với ký tự ASCII (pattern và dữ liệu đều được upper()).
+    """
+
+    def __init__(self, patterns):
+        self.patterns = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        seen = set()
+        for pattern in patterns:
+            if isinstance(pattern, str):
+                pattern = pattern.encode("utf-8")
+            pattern = pattern.upper()
+            if not pattern or pattern in seen:
+                continue
+            seen.add(pattern)
+            self._add(pattern, len(self.patterns))
+            self.patterns.append(pattern)
+        self._build()
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def _add(self, pattern, index):
+        state = 0
+        for byte in pattern:
+            nxt = self._goto[state].get(byte)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][byte] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = nxt
+        self._out[state].append(index)
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for byte, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f and byte not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(byte, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def iter_matches(self, data):
+        """Sinh (start, end, pattern_index) cho mọi lần xuất hiện (kể cả chồng nhau) trong data."""
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for pos, byte in enumerate(bytes(data).upper()):
+            while state and byte not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(byte, 0)
+            for index in out[state]:
+                yield pos + 1 - len(self.patterns[index]), pos + 1, index
+
+    def spans(self, data):
+        """Các đoạn [start, end) bị phủ bởi ít nhất một match, đã gộp chồng nhau."""
+        merged = []
+        for start, end, _ in sorted(self.iter_matches(data)):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return [tuple(s) for s in merged]
@@ -1,12 +1,17 @@
 import os
 import shutil
 import csv
-import numpy as np
-from pyedflib import EdfReader, EdfWriter, FILETYPE_EDFPLUS
+from pyedflib import EdfReader
 import re 
-import pyedflib
 import mne
 import logging
+from supervisor import run_isolated
+from edf_header import split_main_header, MAIN_HEADER_BYTES
+from edf_writer import copy_edf_records, edf_file_ok, WRITE_BLOCK_BYTES
+from edf_triage import triage_edf, repair_record_count, ROUTE_REJECT, ROUTE_HEADER_ONLY, ROUTE_STREAMING, ROUTE_REPAIR_RECORDS
+from identity_index import parse_patient_field, parse_patient_name
+from phi import build_name_automaton, load_sheet_names, scrub_annotations
+from memory_governor import MemoryGovernor, PATH_PASSTHROUGH, PATH_HEADER_ONLY, log_decision
 
 # bids_root = "/mnt/disk1/aiotlab/hieupc/New_CBraMod/BIDS/bids_testing"
 # mapping_csv = os.path.join("mapping_original_to_sub_1.csv")
@@ -18,7 +23,13 @@ bids_root = "/mnt/disk1/aiotlab/hieupc/New_CBraMod/BIDS/Test_Small_BIDS"
 mapping_csv = os.path.join(bids_root, "mapping_original_to_sub_1.csv")
 skipped_csv = os.path.join(bids_root, "skipped_files.csv")
 overwrite = True  # False = create *_anon.edf, True = overwrite original (with backup)
-size_threshold = 500  # 1 GB in bytes; adjust as needed
+decisions_tsv = os.path.join(bids_root, "memory_decisions.tsv")
+n_workers = 1  # number of anonymize processes sharing this machine's RAM
+failed_tsv = os.path.join(bids_root, "failed_files.tsv")
+file_timeout = 1800  # seconds; parse + anonymize of one file runs in a supervised worker
+file_max_rss_mb = 8192  # worker is killed above this RSS
+names_xlsx = None  # xlsx có cột PATIENT_NAME (vd. matched_patients.xlsx): tên cần xoá khỏi annotation
+annotation_inplace = False  # True = chỉ vá header tại chỗ (không ghi lại data record) + xoá tên trong annotation
 
 def get_patient_name(edf_path):
     """
@@ -64,75 +75,42 @@ def get_patient_name(edf_path):
     # Nếu cuối cùng vẫn None thì fallback sang tên file
     return str(name) if name else os.path.basename(edf_path)
 
-def anonymize_edf(edf_path, out_path, new_patient_name):
+def passthrough_edf(edf_path, out_path, new_patient_name, block_bytes=WRITE_BLOCK_BYTES):
     """
-    Anonymize an EDF file while preserving EEG signal data.
-    Compatible with older pyedflib and MNE versions.
+    Ghi lại file với header đã xoá định danh, digital samples pass-through (bit-exact) theo khối lớn;
+    không decode int16 -> float -> int16. Ghi ra .tmp, kiểm tra số record rồi mới move.
     """
+    tmp_out = out_path + ".tmp"
     try:
-        # Read input file
-        with pyedflib.EdfReader(edf_path) as r:
-            n_channels = r.signals_in_file
-            sig_headers = r.getSignalHeaders()
-            header = r.getHeader()
-            sample_rate = r.getSampleFrequency(0)  # Assume same sample rate for all channels
-            
-            # Get number of samples (handle older pyedflib versions)
-            try:
-                n_samples = r.getNSamples(0)  # Newer versions
-            except TypeError:
-                n_samples = r.samples_in_file(0)  # Older versions fallback
-            signals = [r.readSignal(i) for i in range(n_channels)]
-            
-            # Verify signal lengths
-            if any(len(sig) != n_samples for sig in signals):
-                raise ValueError(f"Signal length mismatch: expected {n_samples}, got {[len(sig) for sig in signals]}")
-            print(f"Read {n_channels} channels, {n_samples} samples each at {sample_rate} Hz")
-
-        # Modify header to anonymize
-        header['patientname'] = new_patient_name
-        header['patientcode'] = new_patient_name
-        header['birthdate'] = ''
-        header['gender'] = ''
-        header['admincode'] = ''
-        header['technician'] = ''
-        header['equipment'] = ''
-        if 'subject_info' in header:
-            header['subject_info'] = {}
-
-        # Write to temporary file
-        tmp_out = out_path + ".tmp"
-        writer = pyedflib.EdfWriter(tmp_out, n_channels=n_channels, file_type=pyedflib.FILETYPE_EDFPLUS)
-        writer.setHeader(header)
-        writer.setSignalHeaders(sig_headers)
-        
-        # Write signals in chunks to avoid truncation
-        chunk_size = int(sample_rate)  # Write 1 second at a time (e.g., 500 samples at 500 Hz)
-        for i in range(0, n_samples, chunk_size):
-            for ch in range(n_channels):
-                chunk = signals[ch][i:i + chunk_size]
-                if len(chunk) > 0:
-                    writer.writePhysicalSamples(np.array(chunk, dtype=np.float64))
-            print(f"Wrote samples {i} to {i + chunk_size - 1}")
-        
-        writer.close()
-
-        # Verify output file
-        with pyedflib.EdfReader(tmp_out) as r:
-            try:
-                out_n_samples = r.getNSamples(0)
-            except TypeError:
-                out_n_samples = r.samples_in_file(0)
-            if out_n_samples != n_samples:
-                raise ValueError(f"Output truncated: expected {n_samples} samples, got {out_n_samples}")
-        
-        # Move temporary file to final output
+        with open(edf_path, "rb") as f:
+            hdr = split_main_header(f.read(MAIN_HEADER_BYTES).ljust(MAIN_HEADER_BYTES))
+        patient, recording = anonymized_main_fields(hdr, new_patient_name)
+        n_records = copy_edf_records(edf_path, tmp_out, block_bytes, patient=patient, recording=recording)
+        if not edf_file_ok(tmp_out, n_records):
+            raise ValueError(f"Output truncated: expected {n_records} data records")
         shutil.move(tmp_out, out_path)
-        print(f"Successfully anonymized {edf_path} -> {out_path}")
+    finally:
+        if os.path.exists(tmp_out):
+            os.remove(tmp_out)
+    return n_records
+
+def anonymize_edf(edf_path, out_path, new_patient_name, decode_fallback=True):
+    """
+    Anonymize an EDF file while preserving EEG signal data bit-exactly
+    (header rewritten, data records passed through block by block, so RAM does not grow with the file).
+    If passthrough fails: MNE re-export when decode_fallback (the governor found the decoded signals
+    fit in RAM), otherwise only the header is patched.
+    """
+    try:
+        n_records = passthrough_edf(edf_path, out_path, new_patient_name)
+        print(f"Successfully anonymized {edf_path} -> {out_path} ({n_records} data records)")
         return True
 
     except Exception as e1:
-        print(f"[WARN] PyEDFlib failed for {edf_path}: {e1}. Trying MNE...")
+        if not decode_fallback:
+            print(f"[WARN] Record passthrough failed for {edf_path}: {e1}. Patching header only...")
+            return patch_edf_header(edf_path, out_path, new_patient_name)
+        print(f"[WARN] Record passthrough failed for {edf_path}: {e1}. Trying MNE...")
         try:
             raw = mne.io.read_raw_edf(edf_path, preload=True, verbose=False)
             # Handle older MNE versions (anonymize without subject parameter)
@@ -149,20 +127,107 @@ def anonymize_edf(edf_path, out_path, new_patient_name):
             print(f"Successfully anonymized with MNE: {edf_path} -> {out_path}")
             return True
         except Exception as e2:
-
-            #Clear .tmp file (temporary store of signal data)
-            # if os.path.exists(tmp_out):
-            #     try:
-            #         os.remove(tmp_out)
-            #         logging.info(f"Cleaned up temporary file {tmp_out}")
-            #     except Exception as e:
-            #         logging.error(f"Failed to clean up {tmp_out}: {e}")
-
             print(f"[WARN] MNE failed: {e2}. Copying original...")
             shutil.copy2(edf_path, out_path)
             print(f"[FALLBACK] Copied original: {edf_path} -> {out_path}")
             return False 
 
+def anonymized_main_fields(hdr, new_patient_name):
+    """(patient, recording) của header chính sau khi xoá định danh; EDF+ giữ lại Startdate."""
+    if hdr["reserved"].startswith("EDF+"):
+        # EDF+: "code sex birthdate name" / "Startdate dd-MMM-yyyy admincode technician equipment"
+        patient = f"{new_patient_name} X X {new_patient_name}"
+        startdate = hdr["recording"].split()[:2]
+        recording = " ".join(startdate + ["X", "X", "X"]) if startdate[:1] == ["Startdate"] else "Startdate X X X X"
+        return patient, recording
+    return new_patient_name, ""
+
+def patch_edf_header(edf_path, out_path, new_patient_name):
+    """
+    Anonymize by rewriting only the patient / recording fields of the 256-byte main header;
+    signal data is never decoded. Patches in place when out_path == edf_path.
+    Also works on malformed / truncated files: whatever part of the two fields exists is overwritten.
+    """
+    try:
+        if os.path.abspath(out_path) != os.path.abspath(edf_path):
+            shutil.copy2(edf_path, out_path)
+        with open(out_path, "rb") as f:
+            buf = f.read(MAIN_HEADER_BYTES)
+        patient, recording = anonymized_main_fields(split_main_header(buf.ljust(MAIN_HEADER_BYTES)), new_patient_name)
+        fields = patient.encode("ascii", errors="replace")[:80].ljust(80) + \
+            recording.encode("ascii", errors="replace")[:80].ljust(80)
+        with open(out_path, "r+b") as f:
+            f.seek(8)
+            f.write(fields[:max(0, len(buf) - 8)])
+        print(f"Patched header only: {edf_path} -> {out_path}")
+        return True
+    except Exception as e:
+        print(f"[WARN] Header patch failed for {edf_path}: {e}")
+        return False
+
+ANONYMIZE_FAILED = "Anonymization failed (fallback to copy)"
+SCRUB_FAILED = "Annotation scrub failed"
+
+def read_patient_field(edf_path):
+    """Trường patient thô (80 byte) của header chính; None nếu không đọc được."""
+    try:
+        with open(edf_path, "rb") as f:
+            return split_main_header(f.read(MAIN_HEADER_BYTES).ljust(MAIN_HEADER_BYTES))["patient"]
+    except Exception:
+        return None
+
+def own_name_automaton(patient_field, original_name):
+    """
+    Automaton tên của chính file: từ trường patient thô của header (EDF+ "code sex birthdate name" hoặc cả trường)
+    và từ tên đã decode (pyedflib bỏ cấu trúc EDF+, vd. "LE THI MINH 1980").
+    """
+    names = [parse_patient_field(patient_field)[0] if patient_field else "", parse_patient_name(original_name)[0]]
+    return build_name_automaton([n for n in names if n])
+
+def anonymize_one(edf_path, out_path, anon_name, path=PATH_PASSTHROUGH, names=None, decode_fallback=True):
+    """
+    Parse + anonymize một file theo đường governor chọn; chạy trong worker cô lập.
+    Trả về (original_name, success, reason); reason mô tả lỗi khi success=False.
+    Mọi đường đều giữ nguyên kênh annotation, nên sau đó tên bệnh nhân (automaton names từ sheet + tên
+    trong header của chính file) được xoá tại chỗ trong các record annotation. Xoá annotation lỗi thì file ra
+    (header đã vá nhưng annotation còn tên) bị xoá, trừ khi out_path chính là edf_path (vá tại chỗ).
+    """
+    # Đọc trường patient thô trước khi ghi (out_path có thể chính là edf_path khi vá tại chỗ)
+    patient_field = read_patient_field(edf_path)
+    if path == PATH_HEADER_ONLY:
+        # Không mở bằng pyedflib (đọc cả file annotation); lấy tên thẳng từ header
+        success = patch_edf_header(edf_path, out_path, anon_name)
+        original_name = patient_field or os.path.basename(edf_path)
+    else:
+        original_name = get_patient_name(edf_path)
+        success = anonymize_edf(edf_path, out_path, anon_name, decode_fallback)
+
+    if not success:
+        return original_name, False, ANONYMIZE_FAILED
+    own_name = own_name_automaton(patient_field, original_name)
+    try:
+        n_scrubbed = scrub_annotations(out_path, [names, own_name])
+        if n_scrubbed:
+            logging.info(f"Scrubbed {n_scrubbed} name occurrences from annotations of {out_path}")
+    except (OSError, ValueError) as e:
+        print(f"[WARN] Annotation scrub failed for {out_path}: {e}")
+        if os.path.abspath(out_path) != os.path.abspath(edf_path) and os.path.exists(out_path):
+            os.remove(out_path)
+        return original_name, False, f"{SCRUB_FAILED}: {e}"
+    return original_name, True, None
+
+def record_failed_files(failed_rows):
+    """Append vào failed_files.tsv (file này có thể đã được create_bids ghi trước đó)."""
+    if not failed_rows:
+        return
+    write_header = not os.path.exists(failed_tsv)
+    with open(failed_tsv, "a", newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=["failed_file", "reason"], delimiter='\t', extrasaction='ignore')
+        if write_header:
+            writer.writeheader()
+        writer.writerows(failed_rows)
+    print(f"⚠️ {len(failed_rows)} files hit the timeout/memory cap. See {failed_tsv}")
+
 def extract_sub_num(sub_name: str) -> int:
     """
     Lấy số ID từ tên thư mục sub-XXX.
@@ -172,12 +237,18 @@ def extract_sub_num(sub_name: str) -> int:
     m = re.search(r"sub-(\d+)", sub_name)
     return int(m.group(1)) if m else 999999
 
-def process_bids(bids_root, overwrite=False, size_threshold=500):
+def process_bids(bids_root, overwrite=False):
     """
-    Process BIDS dataset, anonymize EDF files, skip large/unreadable files, and log skipped files.
+    Process BIDS dataset, anonymize EDF files, skip unreadable files, and log skipped files.
+    A memory governor picks record passthrough or header-only per file (and whether the full-decode MNE fallback
+    fits in RAM) instead of skipping large files.
     """
     rows = []
     skipped_rows = []
+    failed_rows = []
+    decision_rows = []
+    governor = MemoryGovernor(n_workers=n_workers)
+    names = build_name_automaton(load_sheet_names(names_xlsx))
     subs = [d for d in os.listdir(bids_root) if d.startswith("sub-")]
     subs_sorted = sorted(subs, key=extract_sub_num)
     # backup_dir = os.path.join(bids_root, "backups")
@@ -195,14 +266,6 @@ def process_bids(bids_root, overwrite=False, size_threshold=500):
             # Check file size
             try:
                 file_size = os.path.getsize(edf_path)
-                if file_size > size_threshold*1024*1024:
-                    skipped_rows.append({
-                        "file": edf_path,
-                        "size_mb": file_size / (1024 * 1024),
-                        "reason": f"File size ({file_size / (1024 * 1024):.2f} MB) exceeds threshold ({size_threshold} MB)"
-                    })
-                    logging.warning(f"Skipped {edf_path}: File size ({file_size / (1024 * 1024):.2f} MB) exceeds threshold")
-                    continue
             except Exception as e:
                 skipped_rows.append({
                     "file": edf_path,
@@ -212,49 +275,108 @@ def process_bids(bids_root, overwrite=False, size_threshold=500):
                 logging.warning(f"Skipped {edf_path}: Cannot access file: {e}")
                 continue
 
-            # Get patient name
-            original_name = get_patient_name(edf_path)
-            anon_name = sub
+            # Header triage: hopeless files skip the reader chain, repairable ones get fixed first
+            triage = triage_edf(edf_path)
+            src_path = edf_path
+            if triage["route"] == ROUTE_REPAIR_RECORDS:
+                src_path = repair_record_count(edf_path, edf_path + ".repaired", triage)
+                logging.info(f"Repaired {edf_path} ({triage['status']}: {triage['detail']})")
 
-            # Create backup
-            # backup = os.path.join(backup_dir, f"{sub}_{fname}.bak")
-            # shutil.copy2(edf_path, backup)
-            # logging.info(f"Backed up {edf_path} to {backup}")
+            # Choose passthrough / header-only and whether the full-decode MNE fallback fits in RAM
+            decision = governor.choose(src_path)
+            if triage["route"] in (ROUTE_REJECT, ROUTE_HEADER_ONLY, ROUTE_REPAIR_RECORDS):
+                decision = {**decision, "path": PATH_HEADER_ONLY,
+                            "reason": f"Triage {triage['status']}: {triage['detail']}"}
+            elif triage["route"] == ROUTE_STREAMING and decision["decode_fallback"]:
+                decision = {**decision, "decode_fallback": False,
+                            "reason": f"Triage {triage['status']}: {triage['detail']}; no MNE fallback"}
+            if annotation_inplace and decision["path"] != PATH_HEADER_ONLY:
+                decision = {**decision, "path": PATH_HEADER_ONLY,
+                            "reason": "In-place mode: header patch + annotation scrub"}
+
+            # Parse + anonymize in a supervised worker (timeout + RSS cap)
+            anon_name = sub
+            out_path = edf_path if overwrite else os.path.join(subdir, fname.replace(".edf", "_anon.edf"))
+            write_path = edf_path + ".tmp" if overwrite else out_path
+            if overwrite and decision["path"] == PATH_HEADER_ONLY:
+                write_path = src_path  # vá header tại chỗ (file gốc hoặc bản đã sửa), không copy file lớn
+            outcome = run_isolated(anonymize_one, src_path, write_path, anon_name, decision["path"], names,
+                                   decision["decode_fallback"], timeout=file_timeout, max_rss_mb=file_max_rss_mb)
+            if src_path not in (edf_path, write_path) and os.path.exists(src_path):
+                os.remove(src_path)
+            if triage["hopeless"]:
+                skipped_rows.append({
+                    "file": edf_path,
+                    "size_mb": file_size / (1024 * 1024),
+                    "reason": f"Triage {triage['status']}: {triage['detail']} (header scrubbed only)"
+                })
+            log_decision(edf_path, decision, outcome["peak_rss_mb"])
+            decision_rows.append({
+                "file": edf_path,
+                "size_mb": file_size / (1024 * 1024),
+                "triage": triage["status"],
+                "path": decision["path"],
+                "decode_fallback": decision["decode_fallback"],
+                "footprint_mb": decision["footprint_mb"],
+                "budget_mb": decision["budget_mb"],
+                "peak_rss_mb": outcome["peak_rss_mb"],
+                "ok": outcome["ok"]
+            })
+            if not outcome["ok"]:
+                # Worker bị kill / crash: dọn file tạm, giữ nguyên file gốc
+                for leftover in (write_path, write_path + ".tmp"):
+                    if leftover != edf_path and os.path.exists(leftover):
+                        os.remove(leftover)
+                failed_rows.append({"failed_file": edf_path, "reason": outcome["reason"]})
+                skipped_rows.append({
+                    "file": edf_path,
+                    "size_mb": file_size / (1024 * 1024),
+                    "reason": outcome["reason"]
+                })
+                logging.warning(f"Skipped {edf_path}: {outcome['reason']}")
+                continue
+            original_name, success, reason = outcome["result"]
+            scrub_failed = not success and reason.startswith(SCRUB_FAILED)
+            logging.info(f"Processed {edf_path} in {outcome['elapsed']:.1f} s, peak RSS {outcome['peak_rss_mb']:.0f} MB")
 
             # Anonymize file
             if overwrite:
-                tmp_out = edf_path + ".tmp"
-                success = anonymize_edf(edf_path, tmp_out, anon_name)
                 if success:
-                    os.replace(tmp_out, edf_path)
-                    out_path = edf_path
+                    os.replace(write_path, edf_path)
                     logging.info(f"Overwrote {edf_path}")
                 else:
-                    out_path = edf_path
+                    for leftover in (write_path, write_path + ".tmp"):
+                        if leftover != edf_path and os.path.exists(leftover):
+                            os.remove(leftover)
+                    if write_path == edf_path:
+                        # Đường header-only vá thẳng file gốc: file gốc KHÔNG còn nguyên, báo đúng như vậy
+                        reason = f"{reason} after patching the original in place; names may remain"
+                        logging.warning(f"Anonymization incomplete for {edf_path}: {reason}")
+                    else:
+                        logging.warning(f"Skipped anonymization for {edf_path}: {reason}; original kept")
                     skipped_rows.append({
                         "file": edf_path,
                         "size_mb": file_size / (1024 * 1024),
-                        "reason": "Anonymization failed (fallback to copy)"
+                        "reason": reason
                     })
-                    logging.warning(f"Skipped anonymization for {edf_path}: Failed and copied original")
             else:
-                out_fname = fname.replace(".edf", "_anon.edf")
-                out_path = os.path.join(subdir, out_fname)
-                success = anonymize_edf(edf_path, out_path, anon_name)
                 if not success:
                     skipped_rows.append({
                         "file": edf_path,
                         "size_mb": file_size / (1024 * 1024),
-                        "reason": "Anonymization failed (fallback to copy)"
+                        "reason": reason
                     })
-                    logging.warning(f"Skipped anonymization for {edf_path}: Failed and copied original")
+                    if scrub_failed:
+                        logging.warning(f"Skipped anonymization for {edf_path}: {reason}; removed {out_path}")
+                    else:
+                        logging.warning(f"Skipped anonymization for {edf_path}: Failed and copied original")
                 else:
                     logging.info(f"Wrote anonymized file: {out_path}")
 
             rows.append({
                 "sub": sub,
                 "orig_edf": edf_path,
-                "anon_edf": out_path,
+                "anon_edf": "n/a" if scrub_failed else out_path,
                 "original_patient_name": original_name,
                 "anon_patient_name": anon_name
             })
@@ -272,6 +394,15 @@ def process_bids(bids_root, overwrite=False, size_threshold=500):
         writer.writeheader()
         writer.writerows(skipped_rows)
 
+    # Write per-file memory decisions
+    with open(decisions_tsv, "w", newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=["file", "size_mb", "triage", "path", "decode_fallback", "footprint_mb",
+                                              "budget_mb", "peak_rss_mb", "ok"], delimiter='\t')
+        writer.writeheader()
+        writer.writerows(decision_rows)
+
+    record_failed_files(failed_rows)
+
     print(f"Completed. Mapping saved to: {mapping_csv}")
     print(f"Skipped files logged to: {skipped_csv}")
     logging.info(f"Completed. Mapping saved to: {mapping_csv}, Skipped files: {skipped_csv}")
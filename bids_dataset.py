@@ -0,0 +1,233 @@
+import os
+import glob
+import random
+from collections import OrderedDict, Counter
+import numpy as np
+import pandas as pd
+from edf_header import read_edf_header, data_records_in_file
+from edf_reader import EdfMemmap
+from derivative_store import scaling_to_uv
+from catalog import Catalog, default_catalog_path
+
+try:
+    # torch không bắt buộc: không có thì dataset vẫn là iterable Python thường (1 worker)
+    from torch.utils.data import IterableDataset, get_worker_info
+except ImportError:
+    IterableDataset = object
+
+    def get_worker_info():
+        return None
+
+
+def _run_info_from_header(bids_dir, bids_path):
+    header = read_edf_header(os.path.join(bids_dir, bids_path))
+    n_records = data_records_in_file(header)
+    if header["n_records"] >= 0:
+        n_records = min(n_records, header["n_records"])
+    channels = [i for i in range(header["n_signals"]) if i not in header["annotation_signals"]]
+    spr = Counter(header["samples_per_record"][i] for i in channels).most_common(1)
+    sfreq = spr[0][0] / (header["record_duration"] or 1.0) if spr else None
+    return {"sfreq": sfreq, "duration": n_records * header["record_duration"]}
+
+
+def query_runs(bids_dir, catalog=None, age_range=None, sex=None, min_duration=None, sfreq=None, qc_status=None):
+    """
+    Các run thỏa điều kiện: tuổi trong age_range (min, max), sex ('male' / 'female'),
+    thời lượng >= min_duration (giây), tần số lấy mẫu = sfreq, trạng thái QC = qc_status (vd. 'pass', cần catalog).
+    duration / sfreq lấy từ catalog khi có, thiếu thì đọc header EDF (chỉ vài trăm byte / file).
+    """
+    edf_files = glob.glob(os.path.join(bids_dir, "sub-*", "**", "*_eeg.edf"), recursive=True)
+    runs = pd.DataFrame({"bids_path": sorted(os.path.relpath(f, bids_dir) for f in edf_files)})
+    runs["participant_id"] = runs["bids_path"].str.split(os.sep).str[0]
+
+    participants_tsv = os.path.join(bids_dir, "participants.tsv")
+    if os.path.exists(participants_tsv):
+        participants = pd.read_csv(participants_tsv, sep="\t", dtype=str, keep_default_na=False)
+        runs = runs.merge(participants[["participant_id", "age", "sex"]].drop_duplicates("participant_id"),
+                          on="participant_id", how="left")
+    else:
+        runs["age"], runs["sex"] = "n/a", "n/a"
+    runs["age"] = pd.to_numeric(runs["age"], errors="coerce")
+
+    info = catalog.recording_info() if catalog is not None else {}
+    rows = []
+    for path in runs["bids_path"]:
+        try:
+            rows.append(info.get(path) or _run_info_from_header(bids_dir, path))
+        except (OSError, ValueError):
+            rows.append({"sfreq": None, "duration": None})
+    runs = pd.concat([runs, pd.DataFrame(rows, index=runs.index)], axis=1)
+
+    keep = runs["duration"].notna()
+    if age_range is not None:
+        keep &= runs["age"].between(*age_range)
+    if sex is not None:
+        keep &= runs["sex"].str.lower() == sex.lower()
+    if min_duration is not None:
+        keep &= runs["duration"] >= min_duration
+    if sfreq is not None:
+        keep &= np.isclose(runs["sfreq"].astype(float), sfreq)
+    if qc_status is not None:
+        passed = catalog.qc_recordings(qc_status) if catalog is not None else set()
+        keep &= runs["bids_path"].isin(passed)
+    return runs[keep].reset_index(drop=True)
+
+
+class HandleCache:
+    """LRU các EdfMemmap đang mở (tối đa max_open); handle bị loại được đóng."""
+
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self._items = OrderedDict()
+
+    def get(self, path):
+        reader = self._items.pop(path, None)
+        if reader is None:
+            reader = EdfMemmap(path)
+        self._items[path] = reader
+        while len(self._items) > self.max_open:
+            _, old = self._items.popitem(last=False)
+            old.close()
+        return reader
+
+    def clear(self):
+        for reader in self._items.values():
+            reader.close()
+        self._items.clear()
+
+
+class BlockCache:
+    """LRU các block đã decode (float32), loại theo tổng dung lượng max_bytes thay vì số phần tử."""
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+
+    def get(self, key, load):
+        block = self._items.pop(key, None)
+        if block is None:
+            block = load()
+            self.nbytes += block.nbytes
+        self._items[key] = block
+        while self.nbytes > self.max_bytes and len(self._items) > 1:
+            _, old = self._items.popitem(last=False)
+            self.nbytes -= old.nbytes
+        return block
+
+
+class BidsWindowDataset(IterableDataset):
+    """
+    Dataset dạng stream trên cây BIDS: sinh (window float32 uV [channels x samples], meta) từ các run
+    được chọn bằng query_runs. Recording được chia cho các worker DataLoader (và các rank khi train
+    phân tán). Mỗi worker giữ LRU handle + LRU block đã decode trên chính instance (tạo lười trong process
+    worker, sống qua các epoch khi DataLoader dùng persistent_workers) nên không mở / decode lại EDF liên tục.
+    Window được trộn từ tối đa interleave run đang mở cùng lúc (chọn ngẫu nhiên khi shuffle, lần lượt khi không).
+    """
+
+    def __init__(self, bids_dir, runs=None, window_seconds=30.0, stride_seconds=None, channels=None,
+                 block_seconds=60.0, max_open=64, cache_bytes=512 * 1024 * 1024, shuffle=False, seed=0,
+                 rank=0, world_size=1, interleave=8, **query):
+        self.bids_dir = bids_dir
+        if runs is None:
+            catalog_path = default_catalog_path(bids_dir)
+            catalog = Catalog(catalog_path) if os.path.exists(catalog_path) else None
+            runs = query_runs(bids_dir, catalog, **query)
+        self.runs = runs
+        self.window_seconds = window_seconds
+        self.stride_seconds = stride_seconds or window_seconds
+        self.channels = channels
+        self.block_seconds = block_seconds
+        self.max_open = max_open
+        self.cache_bytes = cache_bytes
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.rank, self.world_size = rank, world_size
+        # mỗi run đang trộn giữ một handle: không vượt max_open để LRU không đóng handle đang dùng
+        self.interleave = max(1, min(interleave, max_open))
+        self._cache_state = None
+
+    def __getstate__(self):
+        # handle / block đã decode không đi theo dataset sang process worker
+        return {**self.__dict__, "_cache_state": None}
+
+    def caches(self):
+        """(HandleCache, BlockCache) của process hiện tại; tạo lười, process con (fork) không dùng cache của cha."""
+        if self._cache_state is None or self._cache_state[0] != os.getpid():
+            self._cache_state = (os.getpid(), HandleCache(self.max_open), BlockCache(self.cache_bytes))
+        return self._cache_state[1:]
+
+    def close(self):
+        """Đóng mọi handle đang mở của process hiện tại."""
+        if self._cache_state is not None and self._cache_state[0] == os.getpid():
+            self._cache_state[1].clear()
+        self._cache_state = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _shard(self):
+        paths = list(self.runs["bids_path"])
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(paths)
+        worker = get_worker_info()
+        worker_id, n_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        n_shards = self.world_size * n_workers
+        return paths[self.rank * n_workers + worker_id::n_shards]
+
+    def _channel_index(self, reader):
+        if self.channels:
+            return reader.channel_index(self.channels)
+        spr = Counter(reader.samples_per_record.tolist()).most_common(1)[0][0]
+        return [k for k in range(reader.n_channels) if reader.samples_per_record[k] == spr]
+
+    def iter_run(self, bids_path, handles, blocks):
+        reader = handles.get(os.path.join(self.bids_dir, bids_path))
+        idx = self._channel_index(reader)
+        sfreq = float(reader.sfreqs[idx[0]])
+        gain, offset = scaling_to_uv(reader, idx)
+        gain, offset = gain[:, None].astype(np.float32), offset[:, None].astype(np.float32)
+        n_samples = reader.n_records * int(reader.samples_per_record[idx[0]])
+        block = max(1, int(round(self.block_seconds * sfreq)))
+        win = int(round(self.window_seconds * sfreq))
+        stride = int(round(self.stride_seconds * sfreq))
+
+        def load(b):
+            return lambda: reader.digital(idx, b * block, (b + 1) * block).astype(np.float32) * gain + offset
+
+        for start in range(0, n_samples - win + 1, stride):
+            b0, b1 = start // block, (start + win - 1) // block
+            parts = [blocks.get((bids_path, b), load(b)) for b in range(b0, b1 + 1)]
+            data = parts[0] if len(parts) == 1 else np.concatenate(parts, axis=1)
+            offset_in = start - b0 * block
+            # copy: block trong cache không bị sửa nếu consumer ghi đè window
+            yield data[:, offset_in:offset_in + win].copy(), {"bids_path": bids_path, "start": start / sfreq,
+                                                              "sfreq": sfreq}
+
+    def __iter__(self):
+        handles, blocks = self.caches()
+        worker = get_worker_info()
+        rng = random.Random(hash((self.seed, self.epoch, self.rank, worker.id if worker is not None else 0)))
+        pending = iter(self._shard())
+        active = []
+        turn = 0
+        while True:
+            while len(active) < self.interleave:
+                bids_path = next(pending, None)
+                if bids_path is None:
+                    break
+                active.append(self.iter_run(bids_path, handles, blocks))
+            if not active:
+                return
+            k = rng.randrange(len(active)) if self.shuffle else turn % len(active)
+            try:
+                item = next(active[k])
+            except StopIteration:
+                active.pop(k)
+                continue
+            except (OSError, ValueError):
+                active.pop(k)
+                continue  # file hỏng / thiếu kênh: bỏ qua run, không dừng cả epoch
+            turn = k + 1
+            yield item
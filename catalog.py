@@ -0,0 +1,282 @@
+import os
+import time
+import sqlite3
+from contextlib import contextmanager
+
+# Catalog của dataset BIDS: một dòng / recording (đường dẫn tương đối so với bids_dir)
+RECORDING_COLUMNS = [
+    "bids_path", "n_channels", "sfreq", "duration", "n_windows",
+    "signature", "near_duplicate_of", "similarity", "updated",
+]
+
+# QC một lần quét / recording (qc.py)
+QC_COLUMNS = [
+    "bids_path", "duration", "n_channels", "flat_fraction", "clip_fraction", "line_noise_ratio",
+    "outlier_fraction", "n_bad_channels", "status", "updated",
+]
+
+# Thống kê chuẩn hóa theo kênh của từng recording (norm_stats.py), gộp được theo subject / site / dataset
+CHANNEL_STATS_COLUMNS = ["bids_path", "channel", "unit", "count", "mean", "m2", "min", "max", "digest", "updated"]
+
+# Phổ Welch + band power theo kênh của từng recording (spectral.py); psd là BLOB float32 từ 0 Hz, bước psd_step
+BAND_POWER_COLUMNS = [
+    "bids_path", "channel", "sfreq", "delta", "theta", "alpha", "beta", "gamma", "total_power",
+    "peak_alpha_freq", "spectral_edge_95", "psd_step", "psd", "updated",
+]
+
+
+def default_catalog_path(bids_dir):
+    return os.path.join(bids_dir, "derivatives", "catalog.sqlite")
+
+
+class Catalog:
+    """
+    SQLite catalog dùng chung cho các bước phân tích sau khi convert:
+    - recordings: thông tin cơ bản + chữ ký MinHash + cờ near-duplicate
+    - lsh_buckets: (band, bucket) -> recording, để tìm ứng viên near-duplicate không cần so từng cặp
+    - near_duplicates: các cặp recording có độ tương đồng ước tính >= ngưỡng
+    - qc: chỉ số chất lượng tín hiệu + trạng thái pass / bad của từng recording
+    - channel_stats: moments + t-digest (uV) của từng kênh trong từng recording
+    - band_power: band power Welch + PSD float32 của từng kênh trong từng recording
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS recordings (
+                    bids_path TEXT PRIMARY KEY,
+                    n_channels INTEGER,
+                    sfreq REAL,
+                    duration REAL,
+                    n_windows INTEGER,
+                    signature BLOB,
+                    near_duplicate_of TEXT,
+                    similarity REAL,
+                    updated REAL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS lsh_buckets (
+                    band INTEGER NOT NULL,
+                    bucket TEXT NOT NULL,
+                    bids_path TEXT NOT NULL,
+                    PRIMARY KEY (band, bucket, bids_path)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS near_duplicates (
+                    bids_path TEXT NOT NULL,
+                    other TEXT NOT NULL,
+                    similarity REAL,
+                    PRIMARY KEY (bids_path, other)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS qc (
+                    bids_path TEXT PRIMARY KEY,
+                    duration REAL,
+                    n_channels INTEGER,
+                    flat_fraction REAL,
+                    clip_fraction REAL,
+                    line_noise_ratio REAL,
+                    outlier_fraction REAL,
+                    n_bad_channels INTEGER,
+                    status TEXT,
+                    updated REAL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS channel_stats (
+                    bids_path TEXT NOT NULL,
+                    channel TEXT NOT NULL,
+                    unit TEXT,
+                    count INTEGER,
+                    mean REAL,
+                    m2 REAL,
+                    min REAL,
+                    max REAL,
+                    digest BLOB,
+                    updated REAL,
+                    PRIMARY KEY (bids_path, channel)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS band_power (
+                    bids_path TEXT NOT NULL,
+                    channel TEXT NOT NULL,
+                    sfreq REAL,
+                    delta REAL,
+                    theta REAL,
+                    alpha REAL,
+                    beta REAL,
+                    gamma REAL,
+                    total_power REAL,
+                    peak_alpha_freq REAL,
+                    spectral_edge_95 REAL,
+                    psd_step REAL,
+                    psd BLOB,
+                    updated REAL,
+                    PRIMARY KEY (bids_path, channel)
+                )
+            """)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def recording_paths(self):
+        """Mọi recording đã có trong catalog (đường dẫn tương đối so với bids_dir)."""
+        with self._connect() as conn:
+            return sorted(row[0] for row in conn.execute("SELECT bids_path FROM recordings"))
+
+    def recording_info(self):
+        """bids_path -> {sfreq, duration} cho các recording đã biết hai giá trị này."""
+        with self._connect() as conn:
+            return {path: {"sfreq": sfreq, "duration": duration} for path, sfreq, duration in conn.execute(
+                "SELECT bids_path, sfreq, duration FROM recordings WHERE sfreq IS NOT NULL AND duration IS NOT NULL"
+            )}
+
+    def known_recordings(self):
+        with self._connect() as conn:
+            return {row[0] for row in conn.execute("SELECT bids_path FROM recordings WHERE signature IS NOT NULL")}
+
+    def _upsert(self, table, allowed, bids_path, fields):
+        unknown = set(fields) - set(allowed)
+        if unknown:
+            raise ValueError(f"Unknown catalog columns: {sorted(unknown)}")
+        fields["updated"] = time.time()
+        columns = ["bids_path"] + list(fields)
+        updates = ", ".join(f"{c}=excluded.{c}" for c in fields)
+        with self._connect() as conn:
+            conn.execute(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT(bids_path) DO UPDATE SET {updates}",
+                [bids_path] + list(fields.values())
+            )
+
+    def upsert_recording(self, bids_path, **fields):
+        self._upsert("recordings", RECORDING_COLUMNS, bids_path, fields)
+
+    def upsert_qc(self, bids_path, **fields):
+        self._upsert("qc", QC_COLUMNS, bids_path, fields)
+
+    def qc_rows(self):
+        with self._connect() as conn:
+            return conn.execute(f"SELECT {', '.join(QC_COLUMNS)} FROM qc ORDER BY bids_path").fetchall()
+
+    def qc_recordings(self, status=None, exclude=()):
+        """bids_path đã có QC (lọc theo status nếu cho, vd. 'pass'; bỏ các status trong exclude)."""
+        with self._connect() as conn:
+            if status is None:
+                rows = conn.execute("SELECT bids_path, status FROM qc")
+            else:
+                rows = conn.execute("SELECT bids_path, status FROM qc WHERE status=?", (status,))
+            return {path for path, s in rows if s not in exclude}
+
+    def set_channel_stats(self, bids_path, rows):
+        """Thay toàn bộ thống kê kênh của một recording; rows: list dict theo CHANNEL_STATS_COLUMNS."""
+        now = time.time()
+        columns = CHANNEL_STATS_COLUMNS[1:-1]
+        with self._connect() as conn:
+            conn.execute("DELETE FROM channel_stats WHERE bids_path=?", (bids_path,))
+            conn.executemany(
+                f"INSERT INTO channel_stats ({', '.join(CHANNEL_STATS_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(CHANNEL_STATS_COLUMNS))})",
+                [[bids_path] + [row[c] for c in columns] + [now] for row in rows]
+            )
+
+    def channel_stats_recordings(self):
+        with self._connect() as conn:
+            return {row[0] for row in conn.execute("SELECT DISTINCT bids_path FROM channel_stats")}
+
+    def iter_channel_stats(self):
+        """Duyệt từng dòng channel_stats (không nạp cả bảng vào RAM), theo thứ tự bids_path."""
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            yield from conn.execute(
+                f"SELECT {', '.join(CHANNEL_STATS_COLUMNS[:-1])} FROM channel_stats ORDER BY bids_path, channel"
+            )
+        finally:
+            conn.close()
+
+    def set_band_power(self, bids_path, rows):
+        """Thay toàn bộ band power của một recording; rows: list dict theo BAND_POWER_COLUMNS."""
+        now = time.time()
+        columns = BAND_POWER_COLUMNS[1:-1]
+        with self._connect() as conn:
+            conn.execute("DELETE FROM band_power WHERE bids_path=?", (bids_path,))
+            conn.executemany(
+                f"INSERT INTO band_power ({', '.join(BAND_POWER_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(BAND_POWER_COLUMNS))})",
+                [[bids_path] + [row[c] for c in columns] + [now] for row in rows]
+            )
+
+    def band_power_recordings(self):
+        with self._connect() as conn:
+            return {row[0] for row in conn.execute("SELECT DISTINCT bids_path FROM band_power")}
+
+    def band_power_rows(self, columns, channels=None):
+        """Các cột columns của bảng band_power (lọc theo danh sách kênh nếu cho)."""
+        unknown = set(columns) - set(BAND_POWER_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown catalog columns: {sorted(unknown)}")
+        query = f"SELECT {', '.join(columns)} FROM band_power"
+        params = []
+        if channels:
+            query += f" WHERE channel IN ({', '.join('?' * len(channels))})"
+            params = list(channels)
+        with self._connect() as conn:
+            return conn.execute(query + " ORDER BY bids_path, channel", params).fetchall()
+
+    def signatures(self, bids_paths):
+        """bids_path -> signature (bytes) cho các recording đã có chữ ký."""
+        found = {}
+        with self._connect() as conn:
+            for path in set(bids_paths):
+                row = conn.execute("SELECT signature FROM recordings WHERE bids_path=?", (path,)).fetchone()
+                if row and row[0] is not None:
+                    found[path] = row[0]
+        return found
+
+    def add_buckets(self, bids_path, buckets):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM lsh_buckets WHERE bids_path=?", (bids_path,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO lsh_buckets (band, bucket, bids_path) VALUES (?, ?, ?)",
+                [(band, bucket, bids_path) for band, bucket in enumerate(buckets)]
+            )
+
+    def bucket_members(self, buckets):
+        """Các recording chung ít nhất một (band, bucket)."""
+        members = set()
+        with self._connect() as conn:
+            for band, bucket in enumerate(buckets):
+                members.update(row[0] for row in conn.execute(
+                    "SELECT bids_path FROM lsh_buckets WHERE band=? AND bucket=?", (band, bucket)
+                ))
+        return members
+
+    def flag_near_duplicates(self, bids_path, matches):
+        """matches: list (other, similarity); recording được gắn cờ theo match có similarity cao nhất."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM near_duplicates WHERE bids_path=?", (bids_path,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO near_duplicates (bids_path, other, similarity) VALUES (?, ?, ?)",
+                [(bids_path, other, sim) for other, sim in matches]
+            )
+            best = max(matches, key=lambda m: m[1]) if matches else (None, None)
+            conn.execute("UPDATE recordings SET near_duplicate_of=?, similarity=? WHERE bids_path=?",
+                         (best[0], best[1], bids_path))
+
+    def near_duplicate_pairs(self):
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT bids_path, other, similarity FROM near_duplicates ORDER BY bids_path, similarity DESC"
+            ).fetchall()
@@ -0,0 +1,205 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from edf_header import read_edf_header
+
+PARTIAL_BYTES = 1024 * 1024     # số byte đầu + cuối phần data dùng cho hash nhanh
+CHUNK_BYTES = 8 * 1024 * 1024
+
+
+def data_section(edf_path):
+    """(offset, size) của phần data; header (chứa tên, ngày) không được hash vì mỗi bản export có thể khác."""
+    file_size = os.path.getsize(edf_path)
+    try:
+        offset = min(read_edf_header(edf_path)["data_offset"], file_size)
+    except (OSError, ValueError):
+        offset = 0
+    return offset, file_size - offset
+
+
+def partial_hash(edf_path):
+    """Hash nhanh: kích thước data + 1 MB đầu + 1 MB cuối của phần data."""
+    offset, size = data_section(edf_path)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(size).encode())
+    with open(edf_path, "rb") as f:
+        f.seek(offset)
+        h.update(f.read(min(size, PARTIAL_BYTES)))
+        if size > 2 * PARTIAL_BYTES:
+            f.seek(offset + size - PARTIAL_BYTES)
+            h.update(f.read(PARTIAL_BYTES))
+    return h.hexdigest()
+
+
+def full_hash(edf_path):
+    """Hash đầy đủ phần data, đọc theo khối 8 MB."""
+    offset, size = data_section(edf_path)
+    h = hashlib.blake2b(digest_size=32)
+    with open(edf_path, "rb") as f:
+        f.seek(offset)
+        while True:
+            chunk = f.read(CHUNK_BYTES)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ContentIndex:
+    """
+    Index content-addressable (SQLite) của các bản ghi đã convert, bảng sources:
+    mọi file nguồn đã gặp -> partial hash, full hash (nếu đã tính), đường dẫn BIDS;
+    canonical = NULL với bản gốc, = file gốc với bản trùng (chỉ tham chiếu, không copy).
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sources (
+                    source TEXT PRIMARY KEY,
+                    partial_hash TEXT NOT NULL,
+                    full_hash TEXT,
+                    canonical TEXT,
+                    bids_path TEXT,
+                    added REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sources_partial ON sources(partial_hash)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sources_full ON sources(full_hash)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def known_partials(self, partials):
+        """partial hash -> list (source, full_hash, bids_path) của các bản canonical đã có trong index."""
+        found = defaultdict(list)
+        with self._connect() as conn:
+            for p in set(partials):
+                for row in conn.execute(
+                    "SELECT source, full_hash, bids_path FROM sources WHERE partial_hash=? AND canonical IS NULL", (p,)
+                ):
+                    found[p].append(row)
+        return found
+
+    def set_full_hash(self, source, full):
+        with self._connect() as conn:
+            conn.execute("UPDATE sources SET full_hash=? WHERE source=?", (full, source))
+
+    def register(self, source, partial, full=None, canonical=None, bids_path=None):
+        """canonical=None: file này là bản gốc; ngược lại là bản trùng của canonical."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sources (source, partial_hash, full_hash, canonical, bids_path, added) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (source, partial, full, canonical, bids_path, time.time())
+            )
+
+    def set_bids_path(self, source, bids_path):
+        """Ghi đường dẫn BIDS thực tế của bản gốc source (sau khi convert), cho cả các bản trùng tham chiếu tới nó."""
+        with self._connect() as conn:
+            conn.execute("UPDATE sources SET bids_path=? WHERE source=? OR canonical=?", (bids_path, source, source))
+
+    def duplicates_of(self, canonicals):
+        """(source, canonical, full_hash, bids_path) của các bản trùng có bản gốc nằm trong canonicals."""
+        with self._connect() as conn:
+            rows = []
+            for c in sorted(set(canonicals)):
+                rows.extend(conn.execute(
+                    "SELECT source, canonical, full_hash, bids_path FROM sources WHERE canonical=? ORDER BY source", (c,)
+                ).fetchall())
+        return rows
+
+    def lookup(self, source):
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT partial_hash, full_hash, canonical, bids_path FROM sources WHERE source=?", (source,)
+            ).fetchone()
+
+
+def find_duplicates(edf_files, index, n_threads=8):
+    """
+    Tìm file trùng nội dung (phần data) trong edf_files và với index từ các lần chạy trước.
+    1. Partial hash cho mọi file.
+    2. Chỉ những file có partial hash trùng (trong batch hoặc với index) mới tính full hash.
+    Trả về (partials, fulls, duplicates) với duplicates: file -> (canonical_source, full_hash, bids_path|None).
+    """
+    edf_files = sorted(edf_files)
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        partials = dict(zip(edf_files, pool.map(partial_hash, edf_files)))
+
+    by_partial = defaultdict(list)
+    for f, p in partials.items():
+        by_partial[p].append(f)
+    known = index.known_partials(partials.values())
+    candidates = [f for p, fs in by_partial.items() if len(fs) > 1 or p in known for f in fs]
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        fulls = dict(zip(candidates, pool.map(full_hash, candidates)))
+
+    # Bản canonical đã có trong index (lần chạy trước) được ưu tiên
+    canonical_by_full = {}
+    for p in {partials[f] for f in candidates}:
+        for source, full, bids_path in known.get(p, []):
+            if full is None:
+                if not os.path.exists(source):
+                    logging.warning(f"Cannot verify index entry {source}: source file is gone")
+                    continue
+                full = full_hash(source)
+                index.set_full_hash(source, full)
+            canonical_by_full.setdefault(full, (source, bids_path))
+
+    duplicates = {}
+    for f in candidates:
+        full = fulls[f]
+        if full in canonical_by_full:
+            canonical, bids_path = canonical_by_full[full]
+            if canonical != f:
+                duplicates[f] = (canonical, full, bids_path)
+        else:
+            canonical_by_full[full] = (f, None)
+    return partials, fulls, duplicates
+
+
+def dedup_edf_groups(edf_groups, index):
+    """
+    Bỏ các file trùng nội dung khỏi edf_groups (folder rỗng sau khi lọc thì bỏ luôn folder).
+    Trả về (edf_groups đã lọc, partials, fulls, duplicates).
+    """
+    all_files = [f for files in edf_groups.values() for f in files]
+    partials, fulls, duplicates = find_duplicates(all_files, index)
+
+    kept_groups = {}
+    for folder, files in edf_groups.items():
+        kept = [f for f in files if f not in duplicates]
+        if kept:
+            kept_groups[folder] = kept
+    if duplicates:
+        logging.info(f"Dedup: {len(duplicates)} duplicate recordings referenced instead of copied")
+    return kept_groups, partials, fulls, duplicates
+
+
+def record_duplicates(index, duplicates, partials):
+    """
+    Ghi các bản trùng vào index, tham chiếu tới đường dẫn BIDS của bản gốc.
+    Gọi sau khi bản gốc đã được register (để biết đường dẫn BIDS). Trả về các dòng cho duplicates.tsv.
+    """
+    rows = []
+    for f, (canonical, full, bids_path) in sorted(duplicates.items()):
+        if bids_path is None:
+            entry = index.lookup(canonical)
+            bids_path = entry[3] if entry else None
+        index.register(f, partials[f], full, canonical=canonical, bids_path=bids_path)
+        rows.append({"file": f, "duplicate_of": canonical, "bids_path": bids_path or "n/a", "content_hash": full})
+    return rows
@@ -0,0 +1,232 @@
+import os
+import glob
+import json
+import shutil
+import logging
+import argparse
+from collections import Counter
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+from edf_reader import EdfMemmap
+from catalog import Catalog, default_catalog_path
+
+STORE_DIR = os.path.join("derivatives", "arrays")
+INDEX_COLUMNS = ["bids_path", "store_path", "n_channels", "n_samples", "sfreq", "chunk_samples"]
+# Hệ số đổi đơn vị vật lý của header EDF về uV, để mọi run trong store có cùng thang đo
+UNIT_TO_UV = {"uv": 1.0, "µv": 1.0, "mv": 1e3, "v": 1e6, "nv": 1e-3}
+
+
+class ZarrStore:
+    """Một thư mục .zarr / run: mảng 'data' int16 (channels x samples), chunk (1 kênh x chunk_samples)."""
+
+    suffix = ".zarr"
+
+    def __init__(self):
+        import zarr  # chỉ cần khi dùng backend này (pip install zarr)
+        self.zarr = zarr
+
+    def create(self, path, shape, chunks, attrs):
+        group = self.zarr.open_group(path, mode="w")
+        data = group.create_array("data", shape=shape, chunks=chunks, dtype="int16") \
+            if hasattr(group, "create_array") else group.create_dataset("data", shape=shape, chunks=chunks, dtype="int16")
+        group.attrs.update(attrs)
+        return group, data
+
+    def close(self, handle):
+        pass
+
+
+class Hdf5Store:
+    """Một file .h5 / run: dataset 'data' int16 (channels x samples), chunk (1 x chunk_samples), gzip + shuffle."""
+
+    suffix = ".h5"
+
+    def __init__(self):
+        import h5py  # chỉ cần khi dùng backend này (pip install h5py)
+        self.h5py = h5py
+
+    def create(self, path, shape, chunks, attrs):
+        f = self.h5py.File(path, "w")
+        data = f.create_dataset("data", shape=shape, chunks=chunks, dtype="int16",
+                                compression="gzip", compression_opts=4, shuffle=True)
+        for key, value in attrs.items():
+            f.attrs[key] = json.dumps(value) if isinstance(value, (list, dict)) else value
+        return f, data
+
+    def close(self, handle):
+        handle.close()
+
+
+STORES = {"zarr": ZarrStore, "hdf5": Hdf5Store}
+
+
+def store_path_for(bids_path, fmt):
+    """derivatives/arrays/sub-XXXX/<run>_eeg.<zarr|h5>, tương đối so với bids_dir."""
+    base = os.path.basename(bids_path)[:-len(".edf")]
+    sub = bids_path.split(os.sep)[0]
+    return os.path.join(STORE_DIR, sub, base + STORES[fmt].suffix)
+
+
+def scaling_to_uv(reader, idx):
+    """(gain, offset) theo uV cho các kênh idx: physical_uV = digital * gain + offset."""
+    factors = np.array([UNIT_TO_UV.get(reader.units[k].strip().lower(), 1.0) for k in idx])
+    return reader.gain[idx] * factors, reader.offset[idx] * factors
+
+
+def export_run(bids_dir, bids_path, fmt="zarr", chunk_seconds=10.0, block_chunks=6):
+    """
+    Ghi một run ra store dạng mảng: digital int16 pass-through (không mất mát) + gain/offset theo uV trong attrs.
+    Chỉ giữ các kênh có tần số lấy mẫu phổ biến nhất (kênh annotation luôn bị bỏ).
+    Đọc / ghi theo khối block_chunks chunk thời gian nên RAM không phụ thuộc độ dài recording.
+    Ghi ra .tmp rồi đổi tên, run dở dang không bao giờ trông như đã xong.
+    """
+    store = STORES[fmt]()
+    out_rel = store_path_for(bids_path, fmt)
+    out_path = os.path.join(bids_dir, out_rel)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    with EdfMemmap(os.path.join(bids_dir, bids_path)) as reader:
+        if not reader.n_channels:
+            raise ValueError("No signal channels")
+        spr = Counter(reader.samples_per_record.tolist()).most_common(1)[0][0]
+        idx = [k for k in range(reader.n_channels) if reader.samples_per_record[k] == spr]
+        sfreq = float(reader.sfreqs[idx[0]])
+        n_samples = reader.n_records * spr
+        chunk_samples = max(1, int(round(chunk_seconds * sfreq)))
+        gain, offset = scaling_to_uv(reader, idx)
+        attrs = {
+            "bids_path": bids_path,
+            "channels": [reader.labels[k] for k in idx],
+            "sfreq": sfreq,
+            "unit": "uV",
+            "gain": gain.tolist(),
+            "offset": offset.tolist(),
+        }
+        tmp_path = out_path + ".tmp"
+        handle, data = store.create(tmp_path, (len(idx), n_samples), (1, chunk_samples), attrs)
+        try:
+            block = chunk_samples * block_chunks
+            for start in range(0, n_samples, block):
+                stop = min(start + block, n_samples)
+                data[:, start:stop] = reader.digital(idx, start, stop)
+        finally:
+            store.close(handle)
+    if os.path.exists(out_path):
+        _remove(out_path)
+    os.replace(tmp_path, out_path)
+    return {"bids_path": bids_path, "store_path": out_rel, "n_channels": len(idx), "n_samples": n_samples,
+            "sfreq": sfreq, "chunk_samples": chunk_samples}
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def _export_item(item):
+    bids_dir, bids_path, fmt, chunk_seconds = item
+    try:
+        return export_run(bids_dir, bids_path, fmt, chunk_seconds), None
+    except (OSError, ValueError) as e:
+        return {"bids_path": bids_path}, str(e)
+
+
+def list_runs(bids_dir, catalog=None):
+    """
+    Các run cần export: quét cây BIDS, hợp với các run trong catalog (nếu có) còn tồn tại trên đĩa.
+    Catalog có thể chưa cập nhật các run mới thêm, nên không dùng nó thay cho việc quét cây.
+    """
+    edf_files = glob.glob(os.path.join(bids_dir, "sub-*", "**", "*_eeg.edf"), recursive=True)
+    paths = {os.path.relpath(f, bids_dir) for f in edf_files}
+    if catalog is not None:
+        paths.update(p for p in catalog.recording_paths() if os.path.exists(os.path.join(bids_dir, p)))
+    return sorted(paths)
+
+
+def export_store(bids_dir, fmt="zarr", catalog=None, chunk_seconds=10.0, workers=1, overwrite=False):
+    """
+    Export song song mọi run vào derivatives/arrays; run đã có store thì bỏ qua (trừ khi overwrite).
+    index.tsv (một dòng / run) được cập nhật để dataloader biết shape / sfreq mà không mở store.
+    """
+    STORES[fmt]()  # báo thiếu thư viện ngay, trước khi chạy pool
+    index_tsv = os.path.join(bids_dir, STORE_DIR, "index.tsv")
+    index = pd.read_csv(index_tsv, sep="\t") if os.path.exists(index_tsv) else pd.DataFrame(columns=INDEX_COLUMNS)
+    runs = list_runs(bids_dir, catalog)
+    done = set(index["bids_path"])
+    todo = [p for p in runs if overwrite or p not in done
+            or not os.path.exists(os.path.join(bids_dir, store_path_for(p, fmt)))]
+
+    items = [(bids_dir, p, fmt, chunk_seconds) for p in todo]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(tqdm(pool.map(_export_item, items), total=len(items), desc=f"Exporting {fmt}"))
+    else:
+        results = [_export_item(it) for it in tqdm(items, desc=f"Exporting {fmt}")]
+
+    rows, failed = [], []
+    for row, error in results:
+        if error:
+            failed.append({"failed_file": row["bids_path"], "reason": error})
+            logging.warning(f"Failed to export {row['bids_path']}: {error}")
+        else:
+            rows.append(row)
+    if rows:
+        new = pd.DataFrame(rows, columns=INDEX_COLUMNS)
+        index = pd.concat([index[~index["bids_path"].isin(new["bids_path"])], new], ignore_index=True)
+        os.makedirs(os.path.dirname(index_tsv), exist_ok=True)
+        index.sort_values("bids_path").to_csv(index_tsv, sep="\t", index=False)
+    return len(rows), failed
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Export các run EDF trong BIDS ra store Zarr / HDF5 cho training")
+    parser.add_argument(
+        "--bids_dir",
+        type=str,
+        required=True,
+        help="BIDS database directory"
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="zarr",
+        choices=sorted(STORES),
+        help="Định dạng store (zarr cần 'zarr', hdf5 cần 'h5py')"
+    )
+    parser.add_argument(
+        "--catalog",
+        type=str,
+        default=None,
+        help="SQLite catalog (mặc định: <bids_dir>/derivatives/catalog.sqlite); không có thì quét cây BIDS"
+    )
+    parser.add_argument(
+        "--chunk_seconds",
+        type=float,
+        default=10.0,
+        help="Độ dài một chunk thời gian (giây)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Số process export song song"
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Export lại cả các run đã có trong store"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    args = get_args()
+    catalog_path = args.catalog or default_catalog_path(args.bids_dir)
+    catalog = Catalog(catalog_path) if os.path.exists(catalog_path) else None
+    n_runs, failed = export_store(args.bids_dir, args.format, catalog, args.chunk_seconds, args.workers,
+                                  args.overwrite)
+    print(f"{n_runs} runs exported to {os.path.join(args.bids_dir, STORE_DIR)} ({len(failed)} failed)")
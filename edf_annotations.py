@@ -0,0 +1,118 @@
+import os
+import glob
+import json
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from edf_header import read_edf_header, data_records_in_file
+
+# Ký tự phân cách TAL (EDF+ spec, mục 2.2.2)
+TAL_ONSET_END = b"\x14"     # kết thúc onset[/duration] và từng annotation
+TAL_DURATION = b"\x15"      # giữa onset và duration
+TAL_END = b"\x00"           # kết thúc một TAL; phần còn lại của record là padding \x00
+
+EVENTS_JSON = {
+    "onset": {"Description": "Onset of the annotation, in seconds from the start of the recording", "Units": "s"},
+    "duration": {"Description": "Duration of the annotation (n/a when not given in the EDF+ TAL)", "Units": "s"},
+    "trial_type": {"Description": "Annotation text from the EDF+ 'EDF Annotations' channel"},
+}
+
+
+def parse_tal(record_bytes):
+    """
+    Tách các TAL trong phần annotation của một data record.
+    Trả về (record_onset, events) với events là list (onset, duration|None, description);
+    TAL đầu tiên không có text là time-keeping annotation (onset của record), không phải event.
+    """
+    record_onset, events = None, []
+    for tal in record_bytes.split(TAL_END):
+        if not tal:
+            continue
+        parts = tal.split(TAL_ONSET_END)
+        timing, texts = parts[0], [t for t in parts[1:] if t]
+        onset_raw, _, duration_raw = timing.partition(TAL_DURATION)
+        try:
+            onset = float(onset_raw)
+            duration = float(duration_raw) if duration_raw else None
+        except ValueError:
+            logging.warning(f"Skipping malformed TAL {tal[:40]!r}")
+            continue
+        if not texts:
+            if record_onset is None:
+                record_onset = onset
+            continue
+        for text in texts:
+            events.append((onset, duration, text.decode("utf-8", errors="replace").strip()))
+    return record_onset, events
+
+
+def read_annotations(edf_path, block_records=4096):
+    """
+    Đọc annotation EDF+ trực tiếp từ các kênh 'EDF Annotations': memmap phần data theo byte và chỉ
+    copy đoạn byte TAL của mỗi record, kênh tín hiệu không bao giờ được decode.
+    Trả về DataFrame (onset, duration, trial_type) theo thứ tự onset; rỗng nếu file không có annotation.
+    """
+    header = read_edf_header(edf_path)
+    n_records = data_records_in_file(header)
+    if header["n_records"] >= 0:
+        n_records = min(n_records, header["n_records"])
+    events = []
+    if header["annotation_signals"] and n_records:
+        byte_offsets = np.cumsum([0] + header["samples_per_record"]) * 2
+        data = np.memmap(edf_path, dtype=np.uint8, mode="r", offset=header["data_offset"],
+                         shape=(n_records, header["record_bytes"]))
+        for start in range(0, n_records, block_records):
+            for i in header["annotation_signals"]:
+                block = np.ascontiguousarray(data[start:start + block_records, byte_offsets[i]:byte_offsets[i + 1]])
+                for row in block:
+                    events.extend(parse_tal(row.tobytes())[1])
+        del data
+    df = pd.DataFrame(events, columns=["onset", "duration", "trial_type"])
+    return df.sort_values("onset", kind="stable").reset_index(drop=True)
+
+
+def write_events(edf_path, events_tsv):
+    """Ghi <run>_events.tsv + events.json cạnh file EDF. Trả về số event (0 -> không ghi file nào)."""
+    events = read_annotations(edf_path)
+    if events.empty:
+        return 0
+    events["duration"] = events["duration"].astype(object).where(events["duration"].notna(), "n/a")
+    events.to_csv(events_tsv, sep="\t", index=False)
+    with open(events_tsv[:-len(".tsv")] + ".json", "w") as f:
+        json.dump(EVENTS_JSON, f, indent=4)
+    return len(events)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Tạo *_events.tsv từ annotation EDF+ cho các run đã có trong BIDS")
+    parser.add_argument(
+        "--bids_dir",
+        type=str,
+        required=True,
+        help="BIDS database directory"
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Ghi lại cả các run đã có events.tsv"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    args = get_args()
+    edf_files = sorted(glob.glob(os.path.join(args.bids_dir, "sub-*", "**", "*_eeg.edf"), recursive=True))
+    n_runs = 0
+    for edf_file in tqdm(edf_files, desc="Extracting annotations"):
+        events_tsv = edf_file[:-len("_eeg.edf")] + "_events.tsv"
+        if os.path.exists(events_tsv) and not args.overwrite:
+            continue
+        try:
+            if write_events(edf_file, events_tsv):
+                n_runs += 1
+        except (OSError, ValueError) as e:
+            logging.warning(f"Cannot read annotations from {edf_file}: {e}")
+    print(f"events.tsv written for {n_runs} runs")
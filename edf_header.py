@@ -0,0 +1,118 @@
+import os
+
+# Độ rộng (byte) các trường header chính của EDF/EDF+ (256 byte đầu file)
+MAIN_FIELDS = [
+    ("version", 8),
+    ("patient", 80),
+    ("recording", 80),
+    ("startdate", 8),
+    ("starttime", 8),
+    ("header_bytes", 8),
+    ("reserved", 44),
+    ("n_records", 8),
+    ("record_duration", 8),
+    ("n_signals", 4),
+]
+
+# Header từng signal: mỗi trường lặp n_signals lần liên tiếp
+SIGNAL_FIELDS = [
+    ("labels", 16),
+    ("transducers", 80),
+    ("units", 8),
+    ("phys_min", 8),
+    ("phys_max", 8),
+    ("dig_min", 8),
+    ("dig_max", 8),
+    ("prefilters", 80),
+    ("samples_per_record", 8),
+    ("signal_reserved", 32),
+]
+
+MAIN_HEADER_BYTES = 256
+SIGNAL_HEADER_BYTES = 256  # tổng độ rộng SIGNAL_FIELDS cho một signal
+ANNOTATION_LABEL = "EDF Annotations"
+
+
+def _ascii(raw):
+    return raw.decode("ascii", errors="replace").strip()
+
+
+def split_main_header(buf):
+    """Tách 256 byte header chính thành dict các chuỗi (chưa ép kiểu)."""
+    fields, pos = {}, 0
+    for name, width in MAIN_FIELDS:
+        fields[name] = _ascii(buf[pos:pos + width])
+        pos += width
+    return fields
+
+
+def split_signal_headers(buf, n_signals):
+    """Tách phần header signal thành dict tên trường -> list chuỗi (chưa ép kiểu)."""
+    fields, pos = {}, 0
+    for name, width in SIGNAL_FIELDS:
+        fields[name] = [_ascii(buf[pos + i * width:pos + (i + 1) * width]) for i in range(n_signals)]
+        pos += width * n_signals
+    return fields
+
+
+def read_edf_header(edf_path):
+    """
+    Đọc header EDF/EDF+ bằng Python thuần (không decode dữ liệu), chỉ tốn 2 lần đọc nhỏ.
+    Trả về dict gồm các trường gốc + giá trị tính sẵn:
+    samples_per_record (list int), record_samples, record_bytes, data_offset, file_size,
+    is_edfplus, annotation_signals (index các kênh 'EDF Annotations').
+    Raise ValueError nếu header không parse được.
+    """
+    file_size = os.path.getsize(edf_path)
+    with open(edf_path, "rb") as f:
+        buf = f.read(MAIN_HEADER_BYTES)
+        if len(buf) < MAIN_HEADER_BYTES:
+            raise ValueError(f"File too short for an EDF header ({file_size} bytes)")
+        header = split_main_header(buf)
+        try:
+            n_signals = int(header["n_signals"])
+            header_bytes = int(header["header_bytes"])
+            n_records = int(header["n_records"])
+            record_duration = float(header["record_duration"])
+        except ValueError as e:
+            raise ValueError(f"Invalid numeric field in EDF header: {e}")
+        if n_signals <= 0:
+            raise ValueError(f"Invalid number of signals: {n_signals}")
+        sig_buf = f.read(SIGNAL_HEADER_BYTES * n_signals)
+        if len(sig_buf) < SIGNAL_HEADER_BYTES * n_signals:
+            raise ValueError("File too short for its signal headers")
+
+    header.update(split_signal_headers(sig_buf, n_signals))
+    try:
+        for name in ("phys_min", "phys_max", "dig_min", "dig_max"):
+            header[name] = [float(v) for v in header[name]]
+        header["samples_per_record"] = [int(v) for v in header["samples_per_record"]]
+    except ValueError as e:
+        raise ValueError(f"Invalid numeric field in signal header: {e}")
+
+    header["n_signals"] = n_signals
+    header["header_bytes"] = header_bytes
+    header["n_records"] = n_records
+    header["record_duration"] = record_duration
+    header["record_samples"] = sum(header["samples_per_record"])
+    header["record_bytes"] = header["record_samples"] * 2  # int16
+    header["data_offset"] = header_bytes
+    header["file_size"] = file_size
+    header["is_edfplus"] = header["reserved"].startswith("EDF+")
+    header["annotation_signals"] = [i for i, label in enumerate(header["labels"]) if label == ANNOTATION_LABEL]
+    return header
+
+
+def data_records_in_file(header):
+    """Số data record thực sự có trong file (theo kích thước), dùng khi n_records = -1 hoặc sai."""
+    if header["record_bytes"] <= 0:
+        return 0
+    return max(0, (header["file_size"] - header["data_offset"]) // header["record_bytes"])
+
+
+def decode_footprint_bytes(header):
+    """RAM cần để decode toàn bộ tín hiệu (trừ kênh annotation) ra float64: channels x samples x 8 byte."""
+    n_records = header["n_records"] if header["n_records"] >= 0 else data_records_in_file(header)
+    signal_samples = sum(spr for i, spr in enumerate(header["samples_per_record"])
+                         if i not in header["annotation_signals"])
+    return signal_samples * n_records * 8
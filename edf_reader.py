@@ -0,0 +1,112 @@
+import numpy as np
+from edf_header import read_edf_header, data_records_in_file
+
+
+class EdfMemmap:
+    """
+    Reader EDF/EDF+ dựa trên np.memmap phần data record, không qua MNE / pyedflib.
+    - records: view (n_records, record_samples) int16 của toàn bộ data, không copy
+    - channel_records(ch): view zero-copy (n_records, samples_per_record) của một kênh
+    - digital(...) / physical(...): mảng (channels x samples) cho một đoạn thời gian; chỉ các record
+      chứa đoạn đó được đọc từ đĩa, nên đọc cửa sổ ngắn trong file nhiều giờ chỉ tốn vài KB.
+    Kênh 'EDF Annotations' bị bỏ khỏi danh sách kênh tín hiệu.
+    """
+
+    def __init__(self, edf_path):
+        self.path = edf_path
+        self.header = read_edf_header(edf_path)
+        n_records = data_records_in_file(self.header)
+        if self.header["n_records"] >= 0:
+            n_records = min(n_records, self.header["n_records"])
+        self.n_records = n_records
+        self.record_duration = self.header["record_duration"] or 1.0
+        self.channels = [i for i in range(self.header["n_signals"]) if i not in self.header["annotation_signals"]]
+        self.labels = [self.header["labels"][i] for i in self.channels]
+        self.units = [self.header["units"][i] for i in self.channels]
+        self._offsets = np.cumsum([0] + self.header["samples_per_record"])
+        self.samples_per_record = np.array([self.header["samples_per_record"][i] for i in self.channels])
+        self.sfreqs = self.samples_per_record / self.record_duration
+
+        dig_min = np.array([self.header["dig_min"][i] for i in self.channels])
+        dig_max = np.array([self.header["dig_max"][i] for i in self.channels])
+        phys_min = np.array([self.header["phys_min"][i] for i in self.channels])
+        phys_max = np.array([self.header["phys_max"][i] for i in self.channels])
+        span = np.where(dig_max != dig_min, dig_max - dig_min, 1)
+        self.gain = (phys_max - phys_min) / span
+        self.offset = phys_min - self.gain * dig_min
+
+        self.records = np.memmap(edf_path, dtype="<i2", mode="r", offset=self.header["data_offset"],
+                                 shape=(n_records, self.header["record_samples"])) if n_records else \
+            np.zeros((0, self.header["record_samples"]), dtype="<i2")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.records = None
+
+    @property
+    def n_channels(self):
+        return len(self.channels)
+
+    @property
+    def duration(self):
+        return self.n_records * self.record_duration
+
+    def channel_index(self, channels=None):
+        """Vị trí (trong self.channels) của các kênh chọn theo label hoặc vị trí; None = tất cả."""
+        if channels is None:
+            return list(range(self.n_channels))
+        if isinstance(channels, (str, int, np.integer)):
+            channels = [channels]
+        return [self.labels.index(c) if isinstance(c, str) else int(c) for c in channels]
+
+    def channel_records(self, ch):
+        """View zero-copy (n_records, samples_per_record) int16 của một kênh."""
+        i = self.channels[self.channel_index(ch)[0]]
+        return self.records[:, self._offsets[i]:self._offsets[i + 1]]
+
+    def _sample_range(self, spr, start, stop):
+        n_samples = self.n_records * spr
+        start = min(max(0, start), n_samples)
+        stop = n_samples if stop is None else min(max(start, stop), n_samples)
+        return start, stop
+
+    def digital(self, channels=None, start=0, stop=None):
+        """
+        Mẫu digital int16 (channels x samples) trong [start, stop) (đơn vị mẫu). Các kênh được chọn phải
+        cùng tần số lấy mẫu. Seek O(1): chỉ các record [start // spr, ceil(stop / spr)) được chạm tới.
+        """
+        idx = self.channel_index(channels)
+        sprs = set(int(self.samples_per_record[k]) for k in idx)
+        if len(sprs) > 1:
+            raise ValueError(f"Selected channels have different samples per record: {sorted(sprs)}")
+        spr = sprs.pop() if sprs else 1
+        start, stop = self._sample_range(spr, start, stop)
+        rec0, rec1 = start // spr, -(-stop // spr)
+        block = self.records[rec0:rec1]
+        cols = np.concatenate([np.arange(self._offsets[self.channels[k]], self._offsets[self.channels[k] + 1])
+                               for k in idx]) if idx else np.array([], dtype=np.int64)
+        # (records, channels * spr) -> (channels, records * spr)
+        data = block[:, cols].reshape(len(block), len(idx), spr).transpose(1, 0, 2).reshape(len(idx), -1)
+        return data[:, start - rec0 * spr:stop - rec0 * spr]
+
+    def physical(self, channels=None, start=0, stop=None, dtype=np.float64):
+        """Như digital() nhưng đã đổi sang đơn vị vật lý (physical = digital * gain + offset, vector hóa)."""
+        idx = self.channel_index(channels)
+        data = self.digital(idx, start, stop).astype(dtype)
+        data *= self.gain[idx, None].astype(dtype)
+        data += self.offset[idx, None].astype(dtype)
+        return data
+
+    def window(self, t_start, duration, channels=None, physical=True):
+        """Đoạn [t_start, t_start + duration) giây; trả về (data, sfreq)."""
+        idx = self.channel_index(channels)
+        sfreq = float(self.sfreqs[idx[0]]) if idx else 0.0
+        start = int(round(t_start * sfreq))
+        stop = start + int(round(duration * sfreq))
+        read = self.physical if physical else self.digital
+        return read(idx, start, stop), sfreq
@@ -0,0 +1,157 @@
+import os
+import glob
+import argparse
+from datetime import datetime
+import pandas as pd
+from edf_header import (split_main_header, split_signal_headers, MAIN_HEADER_BYTES,
+                        SIGNAL_HEADER_BYTES, ANNOTATION_LABEL)
+
+# Kết quả triage: status (lớp lỗi) + route (đường xử lý tiếp theo)
+STATUS_OK = "ok"
+HOPELESS = {"empty", "truncated_header", "bad_magic", "bad_numeric", "no_records"}
+
+ROUTE_DEFAULT = "default"            # header hợp lệ: đi đường bình thường (governor / MNE)
+ROUTE_REJECT = "reject"              # không có dữ liệu dùng được: bỏ qua reader, chỉ vá header nếu có
+ROUTE_STREAMING = "streaming"        # số sample/record khác nhau giữa các kênh
+ROUTE_HEADER_ONLY = "header_only"    # reader sẽ fail (ngày sai, calibration sai) nhưng header vá được
+ROUTE_REPAIR_RECORDS = "repair_records"  # sửa trường n_records / cắt record dở dang, sau đó chỉ cần vá header
+
+
+def _result(status, route, detail, **extra):
+    return {"status": status, "route": route, "hopeless": status in HOPELESS, "detail": detail, **extra}
+
+
+def _valid_date(startdate, starttime):
+    try:
+        datetime.strptime(startdate, "%d.%m.%y")
+        datetime.strptime(starttime, "%H.%M.%S")
+        return True
+    except ValueError:
+        return False
+
+
+def triage_edf(edf_path):
+    """
+    Kiểm tra nhanh header EDF (chỉ đọc header, không decode), phân lớp lỗi để chọn đường xử lý:
+    empty / truncated_header / bad_magic / bad_numeric / no_records  -> hopeless, bỏ qua reader;
+    unknown_records / truncated / trailing_bytes -> repair_records;
+    bad_date / bad_calibration -> header_only; non_uniform_records -> streaming; ok -> default.
+    """
+    try:
+        file_size = os.path.getsize(edf_path)
+        with open(edf_path, "rb") as f:
+            buf = f.read(MAIN_HEADER_BYTES)
+            if file_size == 0:
+                return _result("empty", ROUTE_REJECT, "File is empty", file_size=0)
+            if len(buf) < MAIN_HEADER_BYTES:
+                return _result("truncated_header", ROUTE_REJECT,
+                               f"{file_size} bytes, shorter than the 256-byte main header", file_size=file_size)
+            main = split_main_header(buf)
+            if main["version"] != "0":
+                return _result("bad_magic", ROUTE_REJECT, f"Version field is {main['version']!r}, expected '0'",
+                               file_size=file_size)
+            try:
+                n_signals = int(main["n_signals"])
+                header_bytes = int(main["header_bytes"])
+                n_records = int(main["n_records"])
+                float(main["record_duration"])
+            except ValueError:
+                return _result("bad_numeric", ROUTE_REJECT, "Non-numeric header_bytes / n_records / duration / n_signals",
+                               file_size=file_size)
+            if n_signals <= 0 or header_bytes != MAIN_HEADER_BYTES + SIGNAL_HEADER_BYTES * n_signals:
+                return _result("bad_numeric", ROUTE_REJECT,
+                               f"header_bytes={header_bytes} inconsistent with n_signals={n_signals}",
+                               file_size=file_size)
+            if file_size < header_bytes:
+                return _result("truncated_header", ROUTE_REJECT,
+                               f"{file_size} bytes, shorter than its {header_bytes}-byte header", file_size=file_size)
+            sig = split_signal_headers(f.read(SIGNAL_HEADER_BYTES * n_signals), n_signals)
+    except OSError as e:
+        return _result("empty", ROUTE_REJECT, f"Cannot read file: {e}", file_size=None)
+
+    try:
+        spr = [int(v) for v in sig["samples_per_record"]]
+        dig_min = [int(float(v)) for v in sig["dig_min"]]
+        dig_max = [int(float(v)) for v in sig["dig_max"]]
+        phys_min = [float(v) for v in sig["phys_min"]]
+        phys_max = [float(v) for v in sig["phys_max"]]
+    except ValueError:
+        return _result("bad_numeric", ROUTE_REJECT, "Non-numeric field in signal headers", file_size=file_size)
+    if any(n <= 0 for n in spr):
+        return _result("bad_numeric", ROUTE_REJECT, "samples_per_record <= 0", file_size=file_size)
+
+    record_bytes = sum(spr) * 2
+    data_bytes = file_size - header_bytes
+    full_records, partial = divmod(data_bytes, record_bytes)
+    extra = {"file_size": file_size, "n_records": n_records, "records_in_file": full_records,
+             "record_bytes": record_bytes, "header_bytes": header_bytes}
+
+    if full_records == 0:
+        return _result("no_records", ROUTE_REJECT, f"Data section holds {data_bytes} bytes, no complete record", **extra)
+    if n_records == -1:
+        return _result("unknown_records", ROUTE_REPAIR_RECORDS, f"n_records=-1, {full_records} records on disk", **extra)
+    if full_records < n_records:
+        return _result("truncated", ROUTE_REPAIR_RECORDS,
+                       f"Header says {n_records} records, only {full_records} complete on disk", **extra)
+    if full_records > n_records or partial:
+        return _result("trailing_bytes", ROUTE_REPAIR_RECORDS,
+                       f"{data_bytes - n_records * record_bytes} bytes after the last declared record", **extra)
+    if not _valid_date(main["startdate"], main["starttime"]):
+        return _result("bad_date", ROUTE_HEADER_ONLY,
+                       f"Invalid start date/time {main['startdate']!r} {main['starttime']!r}", **extra)
+    if any(lo >= hi for lo, hi in zip(dig_min, dig_max)) or any(lo == hi for lo, hi in zip(phys_min, phys_max)):
+        return _result("bad_calibration", ROUTE_HEADER_ONLY, "Digital or physical range is empty for a channel", **extra)
+    signal_spr = {n for n, label in zip(spr, sig["labels"]) if label != ANNOTATION_LABEL}
+    if len(signal_spr) > 1:
+        return _result("non_uniform_records", ROUTE_STREAMING,
+                       f"Channels have different samples per record: {sorted(signal_spr)}", **extra)
+    return _result(STATUS_OK, ROUTE_DEFAULT, "", **extra)
+
+
+def repair_record_count(edf_path, out_path, triage):
+    """
+    Ghi bản sửa: header + các record đầy đủ trên đĩa, trường n_records đặt lại theo số record thực tế.
+    Dùng cho unknown_records / truncated / trailing_bytes.
+    """
+    n_records = triage["records_in_file"]
+    keep = triage["header_bytes"] + n_records * triage["record_bytes"]
+    with open(edf_path, "rb") as src, open(out_path, "wb") as dst:
+        remaining = keep
+        while remaining > 0:
+            chunk = src.read(min(remaining, 16 * 1024 * 1024))
+            if not chunk:
+                break
+            dst.write(chunk)
+            remaining -= len(chunk)
+        dst.seek(236)
+        dst.write(str(n_records).encode("ascii").ljust(8))
+    return out_path
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--edf_dir",
+        type=str,
+        required=True,
+        help="Folder chứa file .edf/.EDF (quét đệ quy)"
+    )
+    parser.add_argument(
+        "--out_tsv",
+        type=str,
+        default="./edf_triage.tsv",
+        help="File TSV kết quả triage"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    edf_files = glob.glob(os.path.join(args.edf_dir, "**", "*.edf"), recursive=True)
+    edf_files.extend(glob.glob(os.path.join(args.edf_dir, "**", "*.EDF"), recursive=True))
+    rows = [{"file": f, **triage_edf(f)} for f in sorted(edf_files)]
+    df = pd.DataFrame(rows)
+    df.to_csv(args.out_tsv, sep="\t", index=False)
+    if not df.empty:
+        print(df["status"].value_counts().to_string())
+    print(f"Triage saved to: {args.out_tsv}")
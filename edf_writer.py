@@ -0,0 +1,100 @@
+import os
+import numpy as np
+from edf_header import MAIN_FIELDS
+from edf_reader import EdfMemmap
+
+# Vị trí byte của từng trường header chính (để vá tại chỗ, vd. n_records sau khi ghi xong)
+MAIN_FIELD_POS = {}
+_pos = 0
+for _name, _width in MAIN_FIELDS:
+    MAIN_FIELD_POS[_name] = (_pos, _width)
+    _pos += _width
+
+WRITE_BLOCK_BYTES = 32 * 1024 * 1024  # ghi theo khối ~32 MB data record
+
+
+def _format_number(value, width):
+    """Số -> chuỗi ASCII vừa width ký tự (EDF cho phép tối đa 8 ký tự cho các trường số)."""
+    value = float(value)
+    if value.is_integer() and len(str(int(value))) <= width:
+        return str(int(value))
+    for decimals in range(width, -1, -1):
+        text = f"{value:.{decimals}f}".rstrip("0").rstrip(".")
+        if len(text) <= width:
+            return text
+    raise ValueError(f"{value} does not fit in a {width}-character EDF field")
+
+
+def format_field(value, width):
+    text = value if isinstance(value, str) else _format_number(value, width)
+    return text.encode("ascii", errors="replace")[:width].ljust(width)
+
+
+def patch_main_fields(header_bytes, **fields):
+    """Thay một số trường header chính trong header gốc (bytes), các byte khác giữ nguyên."""
+    buf = bytearray(header_bytes)
+    for name, value in fields.items():
+        pos, width = MAIN_FIELD_POS[name]
+        buf[pos:pos + width] = format_field(value, width)
+    return bytes(buf)
+
+
+class EdfRecordWriter:
+    """
+    Ghi data record EDF đã xếp sẵn (n, record_samples) int16 theo khối lớn, mỗi khối một lần write.
+    n_records trong header được vá lại khi close().
+    """
+
+    def __init__(self, path, header_bytes, samples_per_record):
+        self.path = path
+        self.record_samples = int(sum(samples_per_record))
+        self.n_records = 0
+        self._f = open(path, "wb")
+        self._f.write(patch_main_fields(header_bytes, n_records=-1))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close()
+
+    def write_records(self, records):
+        """Ghi thẳng các data record đã xếp sẵn (n, record_samples) int16 (vd. lấy từ EdfMemmap.records)."""
+        records = np.ascontiguousarray(records, dtype="<i2")
+        if records.ndim != 2 or records.shape[1] != self.record_samples:
+            raise ValueError(f"Expected records of {self.record_samples} samples, got shape {records.shape}")
+        self._f.write(memoryview(records).cast("B"))
+        self.n_records += len(records)
+
+    def close(self):
+        if self._f is None:
+            return
+        pos, _ = MAIN_FIELD_POS["n_records"]
+        self._f.seek(pos)
+        self._f.write(format_field(self.n_records, 8))
+        self._f.close()
+        self._f = None
+
+
+def copy_edf_records(src_path, out_path, block_bytes=WRITE_BLOCK_BYTES, **main_fields):
+    """
+    Ghi lại một file EDF với header chính đã sửa (main_fields, vd. patient / recording) và digital
+    samples pass-through nguyên vẹn: record được đọc qua memmap và ghi theo khối block_bytes,
+    không decode ra float. Kết quả bit-exact với file gốc ngoài các trường đã sửa. Trả về số record đã ghi.
+    """
+    with EdfMemmap(src_path) as reader:
+        with open(src_path, "rb") as f:
+            header_bytes = f.read(reader.header["data_offset"])
+        header_bytes = patch_main_fields(header_bytes, **main_fields)
+        block_records = max(1, block_bytes // max(1, reader.header["record_bytes"]))
+        with EdfRecordWriter(out_path, header_bytes, reader.header["samples_per_record"]) as writer:
+            for start in range(0, reader.n_records, block_records):
+                writer.write_records(reader.records[start:start + block_records])
+        return writer.n_records
+
+
+def edf_file_ok(edf_path, n_records):
+    """File vừa ghi có đúng n_records record đầy đủ (header + kích thước)."""
+    with EdfMemmap(edf_path) as reader:
+        expected = reader.header["data_offset"] + n_records * reader.header["record_bytes"]
+        return reader.header["n_records"] == n_records and os.path.getsize(edf_path) == expected
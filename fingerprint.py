@@ -0,0 +1,219 @@
+import os
+import glob
+import hashlib
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+from edf_reader import EdfMemmap
+from catalog import Catalog, default_catalog_path
+
+NUM_PERM = 64
+BANDS = 16                  # LSH: 16 band x 4 hàng -> cặp có Jaccard ~0.5 là ứng viên với xác suất ~0.65
+PRIME = (1 << 32) + 15      # số nguyên tố > 2^32 cho hàm hash a*x + b mod p
+SHINGLE_WINDOWS = 3         # số cửa sổ liên tiếp trong một shingle
+LOG_STEP = 0.5              # bước lượng tử hóa log2(std)
+
+_rng = np.random.RandomState(1234)
+_PERM_A = _rng.randint(1, 1 << 31, size=NUM_PERM).astype(np.uint64)
+_PERM_B = _rng.randint(0, 1 << 31, size=NUM_PERM).astype(np.uint64)
+
+
+def _label_hash(label):
+    return int.from_bytes(hashlib.blake2b(label.upper().encode(), digest_size=4).digest(), "little")
+
+
+def window_stats(edf_path, window_seconds=1.0, block_records=600):
+    """
+    Độ lệch chuẩn (đơn vị vật lý) của từng kênh trên cửa sổ window_seconds giây bắt đầu tại MỌI data record
+    (bước trượt = 1 record), tính từ tổng / tổng bình phương theo record nên bản bị cắt lệch vài record
+    vẫn có cùng các cửa sổ. Đọc phần data bằng memmap theo khối, không decode toàn bộ file ra float.
+    Trả về (labels, stats[n_channels, n_starts], recs_per_window, sfreq, duration).
+    """
+    with EdfMemmap(edf_path) as reader:
+        n_records = reader.n_records
+        recs_per_window = max(1, int(round(window_seconds / reader.record_duration)))
+        labels = reader.labels
+        sfreq = float(reader.sfreqs[0]) if reader.n_channels else None
+        duration = reader.duration
+
+        sums = np.zeros((reader.n_channels, n_records))
+        sumsq = np.zeros((reader.n_channels, n_records))
+        for start in range(0, n_records, block_records):
+            for row in range(reader.n_channels):
+                x = np.asarray(reader.channel_records(row)[start:start + block_records], dtype=np.float64)
+                sums[row, start:start + len(x)] = x.sum(axis=1)
+                sumsq[row, start:start + len(x)] = (x * x).sum(axis=1)
+        n = (reader.samples_per_record * recs_per_window).astype(np.float64)[:, None]
+        gains = np.abs(reader.gain)
+
+    n_starts = n_records - recs_per_window + 1
+    if n_starts <= 0:
+        return labels, np.zeros((len(labels), 0)), recs_per_window, sfreq, duration
+    cs = np.concatenate([np.zeros((len(labels), 1)), np.cumsum(sums, axis=1)], axis=1)
+    css = np.concatenate([np.zeros((len(labels), 1)), np.cumsum(sumsq, axis=1)], axis=1)
+    win_sum = cs[:, recs_per_window:] - cs[:, :n_starts]
+    win_sumsq = css[:, recs_per_window:] - css[:, :n_starts]
+    var = np.maximum(win_sumsq / n - (win_sum / n) ** 2, 0)
+    return labels, np.sqrt(var) * gains[:, None], recs_per_window, sfreq, duration
+
+
+def shingles(labels, stats, recs_per_window):
+    """
+    Shingle = (kênh, log2(std) lượng tử hóa của SHINGLE_WINDOWS cửa sổ liên tiếp không chồng nhau), hash về uint32.
+    Lấy shingle tại mọi record bắt đầu nên không phụ thuộc vị trí cắt; lượng tử hóa thô để bản
+    export lại / resample vẫn cho phần lớn shingle giống nhau.
+    Cửa sổ phẳng (std = 0, kênh không gắn điện cực) bị bỏ để không khớp nhầm giữa các bản ghi khác nhau.
+    """
+    out = []
+    span = (SHINGLE_WINDOWS - 1) * recs_per_window
+    n_shingles = stats.shape[1] - span
+    if n_shingles <= 0:
+        return np.array([], dtype=np.uint64)
+    for label, std in zip(labels, stats):
+        q = np.floor(np.log2(np.maximum(std, 1e-3)) / LOG_STEP).astype(np.int64)
+        flat = std <= 0
+        h = np.full(n_shingles, _label_hash(label), dtype=np.uint64)
+        keep = np.ones(n_shingles, dtype=bool)
+        for j in range(SHINGLE_WINDOWS):
+            lo = j * recs_per_window
+            h = h * np.uint64(1000003) ^ (q[lo:lo + n_shingles].astype(np.uint64) & np.uint64(0xFFFFFFFF))
+            keep &= ~flat[lo:lo + n_shingles]
+        h = h[keep]
+        h ^= h >> np.uint64(29)
+        h *= np.uint64(0xBF58476D1CE4E5B9)
+        h ^= h >> np.uint64(32)
+        out.append(h & np.uint64(0xFFFFFFFF))
+    return np.unique(np.concatenate(out)) if out else np.array([], dtype=np.uint64)
+
+
+def minhash(shingle_ids, chunk=65536):
+    """Chữ ký MinHash NUM_PERM giá trị (uint64); rỗng -> None."""
+    if len(shingle_ids) == 0:
+        return None
+    sig = np.full(NUM_PERM, PRIME, dtype=np.uint64)
+    for start in range(0, len(shingle_ids), chunk):
+        x = shingle_ids[start:start + chunk]
+        values = (_PERM_A[:, None] * x[None, :] + _PERM_B[:, None]) % np.uint64(PRIME)
+        sig = np.minimum(sig, values.min(axis=1))
+    return sig
+
+
+def lsh_buckets(sig):
+    rows = NUM_PERM // BANDS
+    return [hashlib.blake2b(sig[b * rows:(b + 1) * rows].tobytes(), digest_size=8).hexdigest() for b in range(BANDS)]
+
+
+def similarity(sig_a, sig_b):
+    """Ước tính Jaccard giữa hai tập shingle = tỉ lệ vị trí MinHash trùng nhau."""
+    return float(np.mean(sig_a == sig_b))
+
+
+def fingerprint_edf(edf_path, window_seconds=1.0):
+    labels, stats, recs_per_window, sfreq, duration = window_stats(edf_path, window_seconds)
+    sig = minhash(shingles(labels, stats, recs_per_window))
+    return {"n_channels": len(labels), "sfreq": sfreq, "duration": duration,
+            "n_windows": (stats.shape[1] + recs_per_window - 1) // recs_per_window, "signature": sig}
+
+
+def _fingerprint_item(item):
+    path, window_seconds = item
+    try:
+        return path, fingerprint_edf(path, window_seconds), None
+    except (OSError, ValueError) as e:
+        return path, None, str(e)
+
+
+def find_near_duplicates(bids_dir, catalog, threshold=0.5, window_seconds=1.0, workers=1, refresh=False):
+    """
+    Fingerprint các file EDF trong bids_dir chưa có trong catalog, đưa vào LSH index,
+    rồi so chữ ký với các ứng viên cùng bucket (không so từng cặp trên toàn corpus).
+    Trả về số recording mới được gắn cờ near-duplicate.
+    """
+    edf_files = sorted(glob.glob(os.path.join(bids_dir, "sub-*", "**", "*_eeg.edf"), recursive=True))
+    known = set() if refresh else catalog.known_recordings()
+    todo = [f for f in edf_files if os.path.relpath(f, bids_dir) not in known]
+
+    items = [(f, window_seconds) for f in todo]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(tqdm(pool.map(_fingerprint_item, items, chunksize=4), total=len(items), desc="Fingerprinting"))
+    else:
+        results = [_fingerprint_item(it) for it in tqdm(items, desc="Fingerprinting")]
+
+    n_flagged = 0
+    for path, fp, error in results:
+        rel = os.path.relpath(path, bids_dir)
+        if fp is None or fp["signature"] is None:
+            logging.warning(f"No fingerprint for {rel}: {error or 'no usable signal windows'}")
+            continue
+        sig = fp["signature"]
+        buckets = lsh_buckets(sig)
+        candidates = catalog.bucket_members(buckets) - {rel}
+        matches = []
+        for other, other_sig in catalog.signatures(candidates).items():
+            sim = similarity(sig, np.frombuffer(other_sig, dtype=np.uint64))
+            if sim >= threshold:
+                matches.append((other, sim))
+        catalog.upsert_recording(rel, n_channels=fp["n_channels"], sfreq=fp["sfreq"], duration=fp["duration"],
+                                 n_windows=fp["n_windows"], signature=sig.tobytes())
+        catalog.add_buckets(rel, buckets)
+        catalog.flag_near_duplicates(rel, matches)
+        if matches:
+            n_flagged += 1
+            logging.info(f"{rel}: near-duplicate of {max(matches, key=lambda m: m[1])[0]}")
+    return n_flagged
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--bids_dir",
+        type=str,
+        required=True,
+        help="BIDS database directory"
+    )
+    parser.add_argument(
+        "--catalog",
+        type=str,
+        default=None,
+        help="SQLite catalog (mặc định: <bids_dir>/derivatives/catalog.sqlite)"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.5,
+        help="Ngưỡng Jaccard ước tính để gắn cờ near-duplicate"
+    )
+    parser.add_argument(
+        "--window_seconds",
+        type=float,
+        default=1.0,
+        help="Độ dài cửa sổ tính std (giây)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Số process fingerprint song song"
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Tính lại fingerprint cho cả các recording đã có trong catalog"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    args = get_args()
+    catalog = Catalog(args.catalog or default_catalog_path(args.bids_dir))
+    n_flagged = find_near_duplicates(args.bids_dir, catalog, args.threshold, args.window_seconds,
+                                     args.workers, args.refresh)
+    pairs = catalog.near_duplicate_pairs()
+    out_tsv = os.path.join(args.bids_dir, "derivatives", "near_duplicates.tsv")
+    pd.DataFrame(pairs, columns=["bids_path", "near_duplicate_of", "similarity"]).to_csv(out_tsv, sep="\t", index=False)
+    print(f"{n_flagged} new recordings flagged as near-duplicates. Pairs saved to: {out_tsv}")
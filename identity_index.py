@@ -0,0 +1,210 @@
+import os
+import re
+import hmac
+import time
+import sqlite3
+import hashlib
+import argparse
+import unidecode
+from contextlib import contextmanager
+from edf_header import split_main_header, MAIN_HEADER_BYTES
+
+KEY_ENV = "BIDS_PSEUDONYM_KEY"  # secret HMAC key, không bao giờ ghi vào DB
+
+
+def load_secret(env=KEY_ENV):
+    secret = os.environ.get(env)
+    if not secret:
+        raise RuntimeError(f"Identity index needs a secret key: set the {env} environment variable")
+    return secret.encode("utf-8")
+
+
+def normalize_name(name):
+    """Bỏ dấu, viết hoa, '_' -> khoảng trắng, gộp khoảng trắng (giống PATIENT_NAME_STD khi matching)."""
+    if not name:
+        return ""
+    clean = unidecode.unidecode(str(name)).upper().replace("_", " ")
+    return " ".join(clean.split())
+
+
+def parse_patient_field(patient):
+    """
+    Tách tên + năm sinh từ trường patient của header EDF.
+    EDF+: "code sex birthdate name" (name kiểu NGUYEN_THI_LOAN_1965, birthdate dd-MMM-yyyy hoặc X);
+    EDF thường: cả trường là tên. Trả về (name, birth_year) đã chuẩn hóa, '' / None nếu không có.
+    """
+    parts = patient.split()
+    birth_year = None
+    if len(parts) >= 4:
+        birthdate, raw_name = parts[2], "_".join(parts[3:])
+        m = re.match(r"^\d{2}-[A-Za-z]{3}-(\d{4})$", birthdate)
+        if m:
+            birth_year = m.group(1)
+    else:
+        raw_name = "_".join(parts)
+    m = re.search(r"^(.*?)[_]?(\d+)?$", raw_name)
+    name = m.group(1) if m else raw_name
+    if m and m.group(2) and len(m.group(2)) == 4 and birth_year is None:
+        birth_year = m.group(2)
+    if name.upper() == "X":
+        name = ""
+    return normalize_name(name), birth_year
+
+
+def _is_edfplus_patient(parts):
+    """parts có dạng EDF+ "code sex birthdate name" (sex M / F / X, birthdate dd-MMM-yyyy hoặc X)."""
+    return len(parts) >= 4 and parts[1].upper() in ("M", "F", "X") and \
+        (parts[2].upper() == "X" or re.match(r"^\d{2}-[A-Za-z]{3}-\d{4}$", parts[2]) is not None)
+
+
+def parse_patient_name(text):
+    """
+    Như parse_patient_field nhưng cho tên đã decode (pyedflib getPatientName, mapping CSV của anonymize.py),
+    vd. "LE THI MINH 1980": không phải trường EDF+ thì mọi token là tên, các token số ở cuối là năm sinh / mã.
+    Trường EDF+ thô (đường header-only ghi nguyên trường patient) vẫn được tách như parse_patient_field.
+    """
+    parts = str(text or "").replace("_", " ").split()
+    if _is_edfplus_patient(str(text or "").split()):
+        return parse_patient_field(text)
+    birth_year = None
+    while parts and parts[-1].isdigit():
+        token = parts.pop()
+        if len(token) == 4 and birth_year is None:
+            birth_year = token
+    name = " ".join(parts)
+    if name.upper() == "X":
+        name = ""
+    return normalize_name(name), birth_year
+
+
+def identity_from_edf(edf_path):
+    """(name, birth_year) từ 256 byte header chính, không cần MNE; ('', None) nếu không đọc được."""
+    try:
+        with open(edf_path, "rb") as f:
+            buf = f.read(MAIN_HEADER_BYTES)
+    except OSError:
+        return "", None
+    if len(buf) < MAIN_HEADER_BYTES:
+        return "", None
+    return parse_patient_field(split_main_header(buf)["patient"])
+
+
+class IdentityIndex:
+    """
+    Index danh tính bệnh nhân -> sub-id, bền vững giữa các lần chạy / dataset.
+    Khóa = HMAC-SHA256(secret, tên chuẩn hóa | năm sinh [| DOC_NO]); DB chỉ chứa HMAC, không chứa tên.
+    - kind 'base': tên + năm sinh; kind 'doc': tên + năm sinh + DOC_NO (khi match được với xlsx).
+    """
+
+    def __init__(self, db_path, secret=None):
+        self.db_path = db_path
+        self.secret = secret if secret is not None else load_secret()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS identities (
+                    key TEXT PRIMARY KEY,
+                    sub_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    created REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_identities_sub ON identities(sub_id)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def key(self, name, birth_year=None, doc_no=None):
+        parts = [normalize_name(name), str(birth_year or "")]
+        if doc_no is not None:
+            parts.append(str(doc_no).strip())
+        return hmac.new(self.secret, "|".join(parts).encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def lookup(self, name, birth_year=None, doc_no=None):
+        """sub-id của bệnh nhân (ưu tiên khóa có DOC_NO), None nếu chưa có."""
+        with self._connect() as conn:
+            if doc_no is not None:
+                row = conn.execute("SELECT sub_id FROM identities WHERE key=?",
+                                   (self.key(name, birth_year, doc_no),)).fetchone()
+                if row:
+                    return row[0]
+            row = conn.execute("SELECT sub_id FROM identities WHERE key=?", (self.key(name, birth_year),)).fetchone()
+            return row[0] if row else None
+
+    def max_sub_id(self):
+        """Sub-id lớn nhất đã cấp (kể cả folder đã enqueue nhưng chưa được worker tạo thư mục)."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT MAX(CAST(sub_id AS INTEGER)) FROM identities").fetchone()
+        return row[0] or 0
+
+    def resolve(self, name, birth_year, doc_no, allocate):
+        """
+        Trả về (sub_id, is_new). allocate() cấp sub-id mới khi bệnh nhân chưa có trong index.
+        Khóa base trùng nhưng sub-id đó đã gắn với DOC_NO khác -> người trùng tên, cấp sub-id mới.
+        """
+        base = self.key(name, birth_year)
+        doc = self.key(name, birth_year, doc_no) if doc_no is not None else None
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            sub_id = None
+            if doc is not None:
+                row = conn.execute("SELECT sub_id FROM identities WHERE key=?", (doc,)).fetchone()
+                sub_id = row[0] if row else None
+            if sub_id is None:
+                row = conn.execute("SELECT sub_id FROM identities WHERE key=?", (base,)).fetchone()
+                if row:
+                    other_doc = conn.execute("SELECT 1 FROM identities WHERE sub_id=? AND kind='doc'",
+                                             (row[0],)).fetchone()
+                    if doc is None or other_doc is None:
+                        sub_id = row[0]
+            is_new = sub_id is None
+            if is_new:
+                sub_id = allocate()
+            now = time.time()
+            conn.execute("INSERT OR IGNORE INTO identities (key, sub_id, kind, created) VALUES (?, ?, 'base', ?)",
+                         (base, sub_id, now))
+            if doc is not None:
+                conn.execute("INSERT OR IGNORE INTO identities (key, sub_id, kind, created) VALUES (?, ?, 'doc', ?)",
+                             (doc, sub_id, now))
+        return sub_id, is_new
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=f"Tra cứu sub-id theo tên bệnh nhân (secret lấy từ ${KEY_ENV})")
+    parser.add_argument(
+        "--db",
+        type=str,
+        required=True,
+        help="SQLite identity index (thường là <bids_dir>/.identity_index.sqlite)"
+    )
+    parser.add_argument(
+        "--name",
+        type=str,
+        required=True,
+        help="Tên bệnh nhân (có dấu hoặc không)"
+    )
+    parser.add_argument(
+        "--birth_year",
+        type=str,
+        default=None,
+        help="Năm sinh (4 chữ số)"
+    )
+    parser.add_argument(
+        "--doc_no",
+        type=str,
+        default=None,
+        help="DOC_NO trong file xlsx, nếu biết"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    index = IdentityIndex(args.db)
+    sub_id = index.lookup(args.name, args.birth_year, args.doc_no)
+    print(f"sub-{sub_id}" if sub_id else "Not found")
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+
+def default_worker_id():
+    """Tên worker mặc định: <hostname>-<pid>, đủ để phân biệt worker giữa các máy."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class JobQueue:
+    """
+    Job table dùng SQLite để chia việc convert EDF giữa nhiều worker (nhiều máy cùng mount DB).
+    - Mỗi job là một nhóm EDF (một folder cha), payload là JSON.
+    - Worker claim job với lease có thời hạn, heartbeat trong lúc chạy để gia hạn lease.
+    - Lease hết hạn (worker chết / treo) sẽ được trả lại hàng đợi để worker khác claim lại.
+    """
+
+    def __init__(self, db_path, max_attempts=3):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    group_key TEXT UNIQUE NOT NULL,
+                    payload TEXT NOT NULL,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    owner TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT,
+                    updated REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs(status, priority DESC, job_id)")
+
+    @contextmanager
+    def _connect(self):
+        # isolation_level=None: tự quản lý transaction bằng BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, group_key, payload, priority=0):
+        """Thêm job; nếu group_key đã có trong bảng thì bỏ qua (enqueue lại an toàn)."""
+        with self._connect() as conn:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO jobs (group_key, payload, priority, updated) VALUES (?, ?, ?, ?)",
+                (group_key, json.dumps(payload), int(priority), time.time())
+            )
+            return cur.rowcount == 1
+
+    def _reclaim_expired(self, conn, now):
+        # Lease hết hạn: trả về pending, hoặc failed nếu đã thử quá max_attempts
+        conn.execute(
+            "UPDATE jobs SET status='failed', owner=NULL, error='lease expired too many times', updated=? "
+            "WHERE status='leased' AND lease_expires < ? AND attempts >= ?",
+            (now, now, self.max_attempts)
+        )
+        cur = conn.execute(
+            "UPDATE jobs SET status='pending', owner=NULL, updated=? "
+            "WHERE status='leased' AND lease_expires < ?",
+            (now, now)
+        )
+        if cur.rowcount:
+            logging.warning(f"Reclaimed {cur.rowcount} expired lease(s)")
+
+    def claim(self, worker_id, lease_seconds):
+        """Claim job pending có priority cao nhất. Trả về (job_id, payload) hoặc None."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._reclaim_expired(conn, now)
+                row = conn.execute(
+                    "SELECT job_id, payload FROM jobs WHERE status='pending' "
+                    "ORDER BY priority DESC, job_id LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                job_id, payload = row
+                conn.execute(
+                    "UPDATE jobs SET status='leased', owner=?, lease_expires=?, attempts=attempts+1, updated=? "
+                    "WHERE job_id=?",
+                    (worker_id, now + lease_seconds, now, job_id)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return job_id, json.loads(payload)
+
+    def heartbeat(self, job_id, worker_id, lease_seconds):
+        """Gia hạn lease. Trả về False nếu worker đã mất lease (job bị reclaim)."""
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET lease_expires=?, updated=? WHERE job_id=? AND owner=? AND status='leased'",
+                (now + lease_seconds, now, job_id, worker_id)
+            )
+            return cur.rowcount == 1
+
+    def complete(self, job_id, worker_id, result):
+        """Đánh dấu done. Nếu lease đã bị worker khác lấy thì kết quả bị bỏ qua."""
+        with self._connect() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status='done', result=?, owner=NULL, error=NULL, updated=? "
+                "WHERE job_id=? AND owner=? AND status='leased'",
+                (json.dumps(result), time.time(), job_id, worker_id)
+            )
+            return cur.rowcount == 1
+
+    def fail(self, job_id, worker_id, error):
+        """Job lỗi: cho chạy lại nếu còn lượt, ngược lại đánh dấu failed."""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status=CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "owner=NULL, error=?, updated=? WHERE job_id=? AND owner=? AND status='leased'",
+                (self.max_attempts, str(error), time.time(), job_id, worker_id)
+            )
+
+    def counts(self):
+        """Số job theo trạng thái, ví dụ {'pending': 10, 'leased': 2, 'done': 30}."""
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def unfinished(self):
+        counts = self.counts()
+        return counts.get('pending', 0) + counts.get('leased', 0)
+
+    def results(self):
+        """Payload + result của tất cả job done, theo thứ tự enqueue."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT payload, result FROM jobs WHERE status='done' ORDER BY job_id").fetchall()
+        return [(json.loads(p), json.loads(r)) for p, r in rows]
+
+    def payloads(self):
+        """{group_key: payload} của mọi job (mọi trạng thái): các giá trị đã giao cho job (vd. sub-id) coi như đã giữ chỗ."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT group_key, payload FROM jobs ORDER BY job_id").fetchall()
+        return {k: json.loads(p) for k, p in rows}
+
+    def failed_jobs(self):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT payload, error FROM jobs WHERE status='failed' ORDER BY job_id").fetchall()
+        return [(json.loads(p), e) for p, e in rows]
+
+
+def run_worker(queue, handler, worker_id=None, lease_seconds=300, poll_seconds=10):
+    """
+    Vòng lặp worker: claim -> chạy handler(payload) -> complete, heartbeat chạy nền trong lúc xử lý.
+    Khi không còn job pending nhưng còn job đang leased bởi worker khác, worker chờ và poll lại
+    để có thể reclaim job của worker chết khi lease hết hạn. Trả về số job đã hoàn thành.
+    """
+    worker_id = worker_id or default_worker_id()
+    n_done = 0
+    while True:
+        claimed = queue.claim(worker_id, lease_seconds)
+        if claimed is None:
+            if queue.unfinished() == 0:
+                break
+            time.sleep(poll_seconds)
+            continue
+
+        job_id, payload = claimed
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(lease_seconds / 3):
+                if not queue.heartbeat(job_id, worker_id, lease_seconds):
+                    logging.warning(f"[{worker_id}] Lost lease on job {job_id}")
+                    return
+
+        beater = threading.Thread(target=beat, daemon=True)
+        beater.start()
+        try:
+            result = handler(payload)
+        except Exception as e:
+            logging.error(f"[{worker_id}] Job {job_id} failed: {e}")
+            queue.fail(job_id, worker_id, e)
+            continue
+        finally:
+            stop.set()
+            beater.join()
+
+        if queue.complete(job_id, worker_id, result):
+            n_done += 1
+        else:
+            logging.warning(f"[{worker_id}] Job {job_id} finished after its lease was reclaimed; result dropped")
+    logging.info(f"[{worker_id}] No work left, processed {n_done} job(s)")
+    return n_done
@@ -0,0 +1,81 @@
+import os
+import logging
+from edf_header import read_edf_header, data_records_in_file, decode_footprint_bytes
+from edf_writer import WRITE_BLOCK_BYTES
+
+# Các đường xử lý một file EDF
+PATH_PASSTHROUGH = "passthrough"  # ghi lại header + copy data record int16 theo khối (không decode tín hiệu)
+PATH_HEADER_ONLY = "header_only"  # chỉ vá header, không ghi lại data
+
+
+def available_memory_bytes():
+    """RAM khả dụng (MemAvailable trong /proc/meminfo), fallback sang sysconf."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError):
+        return None
+
+
+class MemoryGovernor:
+    """
+    Chọn đường xử lý cho từng file dựa vào RAM khả dụng chia cho số worker.
+    Đường passthrough chỉ giữ một khối block_bytes data record int16 trong RAM, bất kể độ dài file;
+    decode_fallback cho biết có được dùng fallback MNE (preload toàn bộ tín hiệu float64) khi passthrough lỗi:
+    chỉ khi footprint decode ước tính từ header (channels x samples x 8 byte) x decode_factor vừa ngân sách.
+    - decode_factor: số bản float64 cùng tồn tại khi MNE đọc + export lại.
+    """
+
+    def __init__(self, n_workers=1, safety=0.7, decode_factor=2.0, block_bytes=WRITE_BLOCK_BYTES, memory_bytes=None):
+        self.n_workers = max(1, n_workers)
+        self.safety = safety
+        self.decode_factor = decode_factor
+        self.block_bytes = block_bytes
+        self.memory_bytes = memory_bytes
+
+    def budget_bytes(self):
+        """Ngân sách RAM cho một worker, đọc lại mỗi lần vì RAM trống thay đổi trong lúc chạy."""
+        total = self.memory_bytes or available_memory_bytes()
+        if total is None:
+            return None
+        return int(total * self.safety / self.n_workers)
+
+    def choose(self, edf_path):
+        """
+        Trả về dict: path (passthrough / header_only), decode_fallback, footprint_mb, budget_mb, reason.
+        File có header không đọc được vẫn đi đường passthrough (và fallback MNE) để chuỗi fallback cũ xử lý.
+        """
+        budget = self.budget_bytes()
+        try:
+            header = read_edf_header(edf_path)
+        except (OSError, ValueError) as e:
+            return {"path": PATH_PASSTHROUGH, "decode_fallback": True, "footprint_mb": None,
+                    "budget_mb": budget / 1024**2 if budget else None,
+                    "reason": f"Header not parsed ({e}); using default reader chain"}
+
+        footprint = decode_footprint_bytes(header)
+        n_records = header["n_records"] if header["n_records"] >= 0 else data_records_in_file(header)
+        # copy_edf_records giữ tối đa một khối block_bytes (ít nhất một record) trong RAM
+        block = max(header["record_bytes"], min(self.block_bytes, header["record_bytes"] * n_records))
+        decode_fallback = budget is None or footprint * self.decode_factor <= budget
+        if budget is None or block <= budget:
+            path = PATH_PASSTHROUGH
+            reason = "Record passthrough" + ("" if decode_fallback else "; too large to decode, no MNE fallback")
+        else:
+            path, reason = PATH_HEADER_ONLY, "One write block exceeds the budget; patching header only"
+        return {"path": path, "decode_fallback": decode_fallback, "footprint_mb": footprint / 1024**2,
+                "budget_mb": budget / 1024**2 if budget else None, "reason": reason}
+
+
+def log_decision(edf_path, decision, peak_rss_mb=None):
+    footprint = f"{decision['footprint_mb']:.0f} MB" if decision["footprint_mb"] is not None else "unknown"
+    budget = f"{decision['budget_mb']:.0f} MB" if decision["budget_mb"] is not None else "unknown"
+    peak = f"{peak_rss_mb:.0f} MB" if peak_rss_mb is not None else "n/a"
+    logging.info(f"{edf_path}: path={decision['path']} footprint={footprint} budget={budget} "
+                 f"peak_rss={peak} ({decision['reason']})")
@@ -0,0 +1,133 @@
+import os
+import glob
+import numpy as np
+import pandas as pd
+import pyedflib
+import mne
+import unidecode
+from identity_index import normalize_name
+
+# Thông số kênh giống bản export EDF của EEG2100 (xem header các file trong 108/):
+# điện cực EEG ±3200 uV, kênh DC / marker ±12002.9 mV, digital int16 đầy đủ
+NK_EEG_SPEC = (-3200.0, 3199.902, "uV", 1e6)
+NK_DC_SPEC = (-12002.9, 12002.56, "mV", 1e3)
+DIG_MIN, DIG_MAX = -32768, 32767
+
+
+def find_nihon_recordings(root):
+    """Các file .EEG (EEG2100) có .PNT đi kèm, quét đệ quy."""
+    found = []
+    for path in glob.glob(os.path.join(root, "**", "*"), recursive=True):
+        stem, ext = os.path.splitext(path)
+        if ext.upper() == ".EEG" and (os.path.exists(stem + ".PNT") or os.path.exists(stem + ".pnt")):
+            found.append(path)
+    return found
+
+
+def recording_key(path):
+    """Khóa nối với sidecar: stem trước dấu '_' đầu tiên, viết hoa (giống utils/read_other.py)."""
+    return os.path.splitext(os.path.basename(path))[0].split("_")[0].upper()
+
+
+def load_patient_sidecars(tsv_path):
+    """
+    Bảng bệnh nhân theo recording từ sidecar_metadata.tsv (utils/read_other.py).
+    Reader MNE không đọc tên bệnh nhân của EEG2100, nên tên / ngày sinh / giới tính lấy từ đây.
+    """
+    if not tsv_path or not os.path.exists(tsv_path):
+        return {}
+    df = pd.read_csv(tsv_path, sep="\t", dtype=str)
+    df["key"] = df["key"].str.upper() if "key" in df.columns else df["file"].map(recording_key)
+    df = df.drop_duplicates("key")
+    return {row["key"]: row for row in df.to_dict("records")}
+
+
+def patient_header(patient):
+    """
+    Các trường patient cho pyedflib theo kiểu bản export EEG2100: tên NGUYEN_THI_LOAN_1965
+    (đuôi năm sinh để matching trong create_bids), giới tính / ngày sinh nếu có.
+    """
+    if not patient:
+        return {"patientname": "X", "sex": "", "birthdate": ""}
+    name = "_".join(unidecode.unidecode(str(patient.get("PATIENT_NAME") or "X")).upper().split())
+    birth = pd.to_datetime(patient.get("BIRTH_DATE"), dayfirst=True, errors="coerce")
+    if not pd.isna(birth):
+        name = f"{name}_{birth.year}"
+    gender = str(patient.get("GENDER") or "").strip().lower()
+    sex = 1 if gender in ("male", "nam") else 0 if gender in ("female", "nữ", "nu") else ""
+    return {"patientname": name, "sex": sex, "birthdate": birth.date() if not pd.isna(birth) else ""}
+
+
+def _channel_spec(ch):
+    """(phys_min, phys_max, unit, multiplier từ volt) theo range MNE gán cho kênh EEG2100."""
+    if abs(ch.get("range", 0) - (NK_EEG_SPEC[1] - NK_EEG_SPEC[0])) < 1e-2:
+        return NK_EEG_SPEC
+    return NK_DC_SPEC
+
+
+def write_raw_edf_chunked(raw, out_path, patient=None, block_seconds=60):
+    """
+    Ghi một Raw chưa preload ra EDF+ theo từng khối block_seconds giây: mỗi khối đọc bằng get_data(start, stop)
+    rồi lượng tử hóa lại về đúng lưới digital int16 của máy (không mất mát), nên RAM chỉ tốn một khối.
+    Annotation (sự kiện từ .LOG) được ghi vào kênh EDF Annotations.
+    """
+    sfreq = raw.info["sfreq"]
+    if abs(sfreq - round(sfreq)) > 1e-6:
+        raise ValueError(f"Non-integer sampling rate {sfreq} Hz is not supported with 1-s data records")
+    sfreq = int(round(sfreq))
+    specs = [_channel_spec(ch) for ch in raw.info["chs"]]
+    signal_headers = [{
+        "label": name[:16],
+        "dimension": unit,
+        "sample_frequency": sfreq,
+        "physical_min": pmin,
+        "physical_max": pmax,
+        "digital_min": DIG_MIN,
+        "digital_max": DIG_MAX,
+        "transducer": "",
+        "prefilter": "",
+    } for name, (pmin, pmax, unit, _) in zip(raw.ch_names, specs)]
+    pmin = np.array([s[0] for s in specs])[:, None]
+    cal = (np.array([s[1] for s in specs])[:, None] - pmin) / (DIG_MAX - DIG_MIN)
+    mult = np.array([s[3] for s in specs])[:, None]
+
+    tmp_out = out_path + ".tmp"
+    writer = pyedflib.EdfWriter(tmp_out, n_channels=len(raw.ch_names), file_type=pyedflib.FILETYPE_EDFPLUS)
+    try:
+        header = {"technician": "", "recording_additional": "", "patient_additional": "", "patientcode": "",
+                  "equipment": "Nihon_Kohden_EEG2100", "admincode": "", **patient_header(patient)}
+        if raw.info["meas_date"] is not None:
+            header["startdate"] = raw.info["meas_date"].replace(tzinfo=None)
+        writer.setHeader(header)
+        writer.setSignalHeaders(signal_headers)
+
+        block = sfreq * block_seconds
+        n_times = raw.n_times - raw.n_times % sfreq  # EDF chỉ chứa record đầy đủ (1 s)
+        for start in range(0, n_times, block):
+            data = raw.get_data(start=start, stop=min(start + block, n_times))
+            digital = np.clip(np.round((data * mult - pmin) / cal + DIG_MIN), DIG_MIN, DIG_MAX).astype(np.int32)
+            writer.writeSamples(list(digital), digital=True)
+        for onset, duration, description in zip(raw.annotations.onset, raw.annotations.duration,
+                                                raw.annotations.description):
+            if onset < n_times / sfreq:
+                writer.writeAnnotation(float(onset), float(duration) if duration > 0 else -1, str(description))
+    finally:
+        writer.close()
+    os.replace(tmp_out, out_path)
+    return out_path
+
+
+def convert_nihon(eeg_path, out_path, patient=None, block_seconds=60):
+    """Đọc EEG2100 (.EEG + .PNT + .LOG) lazy bằng MNE và ghi thẳng ra EDF+ ở out_path."""
+    raw = mne.io.read_raw_nihon(eeg_path, preload=False, verbose=False)
+    return write_raw_edf_chunked(raw, out_path, patient, block_seconds)
+
+
+def nihon_identity(eeg_path, patients):
+    """(tên chuẩn hóa, năm sinh) cho identity index, lấy từ sidecar; ('', None) nếu không có."""
+    patient = patients.get(recording_key(eeg_path)) if patients else None
+    if not patient or not patient.get("PATIENT_NAME"):
+        return "", None
+    name = normalize_name(patient["PATIENT_NAME"])
+    birth = pd.to_datetime(patient.get("BIRTH_DATE"), dayfirst=True, errors="coerce")
+    return name, (str(birth.year) if not pd.isna(birth) else None)
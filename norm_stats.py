@@ -0,0 +1,306 @@
+import os
+import glob
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+from edf_reader import EdfMemmap
+from derivative_store import scaling_to_uv
+from catalog import Catalog, default_catalog_path
+
+STATS_DIR = os.path.join("derivatives", "norm_stats")
+LEVELS = ["subject", "site", "dataset"]
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+COMPRESSION = 100   # số centroid tối đa ~ COMPRESSION; lớn hơn = percentile chính xác hơn, blob lớn hơn
+N_CODES = 65536     # mọi giá trị digital int16
+
+
+class TDigest:
+    """
+    t-digest dạng merging (centroid: mean + weight), nén vector hóa bằng hàm scale k1: centroid ở hai đuôi
+    nhỏ nên p01 / p99 chính xác hơn median. Gộp hai digest = nối centroid rồi nén lại, nên thứ tự gộp
+    không quan trọng (sai số xấp xỉ, không phụ thuộc số lần gộp theo kiểu tích lũy).
+    """
+
+    def __init__(self, means=None, weights=None, compression=COMPRESSION):
+        self.compression = compression
+        self.means = np.zeros(0) if means is None else np.asarray(means, dtype=np.float64)
+        self.weights = np.zeros(0) if weights is None else np.asarray(weights, dtype=np.float64)
+        if len(self.means) > compression:
+            self._compress()
+
+    def _compress(self):
+        order = np.argsort(self.means, kind="stable")
+        means, weights = self.means[order], self.weights[order]
+        total = weights.sum()
+        q = (np.cumsum(weights) - weights / 2) / total
+        # k1(q) = δ * (asin(2q - 1) / π + 1/2): k tăng đơn điệu nên mỗi giá trị k là một đoạn liên tiếp
+        k = np.floor(self.compression * (np.arcsin(np.clip(2 * q - 1, -1, 1)) / np.pi + 0.5)).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, k[1:] != k[:-1]])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    @property
+    def count(self):
+        return float(self.weights.sum())
+
+    def merge(self, *others):
+        return TDigest(np.concatenate([self.means] + [o.means for o in others]),
+                       np.concatenate([self.weights] + [o.weights for o in others]), self.compression)
+
+    def quantile(self, q, vmin=None, vmax=None):
+        """Percentile (q trong [0, 1], số hoặc mảng) bằng nội suy giữa tâm các centroid."""
+        if not len(self.means):
+            return np.full(np.shape(q), np.nan)
+        order = np.argsort(self.means, kind="stable")
+        means, weights = self.means[order], self.weights[order]
+        total = weights.sum()
+        centers = np.cumsum(weights) - weights / 2
+        lo = means[0] if vmin is None else vmin
+        hi = means[-1] if vmax is None else vmax
+        return np.interp(np.asarray(q) * total, np.r_[0.0, centers, total], np.r_[lo, means, hi])
+
+    def to_bytes(self):
+        return np.stack([self.means, self.weights]).astype("<f8").tobytes()
+
+    @classmethod
+    def from_bytes(cls, blob, compression=COMPRESSION):
+        values = np.frombuffer(blob, dtype="<f8").reshape(2, -1)
+        return cls(values[0], values[1], compression)
+
+
+class ChannelStats:
+    """count / mean / M2 (tổng bình phương độ lệch) / min / max + TDigest; merge theo công thức song song của Welford (Chan)."""
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, vmin=np.inf, vmax=-np.inf, digest=None):
+        self.count, self.mean, self.m2 = int(count), float(mean), float(m2)
+        self.min, self.max = float(vmin), float(vmax)
+        self.digest = digest if digest is not None else TDigest()
+
+    @classmethod
+    def from_histogram(cls, values, weights, compression=COMPRESSION):
+        """Thống kê chính xác từ (giá trị vật lý, số lần xuất hiện) của các mã digital có mặt."""
+        n = weights.sum()
+        if not n:
+            return cls()
+        mean = (values * weights).sum() / n
+        m2 = (weights * (values - mean) ** 2).sum()
+        return cls(n, mean, m2, values.min(), values.max(), TDigest(values, weights, compression))
+
+    def merge(self, other):
+        if not other.count:
+            return self
+        if not self.count:
+            return other
+        n = self.count + other.count
+        delta = other.mean - self.mean
+        return ChannelStats(n, self.mean + delta * other.count / n,
+                            self.m2 + other.m2 + delta ** 2 * self.count * other.count / n,
+                            min(self.min, other.min), max(self.max, other.max), self.digest.merge(other.digest))
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else np.nan
+
+    def quantiles(self, qs=QUANTILES):
+        return self.digest.quantile(qs, self.min, self.max)
+
+
+def recording_stats(edf_path, block_seconds=60, compression=COMPRESSION):
+    """
+    Thống kê từng kênh (uV) của một recording, một lần quét theo block qua memmap. Mỗi block chỉ cộng dồn
+    histogram các mã digital int16 (bincount vector hóa cho mọi kênh cùng tần số), nên moments và digest
+    tính từ histogram là chính xác cho recording, RAM cố định 512 KB / kênh bất kể độ dài file.
+    """
+    rows = []
+    with EdfMemmap(edf_path) as reader:
+        if not reader.n_channels:
+            raise ValueError("No signal channels")
+        gain, offset = scaling_to_uv(reader, list(range(reader.n_channels)))
+        for spr in sorted(set(reader.samples_per_record.tolist())):
+            idx = [k for k in range(reader.n_channels) if reader.samples_per_record[k] == spr]
+            base = (np.arange(len(idx), dtype=np.int64) * N_CODES + N_CODES // 2)[:, None]
+            hist = np.zeros(len(idx) * N_CODES, dtype=np.int64)
+            block = max(1, int(block_seconds * reader.sfreqs[idx[0]]))
+            n_samples = reader.n_records * spr
+            for start in range(0, n_samples, block):
+                digital = reader.digital(idx, start, min(start + block, n_samples))
+                hist += np.bincount((digital + base).ravel(), minlength=len(hist))
+            hist = hist.reshape(len(idx), N_CODES)
+            for row, k in enumerate(idx):
+                codes = np.flatnonzero(hist[row])
+                values = (codes - N_CODES // 2) * gain[k] + offset[k]
+                stats = ChannelStats.from_histogram(values, hist[row, codes].astype(np.float64), compression)
+                rows.append({
+                    "channel": reader.labels[k].strip(),
+                    "unit": reader.units[k].strip(),
+                    "count": stats.count,
+                    "mean": stats.mean,
+                    "m2": stats.m2,
+                    "min": stats.min,
+                    "max": stats.max,
+                    "digest": stats.digest.to_bytes(),
+                })
+    return rows
+
+
+def _stats_item(item):
+    bids_dir, bids_path, block_seconds, compression = item
+    try:
+        return bids_path, recording_stats(os.path.join(bids_dir, bids_path), block_seconds, compression), None
+    except (OSError, ValueError) as e:
+        return bids_path, None, str(e)
+
+
+def compute_stats(bids_dir, catalog, block_seconds=60, compression=COMPRESSION, workers=1, refresh=False):
+    """
+    Tính thống kê cho các run chưa có trong bảng channel_stats (song song theo recording) và ghi vào catalog.
+    Thêm nguồn dữ liệu mới chỉ tốn thời gian cho các recording mới. Trả về (số run mới, failed rows).
+    """
+    edf_files = glob.glob(os.path.join(bids_dir, "sub-*", "**", "*_eeg.edf"), recursive=True)
+    runs = sorted(os.path.relpath(f, bids_dir) for f in edf_files)
+    done = set() if refresh else catalog.channel_stats_recordings()
+    items = [(bids_dir, p, block_seconds, compression) for p in runs if p not in done]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = tqdm(pool.map(_stats_item, items), total=len(items), desc="Channel stats")
+            failed = _store_results(catalog, results)
+    else:
+        failed = _store_results(catalog, (_stats_item(it) for it in tqdm(items, desc="Channel stats")))
+    return len(items) - len(failed), failed
+
+
+def _store_results(catalog, results):
+    failed = []
+    for bids_path, rows, error in results:
+        if error:
+            failed.append({"failed_file": bids_path, "reason": error})
+            logging.warning(f"Channel stats failed for {bids_path}: {error}")
+        else:
+            catalog.set_channel_stats(bids_path, rows)
+    return failed
+
+
+def load_sites(bids_dir, site_column="site"):
+    """participant_id -> site (cột site_column của participants.tsv, thiếu thì 'n/a')."""
+    tsv = os.path.join(bids_dir, "participants.tsv")
+    if not os.path.exists(tsv):
+        return {}
+    df = pd.read_csv(tsv, sep="\t", dtype=str, keep_default_na=False)
+    if site_column not in df.columns:
+        return {}
+    return dict(zip(df["participant_id"], df[site_column]))
+
+
+def aggregate_stats(bids_dir, catalog, levels=LEVELS, site_column="site", qc_status=None, compression=COMPRESSION):
+    """
+    Gộp thống kê recording -> subject / site / dataset bằng một lần duyệt bảng channel_stats
+    (merge kết hợp được nên không cần đọc lại tín hiệu). qc_status (vd. 'pass') chỉ giữ run có trạng thái QC đó.
+    Trả về DataFrame: level, group, channel, n_recordings, count, mean, std, min, p01..p99, max (uV).
+    """
+    sites = load_sites(bids_dir, site_column)
+    keep = catalog.qc_recordings(qc_status) if qc_status is not None else None
+    merged, n_recordings = {}, {}
+    for bids_path, channel, _unit, count, mean, m2, vmin, vmax, digest in catalog.iter_channel_stats():
+        if keep is not None and bids_path not in keep:
+            continue
+        stats = ChannelStats(count, mean, m2, vmin, vmax, TDigest.from_bytes(digest, compression))
+        subject = bids_path.split(os.sep)[0]
+        groups = {"subject": subject, "site": sites.get(subject) or "n/a", "dataset": "all"}
+        for level in levels:
+            key = (level, groups[level], channel)
+            merged[key] = merged[key].merge(stats) if key in merged else stats
+            n_recordings[key] = n_recordings.get(key, 0) + 1
+
+    rows = []
+    for (level, group, channel), stats in sorted(merged.items()):
+        row = {"level": level, "group": group, "channel": channel, "n_recordings": n_recordings[(level, group, channel)],
+               "count": stats.count, "mean": stats.mean, "std": np.sqrt(stats.variance), "min": stats.min}
+        row.update({f"p{round(q * 100):02d}": v for q, v in zip(QUANTILES, stats.quantiles())})
+        row["max"] = stats.max
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def write_aggregates(bids_dir, table):
+    """derivatives/norm_stats/<level>.tsv cho từng level."""
+    out_dir = os.path.join(bids_dir, STATS_DIR)
+    os.makedirs(out_dir, exist_ok=True)
+    for level, df in table.groupby("level"):
+        df.drop(columns=["level"]).to_csv(os.path.join(out_dir, f"{level}.tsv"), sep="\t", index=False,
+                                          float_format="%.6g")
+    return out_dir
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Thống kê chuẩn hóa theo kênh (mean / std / percentile) gộp được cho toàn corpus")
+    parser.add_argument(
+        "--bids_dir",
+        type=str,
+        required=True,
+        help="BIDS database directory"
+    )
+    parser.add_argument(
+        "--catalog",
+        type=str,
+        default=None,
+        help="SQLite catalog (mặc định: <bids_dir>/derivatives/catalog.sqlite)"
+    )
+    parser.add_argument(
+        "--block_seconds",
+        type=float,
+        default=60,
+        help="Độ dài block đọc mỗi lần (giây)"
+    )
+    parser.add_argument(
+        "--compression",
+        type=int,
+        default=COMPRESSION,
+        help="Độ nén t-digest (số centroid tối đa xấp xỉ)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Số process song song"
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Tính lại cả các recording đã có thống kê trong catalog"
+    )
+    parser.add_argument(
+        "--levels",
+        type=str,
+        nargs="+",
+        default=LEVELS,
+        choices=LEVELS,
+        help="Các mức gộp cần xuất"
+    )
+    parser.add_argument(
+        "--site_column",
+        type=str,
+        default="site",
+        help="Cột trong participants.tsv dùng làm site"
+    )
+    parser.add_argument(
+        "--qc_status",
+        type=str,
+        default=None,
+        help="Chỉ gộp các run có trạng thái QC này (vd. pass), cần chạy qc.py trước"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    args = get_args()
+    catalog = Catalog(args.catalog or default_catalog_path(args.bids_dir))
+    n_runs, failed = compute_stats(args.bids_dir, catalog, args.block_seconds, args.compression, args.workers,
+                                   args.refresh)
+    table = aggregate_stats(args.bids_dir, catalog, args.levels, args.site_column, args.qc_status, args.compression)
+    out_dir = write_aggregates(args.bids_dir, table)
+    print(f"Stats computed for {n_runs} new runs ({len(failed)} failed). Aggregates: {out_dir}")
@@ -0,0 +1,159 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+import unidecode
+from aho_corasick import Automaton
+from edf_header import read_edf_header, data_records_in_file
+from identity_index import normalize_name
+
+MIN_NAME_CHARS = 5  # tên ngắn hơn (vd. 'X', 'AN') dễ khớp nhầm với text thường, bỏ qua
+REDACT_BYTE = b"X"
+
+
+def name_variants(name):
+    """
+    Các cách một tên có thể xuất hiện trong file (sau fold_text): không dấu với ' ' / '_' / không cách,
+    giống cách kỹ thuật viên gõ và cách EEG2100 ghi vào header (NGUYEN_THI_LOAN).
+    """
+    if name is None or (isinstance(name, float) and np.isnan(name)):
+        return []
+    tokens = normalize_name(name).split()
+    variants = {" ".join(tokens), "_".join(tokens), "".join(tokens)}
+    return [v for v in variants if len(v.replace(" ", "")) >= MIN_NAME_CHARS]
+
+
+def fold_text(raw):
+    """
+    Bỏ dấu để tên gõ có dấu ('Nguyễn Thị Loan') khớp với pattern không dấu.
+    Trả về (folded bytes, starts, ends): byte thứ k của folded ứng với đoạn raw[starts[k]:ends[k]].
+    Dữ liệu ASCII (phần lớn annotation) đi thẳng, không tốn gì thêm.
+    """
+    if raw.isascii():
+        pos = np.arange(len(raw))
+        return raw, pos, pos + 1
+    folded, starts, ends = [], [], []
+    pos = 0
+    for ch in raw.decode("utf-8", errors="surrogateescape"):
+        width = len(ch.encode("utf-8", errors="surrogateescape"))
+        out = ch.encode("ascii") if ch.isascii() else unidecode.unidecode(ch).encode("ascii", errors="ignore")
+        folded.append(out)
+        starts.extend([pos] * len(out))
+        ends.extend([pos + width] * len(out))
+        pos += width
+    return b"".join(folded), np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+
+def find_names(raw, automatons):
+    """Các đoạn byte [start, end) của raw chứa tên (khớp sau khi bỏ dấu), đã gộp chồng nhau."""
+    folded, starts, ends = fold_text(raw)
+    spans = []
+    for s, e in sorted(s for a in automatons for s in a.spans(folded)):
+        s, e = int(starts[s]), int(ends[e - 1])
+        if spans and s <= spans[-1][1]:
+            spans[-1] = (spans[-1][0], max(spans[-1][1], e))
+        else:
+            spans.append((s, e))
+    return spans
+
+
+def build_name_automaton(names):
+    """Một automaton cho mọi biến thể của mọi tên (tên trùng chỉ thêm một lần)."""
+    patterns = []
+    for name in pd.unique(pd.Series(list(names), dtype=object).dropna()):
+        patterns.extend(name_variants(name))
+    return Automaton(patterns)
+
+
+def load_sheet_names(xlsx_path, column="PATIENT_NAME"):
+    """Tên bệnh nhân trong sheet lâm sàng (vd. matched_patients.xlsx); [] nếu không có file / cột."""
+    if not xlsx_path or not os.path.exists(xlsx_path):
+        return []
+    df = pd.read_excel(xlsx_path, usecols=lambda c: c == column)
+    if column not in df.columns:
+        logging.warning(f"No {column} column in {xlsx_path}")
+        return []
+    return df[column].dropna().astype(str).unique().tolist()
+
+
+def annotation_byte_ranges(header):
+    """[(lo, hi)] vị trí byte của các kênh 'EDF Annotations' trong một data record."""
+    byte_offsets = np.cumsum([0] + header["samples_per_record"]) * 2
+    return [(int(byte_offsets[i]), int(byte_offsets[i + 1])) for i in header["annotation_signals"]]
+
+
+def scrub_annotations(edf_path, automatons, block_records=4096):
+    """
+    Xoá tên trong annotation EDF+ tại chỗ: memmap phần data, chỉ quét đoạn byte TAL của mỗi record
+    và ghi đè từng match bằng 'X' cùng độ dài (cấu trúc TAL, kích thước record không đổi).
+    Kênh tín hiệu không bị đọc hay ghi. Trả về số đoạn đã xoá.
+    """
+    automatons = [a for a in automatons if a is not None and len(a)]
+    header = read_edf_header(edf_path)
+    n_records = data_records_in_file(header)
+    if header["n_records"] >= 0:
+        n_records = min(n_records, header["n_records"])
+    if not automatons or not header["annotation_signals"] or not n_records:
+        return 0
+
+    n_scrubbed = 0
+    data = np.memmap(edf_path, dtype=np.uint8, mode="r+", offset=header["data_offset"],
+                     shape=(n_records, header["record_bytes"]))
+    try:
+        for start in range(0, n_records, block_records):
+            for lo, hi in annotation_byte_ranges(header):
+                block = np.array(data[start:start + block_records, lo:hi])
+                for row in np.flatnonzero(block.any(axis=1)):
+                    tal = block[row].tobytes()
+                    spans = find_names(tal, automatons)
+                    if not spans:
+                        continue
+                    for s, e in spans:
+                        block[row, s:e] = REDACT_BYTE[0]
+                    data[start + row, lo:hi] = block[row]
+                    n_scrubbed += len(spans)
+        data.flush()
+    finally:
+        del data
+    return n_scrubbed
+
+
+def scan_edf(edf_path, automatons, block_records=4096):
+    """
+    Tìm tên trong header (chính + signal) và các record annotation của một file EDF, chỉ đọc các vùng đó
+    qua memmap. Trả về list (section, offset tuyệt đối trong file, length).
+    """
+    hits = []
+    try:
+        header = read_edf_header(edf_path)
+    except (OSError, ValueError):
+        header = None
+    header_bytes = header["data_offset"] if header else 256
+    with open(edf_path, "rb") as f:
+        head = f.read(header_bytes)
+    hits.extend(("header", s, e - s) for s, e in find_names(head, automatons))
+    if header is None or not header["annotation_signals"]:
+        return hits
+
+    n_records = data_records_in_file(header)
+    if header["n_records"] >= 0:
+        n_records = min(n_records, header["n_records"])
+    if not n_records:
+        return hits
+    data = np.memmap(edf_path, dtype=np.uint8, mode="r", offset=header["data_offset"],
+                     shape=(n_records, header["record_bytes"]))
+    for start in range(0, n_records, block_records):
+        for lo, hi in annotation_byte_ranges(header):
+            block = np.array(data[start:start + block_records, lo:hi])
+            for row in np.flatnonzero(block.any(axis=1)):
+                base = header["data_offset"] + (start + row) * header["record_bytes"] + lo
+                hits.extend(("annotation", base + s, e - s) for s, e in find_names(block[row].tobytes(), automatons))
+    del data
+    return hits
+
+
+def scan_text_file(path, automatons):
+    """Tìm tên trong file sidecar (tsv / json / txt), đọc nguyên file. Trả về list (section, offset, length)."""
+    with open(path, "rb") as f:
+        raw = f.read()
+    return [("sidecar", s, e - s) for s, e in find_names(raw, automatons)]
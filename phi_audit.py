@@ -0,0 +1,146 @@
+import os
+import glob
+import logging
+import argparse
+import multiprocessing as mp
+import pandas as pd
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+from identity_index import parse_patient_name
+from phi import build_name_automaton, load_sheet_names, scan_edf, scan_text_file, MIN_NAME_CHARS
+
+SIDECAR_SUFFIXES = (".tsv", ".json", ".txt", ".csv")
+AUDIT_COLUMNS = ["file", "section", "offset", "length"]
+
+_audit_ctx = {}
+
+
+def load_mapping_names(mapping_csv):
+    """
+    Tên gốc trong mapping CSV của anonymize.py (bỏ dòng fallback là tên file). Cột original_patient_name là tên
+    pyedflib đã decode (vd. "LE THI MINH 1980") hoặc trường patient thô (đường header-only): parse_patient_name
+    tách được cả hai.
+    """
+    if not mapping_csv or not os.path.exists(mapping_csv):
+        return []
+    originals = pd.read_csv(mapping_csv, usecols=["original_patient_name"], dtype=str)["original_patient_name"]
+    originals = originals.dropna()
+    originals = originals[~originals.str.lower().str.endswith(".edf")]
+    return [name for name in (parse_patient_name(p)[0] for p in originals.unique()) if name]
+
+
+def collect_audit_files(bids_dir, exclude=()):
+    """(EDF, sidecar) trong cây BIDS; exclude: các file được phép chứa tên (mapping CSV, ...)."""
+    exclude = {os.path.abspath(p) for p in exclude if p}
+    edf_files, sidecars = [], []
+    for path in glob.glob(os.path.join(bids_dir, "**", "*"), recursive=True):
+        if not os.path.isfile(path) or os.path.abspath(path) in exclude:
+            continue
+        lower = path.lower()
+        if lower.endswith(".edf"):
+            edf_files.append(path)
+        elif lower.endswith(SIDECAR_SUFFIXES):
+            sidecars.append(path)
+    return sorted(edf_files), sorted(sidecars)
+
+
+def _init_audit_worker(automaton):
+    _audit_ctx["automatons"] = [automaton]
+
+
+def _audit_item(path):
+    try:
+        scan = scan_edf if path.lower().endswith(".edf") else scan_text_file
+        return path, scan(path, _audit_ctx["automatons"]), None
+    except (OSError, ValueError) as e:
+        return path, [], str(e)
+
+
+def audit_bids(bids_dir, names, workers=4, exclude=()):
+    """
+    Quét header + annotation của mọi EDF và mọi sidecar trong bids_dir với MỘT automaton chứa mọi tên.
+    Trả về DataFrame hit (file, section, offset, length) và list file không đọc được.
+    """
+    automaton = build_name_automaton(names)
+    edf_files, sidecars = collect_audit_files(bids_dir, exclude)
+    # File EDF lớn trước để các worker kết thúc gần cùng lúc
+    items = sorted(edf_files, key=os.path.getsize, reverse=True) + sidecars
+    logging.info(f"Auditing {len(edf_files)} EDF + {len(sidecars)} sidecars against {len(automaton)} name patterns")
+
+    if workers > 1:
+        # fork: automaton có sẵn trong worker, không pickle lại
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("fork"),
+                                 initializer=_init_audit_worker, initargs=(automaton,)) as pool:
+            results = list(tqdm(pool.map(_audit_item, items, chunksize=16), total=len(items), desc="Auditing"))
+    else:
+        _init_audit_worker(automaton)
+        results = [_audit_item(p) for p in tqdm(items, desc="Auditing")]
+
+    rows, unreadable = [], []
+    for path, hits, error in results:
+        if error:
+            unreadable.append({"file": os.path.relpath(path, bids_dir), "reason": error})
+        rows.extend({"file": os.path.relpath(path, bids_dir), "section": section, "offset": offset, "length": length}
+                    for section, offset, length in hits)
+    return pd.DataFrame(rows, columns=AUDIT_COLUMNS), unreadable
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Kiểm tra còn sót tên bệnh nhân trong cây BIDS đã anonymize")
+    parser.add_argument(
+        "--bids_dir",
+        type=str,
+        required=True,
+        help="BIDS database directory"
+    )
+    parser.add_argument(
+        "--names_xlsx",
+        type=str,
+        default=None,
+        help="Sheet lâm sàng có cột PATIENT_NAME (vd. matched_patients.xlsx)"
+    )
+    parser.add_argument(
+        "--mapping_csv",
+        type=str,
+        default=None,
+        help="Mapping CSV của anonymize.py (mặc định: <bids_dir>/mapping_original_to_sub_1.csv); không bị quét"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Số process quét song song"
+    )
+    parser.add_argument(
+        "--out",
+        type=str,
+        default=None,
+        help="File kết quả (mặc định: <bids_dir>/derivatives/phi_audit.tsv)"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    args = get_args()
+    mapping_csv = args.mapping_csv or os.path.join(args.bids_dir, "mapping_original_to_sub_1.csv")
+    out_tsv = args.out or os.path.join(args.bids_dir, "derivatives", "phi_audit.tsv")
+    if args.mapping_csv and not os.path.exists(mapping_csv):
+        raise SystemExit(f"Mapping CSV not found: {mapping_csv}")
+    mapping_names = load_mapping_names(mapping_csv)
+    if os.path.exists(mapping_csv) and not len(build_name_automaton(mapping_names)):
+        # mapping được chỉ định mà không ra pattern nào: audit sẽ báo "sạch" sai, dừng luôn
+        raise SystemExit(f"No usable patient names (>= {MIN_NAME_CHARS} chars) in {mapping_csv}")
+    names = load_sheet_names(args.names_xlsx) + mapping_names
+    if not len(build_name_automaton(names)):
+        raise SystemExit("No patient names to audit against: pass --names_xlsx and/or --mapping_csv")
+
+    hits, unreadable = audit_bids(args.bids_dir, names, args.workers, exclude=[mapping_csv, out_tsv])
+    os.makedirs(os.path.dirname(os.path.abspath(out_tsv)), exist_ok=True)
+    hits.to_csv(out_tsv, sep="\t", index=False)
+    for row in unreadable:
+        logging.warning(f"Could not audit {row['file']}: {row['reason']}")
+    if hits.empty:
+        print(f"No patient names found. Report saved to: {out_tsv}")
+    else:
+        print(f"⚠️ {len(hits)} name occurrences in {hits['file'].nunique()} files. Report saved to: {out_tsv}")
@@ -0,0 +1,215 @@
+import os
+import glob
+import json
+import shutil
+import logging
+import argparse
+import numpy as np
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+from edf_reader import EdfMemmap
+from derivative_store import scaling_to_uv
+
+PREVIEW_DIR = os.path.join("derivatives", "preview")
+BASE_SECONDS = 0.1      # độ rộng bin ở level 0; zoom mịn hơn thì đọc thẳng EDF (EdfMemmap.window)
+FACTOR = 4              # mỗi level gộp FACTOR bin của level dưới
+MIN_BINS = 1024         # dừng khi level thô nhất còn <= MIN_BINS bin
+BLOCK_BINS = 6000       # số bin level 0 tính trong một lần đọc (10 phút với bin 0.1 s)
+
+
+def preview_path_for(bids_path):
+    """derivatives/preview/sub-XXXX/<run>_eeg_preview (thư mục), tương đối so với bids_dir."""
+    base = os.path.basename(bids_path)[:-len(".edf")]
+    return os.path.join(PREVIEW_DIR, bids_path.split(os.sep)[0], base + "_preview")
+
+
+def _level_file(path, level):
+    return os.path.join(path, f"level_{level:02d}.npy")
+
+
+def build_preview(edf_path, out_path, base_seconds=BASE_SECONDS, factor=FACTOR, min_bins=MIN_BINS):
+    """
+    Ghi kim tự tháp min/max cho một run: level_XX.npy int16 (channels x bins x 2) giá trị digital,
+    level 0 có bin base_seconds giây, level k+1 gộp factor bin của level k. Level 0 tính theo block từ
+    memmap (np.minimum / np.maximum.reduceat, bin có thể lệch mẫu khi sfreq * base_seconds không nguyên),
+    các level trên tính từ level ngay dưới nên chỉ đọc tín hiệu gốc một lần. gain / offset (uV) trong meta.json.
+    Ghi ra .tmp rồi đổi tên như derivative_store.export_run.
+    """
+    tmp_path = out_path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    with EdfMemmap(edf_path) as reader:
+        if not reader.n_channels or not reader.n_records:
+            raise ValueError("No signal data")
+        base_seconds = max(base_seconds, 1.0 / float(reader.sfreqs.min()))  # mỗi bin có ít nhất một mẫu
+        n_bins = int(np.ceil(reader.duration / base_seconds - 1e-9))
+        level0 = np.lib.format.open_memmap(_level_file(tmp_path, 0), mode="w+", dtype="<i2",
+                                           shape=(reader.n_channels, n_bins, 2))
+        for spr in sorted(set(reader.samples_per_record.tolist())):
+            idx = [k for k in range(reader.n_channels) if reader.samples_per_record[k] == spr]
+            starts = np.floor(np.arange(n_bins + 1) * base_seconds * reader.sfreqs[idx[0]]).astype(np.int64)
+            starts[-1] = reader.n_records * spr
+            for b0 in range(0, n_bins, BLOCK_BINS):
+                b1 = min(b0 + BLOCK_BINS, n_bins)
+                digital = reader.digital(idx, starts[b0], starts[b1])
+                local = starts[b0:b1] - starts[b0]
+                level0[idx, b0:b1, 0] = np.minimum.reduceat(digital, local, axis=1)
+                level0[idx, b0:b1, 1] = np.maximum.reduceat(digital, local, axis=1)
+        gain, offset = scaling_to_uv(reader, list(range(reader.n_channels)))
+        meta = {
+            "channels": [label.strip() for label in reader.labels],
+            "sfreq": reader.sfreqs.tolist(),
+            "duration": reader.duration,
+            "unit": "uV",
+            "gain": gain.tolist(),
+            "offset": offset.tolist(),
+            "base_seconds": base_seconds,
+            "factor": factor,
+        }
+        level0.flush()
+
+    levels, below = [n_bins], level0
+    while levels[-1] > min_bins:
+        n = int(np.ceil(levels[-1] / factor))
+        above = np.lib.format.open_memmap(_level_file(tmp_path, len(levels)), mode="w+", dtype="<i2",
+                                          shape=(below.shape[0], n, 2))
+        step = BLOCK_BINS * factor
+        for s in range(0, levels[-1], step):
+            chunk = np.asarray(below[:, s:s + step])
+            local = np.arange(0, chunk.shape[1], factor)
+            above[:, s // factor:s // factor + len(local), 0] = np.minimum.reduceat(chunk[:, :, 0], local, axis=1)
+            above[:, s // factor:s // factor + len(local), 1] = np.maximum.reduceat(chunk[:, :, 1], local, axis=1)
+        above.flush()
+        levels.append(n)
+        below = above
+    meta["levels"] = levels
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=4)
+
+    del level0, below
+    if os.path.exists(out_path):
+        shutil.rmtree(out_path)
+    os.replace(tmp_path, out_path)
+    return meta
+
+
+class Preview:
+    """
+    Đọc kim tự tháp min/max của một run qua np.load(mmap_mode='r'): fetch() chọn level mịn nhất mà số bin
+    trong khoảng thời gian yêu cầu <= max_bins, nên mọi mức zoom chỉ đọc vài chục KB.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.channels = self.meta["channels"]
+        self.duration = self.meta["duration"]
+        self.gain = np.array(self.meta["gain"], dtype=np.float32)
+        self.offset = np.array(self.meta["offset"], dtype=np.float32)
+        self.levels = [np.load(_level_file(path, k), mmap_mode="r") for k in range(len(self.meta["levels"]))]
+
+    def bin_seconds(self, level):
+        return self.meta["base_seconds"] * self.meta["factor"] ** level
+
+    def choose_level(self, t_start, t_stop, max_bins):
+        for level in range(len(self.levels)):
+            if (t_stop - t_start) / self.bin_seconds(level) <= max_bins:
+                return level
+        return len(self.levels) - 1
+
+    def fetch(self, t_start=0.0, t_stop=None, max_bins=2000, channels=None):
+        """(times [bins], lo, hi [channels x bins], uV float32) cho đoạn [t_start, t_stop) giây."""
+        t_stop = self.duration if t_stop is None else min(t_stop, self.duration)
+        idx = list(range(len(self.channels))) if channels is None else \
+            [self.channels.index(c) if isinstance(c, str) else int(c) for c in channels]
+        level = self.choose_level(t_start, t_stop, max_bins)
+        width = self.bin_seconds(level)
+        data = self.levels[level]
+        # làm tròn trước floor / ceil: width thập phân (0.1 s) làm 10 // 0.1 == 99.0
+        b0 = max(0, int(np.floor(round(t_start / width, 9))))
+        b1 = min(data.shape[1], int(np.ceil(round(t_stop / width, 9))))
+        block = data[idx, b0:b1].astype(np.float32)
+        gain, offset = self.gain[idx, None], self.offset[idx, None]
+        a, b = block[:, :, 0] * gain + offset, block[:, :, 1] * gain + offset
+        # gain âm (phys_min > phys_max) đảo thứ tự min / max
+        return np.arange(b0, b1) * width, np.minimum(a, b), np.maximum(a, b)
+
+
+def open_preview(bids_dir, bids_path, build=True):
+    """Preview của một run; chưa có thì dựng ngay (lazy) khi build=True."""
+    out_path = os.path.join(bids_dir, preview_path_for(bids_path))
+    if not os.path.exists(os.path.join(out_path, "meta.json")):
+        if not build:
+            raise FileNotFoundError(f"No preview for {bids_path}")
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        build_preview(os.path.join(bids_dir, bids_path), out_path)
+    return Preview(out_path)
+
+
+def _preview_item(item):
+    bids_dir, bids_path, base_seconds = item
+    try:
+        out_path = os.path.join(bids_dir, preview_path_for(bids_path))
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        build_preview(os.path.join(bids_dir, bids_path), out_path, base_seconds)
+        return bids_path, None
+    except (OSError, ValueError) as e:
+        return bids_path, str(e)
+
+
+def build_previews(bids_dir, base_seconds=BASE_SECONDS, workers=1, overwrite=False):
+    """Dựng preview song song cho mọi run chưa có (trừ khi overwrite). Trả về (số run đã dựng, failed rows)."""
+    edf_files = glob.glob(os.path.join(bids_dir, "sub-*", "**", "*_eeg.edf"), recursive=True)
+    runs = sorted(os.path.relpath(f, bids_dir) for f in edf_files)
+    items = [(bids_dir, p, base_seconds) for p in runs
+             if overwrite or not os.path.exists(os.path.join(bids_dir, preview_path_for(p), "meta.json"))]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(tqdm(pool.map(_preview_item, items), total=len(items), desc="Previews"))
+    else:
+        results = [_preview_item(it) for it in tqdm(items, desc="Previews")]
+
+    failed = []
+    for bids_path, error in results:
+        if error:
+            failed.append({"failed_file": bids_path, "reason": error})
+            logging.warning(f"Failed to build preview for {bids_path}: {error}")
+    return len(items) - len(failed), failed
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Dựng kim tự tháp min/max để xem nhanh các recording dài")
+    parser.add_argument(
+        "--bids_dir",
+        type=str,
+        required=True,
+        help="BIDS database directory"
+    )
+    parser.add_argument(
+        "--base_seconds",
+        type=float,
+        default=BASE_SECONDS,
+        help="Độ rộng bin ở level mịn nhất (giây)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Số process song song"
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Dựng lại cả các run đã có preview"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    args = get_args()
+    n_runs, failed = build_previews(args.bids_dir, args.base_seconds, args.workers, args.overwrite)
+    print(f"{n_runs} previews built in {os.path.join(args.bids_dir, PREVIEW_DIR)} ({len(failed)} failed)")
@@ -0,0 +1,230 @@
+import os
+import glob
+import logging
+import argparse
+from collections import Counter
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+from edf_reader import EdfMemmap
+from derivative_store import scaling_to_uv
+from catalog import Catalog, default_catalog_path, QC_COLUMNS
+
+QC_DIR = os.path.join("derivatives", "qc")
+# cột số đo của bảng qc: về NULL khi run không đọc được, không giữ số đo của lần QC trước
+QC_METRICS = [c for c in QC_COLUMNS if c not in ("bids_path", "status", "updated")]
+CHANNEL_COLUMNS = ["channel", "unit", "flat_fraction", "clip_fraction", "line_noise_ratio", "outlier_fraction", "bad"]
+
+# Ngưỡng mặc định; kênh vượt bất kỳ ngưỡng nào là kênh xấu
+THRESHOLDS = {
+    "flat_fraction": 0.5,       # tỉ lệ cửa sổ 1 s gần như phẳng
+    "clip_fraction": 0.01,      # tỉ lệ mẫu chạm dig_min / dig_max
+    "line_noise_ratio": 0.9,    # công suất 50 Hz +- 1 Hz / công suất 1 Hz..Nyquist (EEG lâm sàng thô thường 0.3..0.8)
+    "outlier_fraction": 0.1,    # tỉ lệ cửa sổ có std lệch xa median (robust z)
+}
+MIN_DURATION = 10.0     # recording ngắn hơn (giây) luôn bị đánh dấu bad
+FLAT_PTP_UV = 0.5       # cửa sổ có biên độ đỉnh-đỉnh < 0.5 uV coi là phẳng
+OUTLIER_Z = 5.0
+LINE_FREQ = 50.0
+EEG_UNITS = {"uv", "µv"}
+
+
+class ChannelQC:
+    """
+    Bộ tích lũy QC cho một nhóm kênh cùng tần số, cập nhật theo từng block (channels x samples) một lần:
+    - clip: đếm mẫu digital đúng bằng dig_min / dig_max
+    - flat + outlier: đỉnh-đỉnh và std của từng cửa sổ 1 s (chỉ giữ 1 số float32 / kênh / giây)
+    - line noise: tổng phổ công suất (FFT cửa sổ Hann 2 s) để so 50 Hz với toàn dải
+    """
+
+    def __init__(self, n_channels, sfreq, dig_min, dig_max, line_freq=LINE_FREQ):
+        self.sfreq = sfreq
+        self.win = max(1, int(round(sfreq)))
+        self.nfft = 2 * self.win
+        self.dig_min, self.dig_max = dig_min[:, None], dig_max[:, None]
+        self.n_samples = 0
+        self.clipped = np.zeros(n_channels)
+        self.ptp, self.std = [], []
+        self.power = np.zeros((n_channels, self.nfft // 2 + 1))
+        self.hann = np.hanning(self.nfft).astype(np.float32)
+        freqs = np.fft.rfftfreq(self.nfft, 1.0 / sfreq)
+        self.line_bins = np.abs(freqs - line_freq) <= 1.0
+        self.band_bins = freqs >= 1.0
+
+    def update(self, digital, physical_uv):
+        n_ch, n = digital.shape
+        self.n_samples += n
+        self.clipped += ((digital <= self.dig_min) | (digital >= self.dig_max)).sum(axis=1)
+
+        n_win = n // self.win
+        if n_win:
+            w = physical_uv[:, :n_win * self.win].reshape(n_ch, n_win, self.win)
+            self.ptp.append((w.max(axis=2) - w.min(axis=2)).astype(np.float32))
+            self.std.append(w.std(axis=2).astype(np.float32))
+        n_seg = n // self.nfft
+        if n_seg:
+            seg = physical_uv[:, :n_seg * self.nfft].reshape(n_ch, n_seg, self.nfft)
+            seg = (seg - seg.mean(axis=2, keepdims=True)) * self.hann
+            self.power += (np.abs(np.fft.rfft(seg, axis=2)) ** 2).sum(axis=1)
+
+    def result(self):
+        n_ch = len(self.clipped)
+        ptp = np.concatenate(self.ptp, axis=1) if self.ptp else np.zeros((n_ch, 0))
+        std = np.concatenate(self.std, axis=1) if self.std else np.zeros((n_ch, 0))
+        flat = ptp < FLAT_PTP_UV
+        flat_fraction = flat.mean(axis=1) if ptp.shape[1] else np.ones(n_ch)
+        # outlier: std của cửa sổ (không phẳng) có robust z-score > OUTLIER_Z so với median của kênh
+        outlier_fraction = np.zeros(n_ch)
+        for c in range(n_ch):
+            s = std[c][~flat[c]]
+            if len(s) < 2:
+                continue
+            med = np.median(s)
+            mad = np.median(np.abs(s - med)) * 1.4826
+            if mad > 0:
+                outlier_fraction[c] = np.sum(np.abs(s - med) / mad > OUTLIER_Z) / std.shape[1]
+        total = self.power[:, self.band_bins].sum(axis=1)
+        line = self.power[:, self.line_bins].sum(axis=1)
+        line_ratio = np.divide(line, total, out=np.zeros(n_ch), where=total > 0)
+        clip_fraction = self.clipped / self.n_samples if self.n_samples else np.zeros(n_ch)
+        return {"flat_fraction": flat_fraction, "clip_fraction": clip_fraction,
+                "line_noise_ratio": line_ratio, "outlier_fraction": outlier_fraction}
+
+
+def qc_recording(edf_path, block_seconds=60, thresholds=THRESHOLDS):
+    """
+    Một lần quét recording theo block block_seconds giây (memmap, không decode toàn file).
+    Trả về (DataFrame theo kênh, dict tóm tắt cho catalog).
+    """
+    with EdfMemmap(edf_path) as reader:
+        if not reader.n_channels:
+            raise ValueError("No signal channels")
+        spr = Counter(reader.samples_per_record.tolist()).most_common(1)[0][0]
+        idx = [k for k in range(reader.n_channels) if reader.samples_per_record[k] == spr]
+        sfreq = float(reader.sfreqs[idx[0]])
+        gain, offset = scaling_to_uv(reader, idx)
+        gain, offset = gain[:, None].astype(np.float32), offset[:, None].astype(np.float32)
+        chans = [reader.channels[k] for k in idx]
+        dig_min = np.array([reader.header["dig_min"][i] for i in chans])
+        dig_max = np.array([reader.header["dig_max"][i] for i in chans])
+        acc = ChannelQC(len(idx), sfreq, dig_min, dig_max)
+        # block là bội số của cửa sổ FFT (2 s) để không cửa sổ nào bị cắt giữa hai block
+        block = acc.nfft * max(1, int(block_seconds * sfreq) // acc.nfft)
+        n_samples = reader.n_records * spr
+        for start in range(0, n_samples, block):
+            digital = reader.digital(idx, start, min(start + block, n_samples))
+            acc.update(digital, digital.astype(np.float32) * gain + offset)
+        duration = reader.duration
+        labels = [reader.labels[k] for k in idx]
+        units = [reader.units[k] for k in idx]
+
+    metrics = acc.result()
+    channels = pd.DataFrame({"channel": labels, "unit": [u.strip() for u in units], **metrics})
+    channels["bad"] = np.any([channels[m] > t for m, t in thresholds.items()], axis=0)
+    # trạng thái run chỉ xét kênh EEG (đơn vị uV); kênh DC / SpO2 / marker vẫn có trong bảng theo kênh
+    eeg = channels[channels["unit"].str.strip().str.lower().isin(EEG_UNITS)]
+    if eeg.empty:
+        eeg = channels
+    n_bad = int(eeg["bad"].sum())
+    status = "bad" if duration < MIN_DURATION or n_bad > len(eeg) / 2 else "pass"
+    summary = {
+        "duration": duration,
+        "n_channels": len(eeg),
+        "flat_fraction": float(eeg["flat_fraction"].mean()),
+        "clip_fraction": float(eeg["clip_fraction"].max()),
+        "line_noise_ratio": float(eeg["line_noise_ratio"].median()),
+        "outlier_fraction": float(eeg["outlier_fraction"].mean()),
+        "n_bad_channels": n_bad,
+        "status": status,
+    }
+    return channels[CHANNEL_COLUMNS], summary
+
+
+def _qc_item(item):
+    bids_dir, bids_path, block_seconds = item
+    try:
+        channels, summary = qc_recording(os.path.join(bids_dir, bids_path), block_seconds)
+        out_tsv = os.path.join(bids_dir, QC_DIR, os.path.dirname(bids_path),
+                               os.path.basename(bids_path).replace("_eeg.edf", "_qc.tsv"))
+        os.makedirs(os.path.dirname(out_tsv), exist_ok=True)
+        channels.to_csv(out_tsv, sep="\t", index=False, float_format="%.6g")
+        return bids_path, summary, None
+    except (OSError, ValueError) as e:
+        return bids_path, None, str(e)
+
+
+def run_qc(bids_dir, catalog, block_seconds=60, workers=1, refresh=False):
+    """
+    QC mọi run chưa có trong bảng qc của catalog (song song theo recording); run lần trước không đọc được
+    (status 'unreadable') được thử lại.
+    Ghi derivatives/qc/<sub>/eeg/<run>_qc.tsv (theo kênh) + catalog + derivatives/qc/qc_summary.tsv.
+    """
+    edf_files = glob.glob(os.path.join(bids_dir, "sub-*", "**", "*_eeg.edf"), recursive=True)
+    runs = sorted(os.path.relpath(f, bids_dir) for f in edf_files)
+    done = set() if refresh else catalog.qc_recordings(exclude=("unreadable",))
+    items = [(bids_dir, p, block_seconds) for p in runs if p not in done]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(tqdm(pool.map(_qc_item, items), total=len(items), desc="QC"))
+    else:
+        results = [_qc_item(it) for it in tqdm(items, desc="QC")]
+
+    failed = []
+    for bids_path, summary, error in results:
+        if error:
+            failed.append({"failed_file": bids_path, "reason": error})
+            logging.warning(f"QC failed for {bids_path}: {error}")
+            catalog.upsert_qc(bids_path, status="unreadable", **dict.fromkeys(QC_METRICS))
+        else:
+            catalog.upsert_qc(bids_path, **summary)
+
+    summary = pd.DataFrame(catalog.qc_rows(), columns=QC_COLUMNS)
+    os.makedirs(os.path.join(bids_dir, QC_DIR), exist_ok=True)
+    summary.drop(columns=["updated"]).to_csv(os.path.join(bids_dir, QC_DIR, "qc_summary.tsv"), sep="\t",
+                                             index=False, na_rep="n/a", float_format="%.6g")
+    return len(items) - len(failed), failed
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="QC tín hiệu (flat, clipping, 50 Hz, outlier) một lần quét / recording")
+    parser.add_argument(
+        "--bids_dir",
+        type=str,
+        required=True,
+        help="BIDS database directory"
+    )
+    parser.add_argument(
+        "--catalog",
+        type=str,
+        default=None,
+        help="SQLite catalog (mặc định: <bids_dir>/derivatives/catalog.sqlite)"
+    )
+    parser.add_argument(
+        "--block_seconds",
+        type=float,
+        default=60,
+        help="Độ dài block đọc mỗi lần (giây)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Số process QC song song"
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Tính lại QC cho cả các recording đã có trong catalog"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    args = get_args()
+    catalog = Catalog(args.catalog or default_catalog_path(args.bids_dir))
+    n_runs, failed = run_qc(args.bids_dir, catalog, args.block_seconds, args.workers, args.refresh)
+    print(f"QC done for {n_runs} runs ({len(failed)} failed). Summary: "
+          f"{os.path.join(args.bids_dir, QC_DIR, 'qc_summary.tsv')}")
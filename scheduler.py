@@ -0,0 +1,93 @@
+import os
+import heapq
+import logging
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from tqdm import tqdm
+
+# Decode int16 -> float64 tốn ~4 lần kích thước file trên RAM
+DECODE_FACTOR = 4
+
+
+def group_inventory(edf_groups, sub_ids=None):
+    """
+    Inventory kích thước (byte) cho từng folder EDF.
+    sub_ids: dict folder -> sub_id đã gán trước (để thứ tự chạy không làm đổi sub-id).
+    """
+    items = []
+    for folder, files in edf_groups.items():
+        sizes = []
+        for f in files:
+            try:
+                sizes.append(os.path.getsize(f))
+            except OSError:
+                sizes.append(0)
+        items.append({
+            "folder": folder,
+            "files": sorted(files),
+            "sub_id": sub_ids.get(folder) if sub_ids else None,
+            "bytes": sum(sizes),
+            "mem_bytes": max(sizes, default=0) * DECODE_FACTOR,
+        })
+    return items
+
+
+def lpt_order(items):
+    """Longest-processing-time-first: job lớn nhất chạy trước (ổn định theo thứ tự ban đầu khi bằng nhau)."""
+    return sorted(items, key=lambda it: -it["bytes"])
+
+
+def lpt_assign(items, n_workers):
+    """
+    Chia tĩnh LPT: gán lần lượt job lớn nhất cho worker đang nhẹ nhất.
+    Trả về (list job theo worker, makespan dự kiến tính bằng byte).
+    """
+    heap = [(0, w) for w in range(n_workers)]
+    shards = [[] for _ in range(n_workers)]
+    for it in lpt_order(items):
+        load, w = heapq.heappop(heap)
+        shards[w].append(it)
+        heapq.heappush(heap, (load + it["bytes"], w))
+    return shards, max(load for load, _ in heap)
+
+
+def run_lpt(items, func, n_workers, worker_mem_bytes=None, initializer=None, initargs=()):
+    """
+    Chạy func(item) trên process pool theo thứ tự LPT với ngân sách RAM mỗi worker.
+    - Tổng mem_bytes của các job đang chạy không vượt quá n_workers * worker_mem_bytes;
+      nếu job lớn nhất còn lại chưa vừa thì lấy job nhỏ hơn vừa ngân sách (backfill).
+    - Một job luôn được chạy khi pool trống, kể cả khi vượt ngân sách, để không bị kẹt.
+    - Progress bar tính theo byte nên ETA là thời gian cho số byte còn lại.
+    Yield (item, result) theo thứ tự hoàn thành.
+    """
+    pending = lpt_order(items)
+    total_bytes = sum(it["bytes"] for it in pending)
+    budget = n_workers * worker_mem_bytes if worker_mem_bytes else None
+    _, makespan = lpt_assign(items, n_workers)
+    logging.info(f"LPT schedule: {len(pending)} jobs, {total_bytes / 1024**2:.1f} MB total, "
+                 f"predicted makespan {makespan / 1024**2:.1f} MB per worker")
+
+    running = {}
+    mem_in_flight = 0
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=initializer, initargs=initargs) as pool, \
+            tqdm(total=total_bytes, unit="B", unit_scale=True, unit_divisor=1024, desc="Bytes processed") as pbar:
+        while pending or running:
+            # Submit job theo LPT trong giới hạn số worker và ngân sách RAM
+            i = 0
+            while i < len(pending) and len(running) < n_workers:
+                it = pending[i]
+                fits = budget is None or mem_in_flight + it["mem_bytes"] <= budget
+                if fits or not running:
+                    running[pool.submit(func, it)] = it
+                    mem_in_flight += it["mem_bytes"]
+                    pending.pop(i)
+                else:
+                    i += 1
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                it = running.pop(fut)
+                mem_in_flight -= it["mem_bytes"]
+                pbar.update(it["bytes"])
+                remaining = total_bytes - pbar.n
+                pbar.set_postfix(remaining=f"{remaining / 1024**2:.0f}MB")
+                yield it, fut.result()
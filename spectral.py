@@ -0,0 +1,228 @@
+import os
+import glob
+import logging
+import argparse
+from collections import Counter
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from scipy import fft, signal
+from concurrent.futures import ProcessPoolExecutor
+from edf_reader import EdfMemmap
+from derivative_store import scaling_to_uv
+from catalog import Catalog, default_catalog_path, BAND_POWER_COLUMNS
+
+SPECTRAL_DIR = os.path.join("derivatives", "spectral")
+BANDS = {
+    "delta": (1.0, 4.0),
+    "theta": (4.0, 8.0),
+    "alpha": (8.0, 13.0),
+    "beta": (13.0, 30.0),
+    "gamma": (30.0, 45.0),   # dừng ở 45 Hz để không lẫn nhiễu điện lưới 50 Hz
+}
+TOTAL_BAND = (1.0, 45.0)
+ALPHA_PEAK_RANGE = (7.0, 14.0)
+PSD_FMAX = 100.0        # PSD lưu trong catalog chỉ tới 100 Hz (hoặc Nyquist)
+
+
+class WelchAccumulator:
+    """
+    Welch PSD (Hann, overlap 50%, trừ trung bình từng đoạn, density uV^2/Hz như scipy.signal.welch) tích lũy theo block:
+    mọi đoạn của mọi kênh trong block được FFT trong một lần gọi (sliding_window_view, không copy khi cắt đoạn),
+    phần đuôi chưa đủ một đoạn được giữ lại cho block sau nên kết quả không phụ thuộc cách chia block.
+    """
+
+    def __init__(self, n_channels, sfreq, segment_seconds=2.0, overlap=0.5):
+        self.sfreq = sfreq
+        self.nperseg = max(2, int(round(segment_seconds * sfreq)))
+        self.step = max(1, int(round(self.nperseg * (1 - overlap))))
+        self.window = signal.get_window("hann", self.nperseg).astype(np.float32)
+        self.power = np.zeros((n_channels, self.nperseg // 2 + 1))
+        self.n_segments = 0
+        self.tail = np.zeros((n_channels, 0), dtype=np.float32)
+
+    @property
+    def freqs(self):
+        return fft.rfftfreq(self.nperseg, 1.0 / self.sfreq)
+
+    def update(self, x):
+        data = np.concatenate([self.tail, x.astype(np.float32, copy=False)], axis=1)
+        n_seg = (data.shape[1] - self.nperseg) // self.step + 1 if data.shape[1] >= self.nperseg else 0
+        if n_seg:
+            segs = np.lib.stride_tricks.sliding_window_view(data, self.nperseg, axis=1)[:, ::self.step][:, :n_seg]
+            segs = (segs - segs.mean(axis=2, keepdims=True)) * self.window
+            self.power += (np.abs(fft.rfft(segs, axis=2)) ** 2).sum(axis=1)
+            self.n_segments += n_seg
+        self.tail = data[:, n_seg * self.step:]
+
+    def psd(self):
+        if not self.n_segments:
+            return np.full(self.power.shape, np.nan)
+        psd = self.power / (self.n_segments * self.sfreq * (self.window.astype(np.float64) ** 2).sum())
+        last = -1 if self.nperseg % 2 == 0 else None   # bin Nyquist (nperseg chẵn) không nhân đôi
+        psd[:, 1:last] *= 2
+        return psd
+
+
+def band_features(freqs, psd):
+    """Band power tuyệt đối (uV^2), tổng 1..45 Hz, đỉnh alpha và spectral edge 95% cho mỗi hàng của psd."""
+    df = freqs[1] - freqs[0]
+    out = {}
+    for name, (lo, hi) in {**BANDS, "total_power": TOTAL_BAND}.items():
+        mask = (freqs >= lo) & (freqs < hi)
+        out[name] = psd[:, mask].sum(axis=1) * df if hi <= freqs[-1] else np.full(len(psd), np.nan)
+    mask = (freqs >= ALPHA_PEAK_RANGE[0]) & (freqs <= ALPHA_PEAK_RANGE[1])
+    out["peak_alpha_freq"] = freqs[mask][np.argmax(psd[:, mask], axis=1)] if mask.any() else np.full(len(psd), np.nan)
+    mask = (freqs >= TOTAL_BAND[0]) & (freqs < TOTAL_BAND[1])
+    cum = np.cumsum(psd[:, mask], axis=1)
+    edge = np.argmax(cum >= 0.95 * cum[:, -1:], axis=1) if mask.any() else None
+    out["spectral_edge_95"] = freqs[mask][edge] if edge is not None else np.full(len(psd), np.nan)
+    return out
+
+
+def recording_band_power(edf_path, segment_seconds=2.0, block_seconds=60):
+    """Welch PSD + band features của mọi kênh (uV) trong một recording, đọc theo block qua memmap."""
+    rows = []
+    with EdfMemmap(edf_path) as reader:
+        if not reader.n_channels:
+            raise ValueError("No signal channels")
+        gain, offset = scaling_to_uv(reader, list(range(reader.n_channels)))
+        for spr in sorted(set(reader.samples_per_record.tolist())):
+            idx = [k for k in range(reader.n_channels) if reader.samples_per_record[k] == spr]
+            sfreq = float(reader.sfreqs[idx[0]])
+            acc = WelchAccumulator(len(idx), sfreq, segment_seconds)
+            g, o = gain[idx, None].astype(np.float32), offset[idx, None].astype(np.float32)
+            block = max(acc.nperseg, int(block_seconds * sfreq))
+            n_samples = reader.n_records * spr
+            for start in range(0, n_samples, block):
+                acc.update(reader.digital(idx, start, min(start + block, n_samples)) * g + o)
+            freqs, psd = acc.freqs, acc.psd()
+            features = band_features(freqs, psd)
+            keep = freqs <= PSD_FMAX
+            for row, k in enumerate(idx):
+                rows.append({
+                    "channel": reader.labels[k].strip(),
+                    "sfreq": sfreq,
+                    **{name: float(values[row]) for name, values in features.items()},
+                    "psd_step": float(freqs[1]),
+                    "psd": psd[row, keep].astype("<f4").tobytes(),
+                })
+    return rows
+
+
+def _spectral_item(item):
+    bids_dir, bids_path, segment_seconds, block_seconds = item
+    try:
+        rows = recording_band_power(os.path.join(bids_dir, bids_path), segment_seconds, block_seconds)
+        return bids_path, rows, None
+    except (OSError, ValueError) as e:
+        return bids_path, None, str(e)
+
+
+def compute_band_power(bids_dir, catalog, segment_seconds=2.0, block_seconds=60, workers=1, refresh=False):
+    """Tính phổ cho các run chưa có trong bảng band_power (song song theo recording), ghi vào catalog."""
+    edf_files = glob.glob(os.path.join(bids_dir, "sub-*", "**", "*_eeg.edf"), recursive=True)
+    runs = sorted(os.path.relpath(f, bids_dir) for f in edf_files)
+    done = set() if refresh else catalog.band_power_recordings()
+    items = [(bids_dir, p, segment_seconds, block_seconds) for p in runs if p not in done]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = tqdm(pool.map(_spectral_item, items), total=len(items), desc="Welch PSD")
+            failed = _store_results(catalog, results)
+    else:
+        failed = _store_results(catalog, (_spectral_item(it) for it in tqdm(items, desc="Welch PSD")))
+    return len(items) - len(failed), failed
+
+
+def _store_results(catalog, results):
+    failed = []
+    for bids_path, rows, error in results:
+        if error:
+            failed.append({"failed_file": bids_path, "reason": error})
+            logging.warning(f"Welch PSD failed for {bids_path}: {error}")
+        else:
+            catalog.set_band_power(bids_path, rows)
+    return failed
+
+
+def load_band_power(catalog, channels=None, relative=False):
+    """
+    Bảng feature toàn corpus (một dòng / run x kênh, float32) đọc thẳng từ catalog, không chạm tín hiệu.
+    relative=True: band power chia cho total_power.
+    """
+    columns = [c for c in BAND_POWER_COLUMNS if c not in ("psd", "psd_step", "updated")]
+    df = pd.DataFrame(catalog.band_power_rows(columns, channels), columns=columns)
+    numeric = columns[2:]
+    df[numeric] = df[numeric].astype(np.float32)
+    if relative:
+        for band in BANDS:
+            df[band] = df[band] / df["total_power"]
+    return df
+
+
+def load_psd(catalog, channels=None):
+    """(freqs, DataFrame bids_path / channel, mảng PSD float32 run x freqs) cho các kênh cùng lưới tần số."""
+    rows = catalog.band_power_rows(["bids_path", "channel", "psd_step", "psd"], channels)
+    if not rows:
+        return np.zeros(0), pd.DataFrame(columns=["bids_path", "channel"]), np.zeros((0, 0), dtype=np.float32)
+    step = Counter(r[2] for r in rows).most_common(1)[0][0]
+    rows = [r for r in rows if r[2] == step]
+    psds = [np.frombuffer(r[3], dtype="<f4") for r in rows]
+    n = min(len(p) for p in psds)
+    index = pd.DataFrame([r[:2] for r in rows], columns=["bids_path", "channel"])
+    return np.arange(n) * step, index, np.stack([p[:n] for p in psds])
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Welch PSD + band power theo kênh cho mọi run, lưu vào catalog")
+    parser.add_argument(
+        "--bids_dir",
+        type=str,
+        required=True,
+        help="BIDS database directory"
+    )
+    parser.add_argument(
+        "--catalog",
+        type=str,
+        default=None,
+        help="SQLite catalog (mặc định: <bids_dir>/derivatives/catalog.sqlite)"
+    )
+    parser.add_argument(
+        "--segment_seconds",
+        type=float,
+        default=2.0,
+        help="Độ dài một đoạn Welch (giây), quyết định độ phân giải tần số"
+    )
+    parser.add_argument(
+        "--block_seconds",
+        type=float,
+        default=60,
+        help="Độ dài block đọc mỗi lần (giây)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Số process song song"
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Tính lại cả các recording đã có trong catalog"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    args = get_args()
+    catalog = Catalog(args.catalog or default_catalog_path(args.bids_dir))
+    n_runs, failed = compute_band_power(args.bids_dir, catalog, args.segment_seconds, args.block_seconds,
+                                        args.workers, args.refresh)
+    out_dir = os.path.join(args.bids_dir, SPECTRAL_DIR)
+    os.makedirs(out_dir, exist_ok=True)
+    load_band_power(catalog).to_csv(os.path.join(out_dir, "band_power.tsv"), sep="\t", index=False,
+                                    na_rep="n/a", float_format="%.6g")
+    print(f"Band power computed for {n_runs} new runs ({len(failed)} failed). Table: "
+          f"{os.path.join(out_dir, 'band_power.tsv')}")
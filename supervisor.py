@@ -0,0 +1,114 @@
+import time
+import resource
+import logging
+import multiprocessing as mp
+
+# fork: process con dùng lại các module đã import (mne, pyedflib) nên khởi động gần như tức thì
+_ctx = mp.get_context("fork")
+
+
+def _read_rss_bytes(pid):
+    """RSS hiện tại của process (đọc /proc, không cần psutil). Trả về None nếu không đọc được."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _child(conn, func, args, kwargs):
+    try:
+        result = func(*args, **kwargs)
+        status, payload = "ok", result
+    except MemoryError:
+        status, payload = "error", "MemoryError"
+    except Exception as e:
+        status, payload = "error", f"{type(e).__name__}: {e}"
+    # ru_maxrss trên Linux tính bằng KB
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    try:
+        conn.send((status, payload, peak_rss))
+    except Exception as e:
+        conn.send(("error", f"Result not picklable: {e}", peak_rss))
+    conn.close()
+
+
+def run_isolated(func, *args, timeout=None, max_rss_mb=None, poll_interval=0.2, **kwargs):
+    """
+    Chạy func(*args, **kwargs) trong process con có giám sát.
+    - Quá timeout (giây) hoặc RSS vượt max_rss_mb -> kill process con.
+    - Exception trong func không làm chết tiến trình cha.
+    Trả về dict: ok (bool), result, reason (None nếu ok), peak_rss_mb, elapsed.
+    """
+    parent_conn, child_conn = _ctx.Pipe(duplex=False)
+    proc = _ctx.Process(target=_child, args=(child_conn, func, args, kwargs), daemon=True)
+    start = time.monotonic()
+    proc.start()
+    child_conn.close()
+
+    max_rss_bytes = max_rss_mb * 1024 * 1024 if max_rss_mb else None
+    peak_seen = 0
+    reason = None
+    message = None
+    while True:
+        if parent_conn.poll(poll_interval):
+            try:
+                message = parent_conn.recv()
+            except EOFError:
+                message = None
+            break
+        elapsed = time.monotonic() - start
+        if not proc.is_alive():
+            # con có thể đã gửi kết quả rồi thoát ngay sau lần poll trên: đọc lại một lần trước khi coi là chết
+            if parent_conn.poll(0):
+                try:
+                    message = parent_conn.recv()
+                except EOFError:
+                    message = None
+            break
+        if timeout is not None and elapsed > timeout:
+            reason = f"Timeout: exceeded {timeout:g} s wall-clock limit"
+            break
+        rss = _read_rss_bytes(proc.pid)
+        if rss is not None:
+            peak_seen = max(peak_seen, rss)
+            if max_rss_bytes and rss > max_rss_bytes:
+                reason = f"Memory: RSS {rss / 1024**2:.0f} MB exceeds {max_rss_mb:g} MB limit"
+                break
+
+    if reason is not None:
+        proc.kill()
+        logging.warning(f"Killed isolated worker for {getattr(func, '__name__', func)}{args}: {reason}")
+    proc.join()
+    parent_conn.close()
+    elapsed = time.monotonic() - start
+
+    if reason is None and message is None:
+        reason = f"Worker died (exit code {proc.exitcode})"
+    if reason is not None:
+        return {"ok": False, "result": None, "reason": reason,
+                "peak_rss_mb": peak_seen / 1024**2, "elapsed": elapsed}
+
+    status, payload, peak_rss = message
+    peak_rss_mb = max(peak_rss, peak_seen) / 1024**2
+    if status != "ok":
+        return {"ok": False, "result": None, "reason": payload, "peak_rss_mb": peak_rss_mb, "elapsed": elapsed}
+    return {"ok": True, "result": payload, "reason": None, "peak_rss_mb": peak_rss_mb, "elapsed": elapsed}
+
+
+def run_maybe_isolated(func, *args, timeout=None, max_rss_mb=None, **kwargs):
+    """Như run_isolated, nhưng chạy thẳng trong process hiện tại khi không đặt giới hạn nào."""
+    if timeout is None and max_rss_mb is None:
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            return {"ok": False, "result": None, "reason": f"{type(e).__name__}: {e}",
+                    "peak_rss_mb": None, "elapsed": time.monotonic() - start}
+        return {"ok": True, "result": result, "reason": None,
+                "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                "elapsed": time.monotonic() - start}
+    return run_isolated(func, *args, timeout=timeout, max_rss_mb=max_rss_mb, **kwargs)
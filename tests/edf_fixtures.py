@@ -0,0 +1,18 @@
+import datetime
+
+import numpy as np
+import pyedflib
+
+
+def write_edfplus(path, patient_name, annotations, n_signals=2, seconds=10, sfreq=100):
+    writer = pyedflib.EdfWriter(str(path), n_signals, file_type=pyedflib.FILETYPE_EDFPLUS)
+    writer.setHeader({"patientname": patient_name, "technician": "", "recording_additional": "",
+                      "patient_additional": "", "patientcode": "", "equipment": "", "admincode": "",
+                      "sex": "", "birthdate": "", "startdate": datetime.datetime(2025, 1, 1)})
+    writer.setSignalHeaders([{"label": f"C{i}", "dimension": "uV", "sample_frequency": sfreq,
+                              "physical_min": -100, "physical_max": 100, "digital_min": -32768,
+                              "digital_max": 32767, "transducer": "", "prefilter": ""} for i in range(n_signals)])
+    writer.writeSamples(list(np.random.RandomState(0).randn(n_signals, seconds * sfreq) * 10))
+    for onset, text in annotations:
+        writer.writeAnnotation(onset, -1, text)
+    writer.close()
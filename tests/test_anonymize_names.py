@@ -0,0 +1,54 @@
+import pytest
+
+pyedflib = pytest.importorskip("pyedflib")
+
+import anonymize
+from edf_annotations import read_annotations
+from identity_index import parse_patient_field, parse_patient_name
+from memory_governor import PATH_PASSTHROUGH, PATH_HEADER_ONLY
+from phi import build_name_automaton
+from edf_fixtures import write_edfplus
+
+
+def test_parse_patient_name_decoded():
+    # pyedflib trả tên đã decode: parse_patient_field coi 4 token là trường EDF+ và mất tên
+    assert parse_patient_field("LE THI MINH 1980") == ("", "1980")
+    assert parse_patient_name("LE THI MINH 1980") == ("LE THI MINH", "1980")
+    assert parse_patient_name("X X X LE_THI_MINH_1980") == ("LE THI MINH", "1980")
+    assert parse_patient_name("NGUYEN_VAN_AN_1965") == ("NGUYEN VAN AN", "1965")
+
+
+@pytest.mark.parametrize("path, decode_fallback", [(PATH_PASSTHROUGH, True), (PATH_PASSTHROUGH, False),
+                                                   (PATH_HEADER_ONLY, False)])
+def test_own_header_name_scrubbed_from_annotations(tmp_path, path, decode_fallback):
+    src = tmp_path / "src.edf"
+    out = tmp_path / "out.edf"
+    write_edfplus(src, "LE_THI_MINH_1980", [(2.0, "bn Lê Thị Minh ngủ"), (3.0, "eyes open")])
+
+    # sheet không có tên này: chỉ tên trong header của chính file được dùng
+    _, success, _ = anonymize.anonymize_one(str(src), str(out), "sub-0001", path, build_name_automaton([]),
+                                            decode_fallback)
+
+    assert success
+    texts = list(read_annotations(str(out))["trial_type"])
+    assert "eyes open" in texts
+    assert not any("Minh" in t or "MINH" in t for t in texts)
+    assert any("XXX" in t for t in texts)
+
+
+def test_failed_scrub_removes_output(tmp_path, monkeypatch):
+    src = tmp_path / "src.edf"
+    out = tmp_path / "out.edf"
+    write_edfplus(src, "LE_THI_MINH_1980", [(2.0, "bn Lê Thị Minh ngủ")])
+
+    def broken_scrub(path, automatons):
+        raise ValueError("bad TAL")
+
+    monkeypatch.setattr(anonymize, "scrub_annotations", broken_scrub)
+    _, success, reason = anonymize.anonymize_one(str(src), str(out), "sub-0001", PATH_PASSTHROUGH,
+                                                 build_name_automaton([]))
+
+    assert not success
+    assert reason.startswith(anonymize.SCRUB_FAILED)
+    assert not out.exists()  # header đã vá nhưng annotation còn tên: không để lại file trông như đã anonymize
+    assert src.exists()
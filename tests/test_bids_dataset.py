@@ -0,0 +1,47 @@
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyedflib")
+
+import bids_dataset
+from bids_dataset import BidsWindowDataset
+from edf_fixtures import write_edfplus
+
+
+@pytest.fixture
+def bids_dir(tmp_path):
+    for sub in ("sub-0001", "sub-0002", "sub-0003"):
+        os.makedirs(tmp_path / sub / "eeg")
+        write_edfplus(tmp_path / sub / "eeg" / f"{sub}_task-rest_run-001_eeg.edf", "X", [], seconds=20)
+    return tmp_path
+
+
+def make_dataset(bids_dir, **kwargs):
+    runs = pd.DataFrame({"bids_path": [f"sub-000{i}/eeg/sub-000{i}_task-rest_run-001_eeg.edf" for i in (1, 2, 3)]})
+    return BidsWindowDataset(str(bids_dir), runs=runs, window_seconds=2.0, block_seconds=4.0, **kwargs)
+
+
+def test_windows_interleaved_across_runs(bids_dir):
+    windows = [(meta["bids_path"], meta["start"]) for _, meta in make_dataset(bids_dir, interleave=3)]
+    assert len(windows) == 3 * 10
+    assert sorted(windows) == sorted(set(windows))
+    assert len({path for path, _ in windows[:3]}) == 3  # các run được trộn, không đọc hết run này mới sang run khác
+
+
+def test_caches_reused_across_epochs(bids_dir, monkeypatch):
+    opened = []
+    real = bids_dataset.EdfMemmap
+
+    def counting(path):
+        opened.append(path)
+        return real(path)
+
+    monkeypatch.setattr(bids_dataset, "EdfMemmap", counting)
+    dataset = make_dataset(bids_dir, shuffle=True)
+    for epoch in range(3):
+        dataset.set_epoch(epoch)
+        assert len(list(dataset)) == 30
+    assert len(opened) == 3  # mỗi EDF mở một lần cho cả 3 epoch
+    dataset.close()
@@ -0,0 +1,47 @@
+import pytest
+
+pytest.importorskip("pyedflib")
+
+from anonymize import passthrough_edf
+from edf_header import read_edf_header
+from edf_writer import MAIN_FIELD_POS, copy_edf_records
+from edf_fixtures import write_edfplus
+
+IDENTITY_BYTES = range(MAIN_FIELD_POS["patient"][0], MAIN_FIELD_POS["recording"][0] + MAIN_FIELD_POS["recording"][1])
+
+
+def changed_header_bytes(a, b):
+    return [i for i in range(len(a)) if a[i] != b[i]]
+
+
+@pytest.mark.parametrize("block_bytes", [1, 4096, 32 * 1024 * 1024])
+def test_copy_edf_records_bit_exact(tmp_path, block_bytes):
+    src, out = tmp_path / "src.edf", tmp_path / "out.edf"
+    write_edfplus(src, "LE_THI_MINH_1980", [(2.0, "eyes open")], n_signals=3, seconds=30)
+
+    n_records = copy_edf_records(str(src), str(out), block_bytes, patient="sub-0001 X X sub-0001",
+                                 recording="Startdate 01-JAN-2025 X X X")
+
+    header = read_edf_header(str(src))
+    a, b = src.read_bytes(), out.read_bytes()
+    assert n_records == header["n_records"]
+    assert len(a) == len(b)
+    offset = header["data_offset"]
+    assert a[offset:] == b[offset:]  # data record (kể cả kênh annotation) giữ nguyên từng byte
+    assert set(changed_header_bytes(a[:offset], b[:offset])) <= set(IDENTITY_BYTES)
+    assert b"LE_THI_MINH" not in b[:offset]
+
+
+def test_passthrough_edf_only_identity_fields_change(tmp_path):
+    src, out = tmp_path / "src.edf", tmp_path / "out.edf"
+    write_edfplus(src, "LE_THI_MINH_1980", [], seconds=12)
+
+    passthrough_edf(str(src), str(out), "sub-0001", block_bytes=1000)
+
+    a, b = src.read_bytes(), out.read_bytes()
+    offset = read_edf_header(str(src))["data_offset"]
+    assert a[offset:] == b[offset:]
+    assert set(changed_header_bytes(a[:offset], b[:offset])) <= set(IDENTITY_BYTES)
+    out_header = read_edf_header(str(out))
+    assert out_header["patient"].startswith("sub-0001")
+    assert out_header["recording"].startswith("Startdate")
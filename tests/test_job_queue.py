@@ -0,0 +1,88 @@
+import os
+import time
+import types
+
+from job_queue import JobQueue
+
+
+def expire():
+    time.sleep(0.02)
+
+
+def test_enqueue_is_idempotent(tmp_path):
+    queue = JobQueue(str(tmp_path / "q.sqlite"))
+    assert queue.enqueue("a", {"n": 1})
+    assert not queue.enqueue("a", {"n": 2})
+    assert queue.payloads() == {"a": {"n": 1}}
+
+
+def test_expired_lease_reclaimed_by_other_worker(tmp_path):
+    db = str(tmp_path / "q.sqlite")
+    q1, q2 = JobQueue(db), JobQueue(db)
+    q1.enqueue("a", {"n": 1})
+    job_id, _ = q1.claim("w1", lease_seconds=0)
+    expire()
+
+    claimed = q2.claim("w2", lease_seconds=60)
+    assert claimed is not None and claimed[0] == job_id
+    # w1 mất lease: heartbeat và complete của w1 bị từ chối, kết quả của w2 được giữ
+    assert not q1.heartbeat(job_id, "w1", 60)
+    assert not q1.complete(job_id, "w1", {"by": "w1"})
+    assert q2.complete(job_id, "w2", {"by": "w2"})
+    assert q1.results() == [({"n": 1}, {"by": "w2"})]
+
+
+def test_heartbeat_keeps_lease(tmp_path):
+    db = str(tmp_path / "q.sqlite")
+    q1, q2 = JobQueue(db), JobQueue(db)
+    q1.enqueue("a", {"n": 1})
+    job_id, _ = q1.claim("w1", lease_seconds=0)
+    assert q1.heartbeat(job_id, "w1", 60)
+    expire()
+    assert q2.claim("w2", lease_seconds=60) is None
+    assert q1.counts() == {"leased": 1}
+
+
+def test_max_attempts_cutoff(tmp_path):
+    db = str(tmp_path / "q.sqlite")
+    q1, q2 = JobQueue(db, max_attempts=2), JobQueue(db, max_attempts=2)
+    q1.enqueue("a", {"n": 1})
+    job_id, _ = q1.claim("w1", lease_seconds=0)
+    expire()
+    assert q2.claim("w2", lease_seconds=0)[0] == job_id  # lần thử thứ 2
+    expire()
+    assert q1.claim("w1", lease_seconds=60) is None  # hết lượt: failed, không trả lại hàng đợi
+    assert q1.counts() == {"failed": 1}
+    assert q2.unfinished() == 0
+
+
+def test_fail_retries_until_max_attempts(tmp_path):
+    queue = JobQueue(str(tmp_path / "q.sqlite"), max_attempts=2)
+    queue.enqueue("a", {"n": 1})
+    job_id, _ = queue.claim("w1", 60)
+    queue.fail(job_id, "w1", "boom")
+    assert queue.counts() == {"pending": 1}
+    job_id, _ = queue.claim("w1", 60)
+    queue.fail(job_id, "w1", "boom")
+    assert queue.failed_jobs() == [({"n": 1}, "boom")]
+
+
+def test_reenqueue_reserves_queued_sub_ids(tmp_path):
+    import with_test_main_create_bids as create
+
+    src, bids = tmp_path / "src", tmp_path / "bids"
+    for folder in ("a", "b"):
+        os.makedirs(src / folder)
+        (src / folder / "x.edf").write_bytes(b"0" * 10)
+    args = types.SimpleNamespace(bids_dir=str(bids), edf_dir=str(src), queue_db=None, input_format="edf",
+                                 dedup=False, identity=False, dedup_db=None)
+    create.enqueue_bids(args)
+    # job chưa chạy nên chưa có thư mục sub-*; folder mới vẫn không được cấp lại sub-id đã giao
+    os.makedirs(src / "c")
+    (src / "c" / "y.edf").write_bytes(b"0" * 10)
+    create.enqueue_bids(args)
+
+    payloads = JobQueue(create.queue_db_path(args)).payloads()
+    sub_ids = {os.path.basename(folder): p["sub_id"] for folder, p in payloads.items()}
+    assert sorted(sub_ids.values()) == ["0001", "0002", "0003"]
+    assert sub_ids["c"] == "0003"
@@ -0,0 +1,21 @@
+import os
+
+import qc
+from catalog import Catalog
+
+BIDS_PATH = os.path.join("sub-0001", "eeg", "sub-0001_task-rest_run-001_eeg.edf")
+
+
+def test_unreadable_run_clears_old_metrics_and_is_retried(tmp_path):
+    os.makedirs(tmp_path / "sub-0001" / "eeg")
+    (tmp_path / BIDS_PATH).write_bytes(b"garbage")
+    catalog = Catalog(str(tmp_path / "catalog.sqlite"))
+    catalog.upsert_qc(BIDS_PATH, status="pass", duration=10.0, n_channels=2, flat_fraction=0.1)
+
+    n_runs, failed = qc.run_qc(str(tmp_path), catalog, refresh=True)
+
+    assert n_runs == 0 and len(failed) == 1
+    row = dict(zip(qc.QC_COLUMNS, catalog.qc_rows()[0]))
+    assert row["status"] == "unreadable"
+    assert all(row[c] is None for c in qc.QC_METRICS)
+    assert BIDS_PATH not in catalog.qc_recordings(exclude=("unreadable",))
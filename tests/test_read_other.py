@@ -0,0 +1,17 @@
+import pytest
+
+from utils.read_other import parse_sidecar
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Patient: NGUYEN VAN A DOC_NO: 12345 Sex: Male\n",
+     {"PATIENT_NAME": "NGUYEN VAN A", "DOC_NO": "12345", "GENDER": "Male"}),
+    ("Patient: LE THI MINH\nDOC_NO=123\nsex: nữ BIRTH_DATE: 01/02/1980\n",
+     {"PATIENT_NAME": "LE THI MINH", "DOC_NO": "123", "GENDER": "nữ", "BIRTH_DATE": "01/02/1980"}),
+    ("Patient: TRAN VAN B   \n", {"PATIENT_NAME": "TRAN VAN B"}),
+])
+def test_parse_sidecar_fields(tmp_path, text, expected):
+    path = tmp_path / "FA5550A0.log"
+    path.write_text(text, encoding="utf-8")
+    meta = parse_sidecar(str(path))
+    assert {k: v for k, v in meta.items() if k not in ("file", "stem")} == expected
@@ -0,0 +1,33 @@
+import math
+
+import pandas as pd
+import pytest
+
+from utils.read_test_name import classify_result, classify_results
+
+VALUES = ["4,2", "1,000", "150,000", "1e5", "2.5E-3", "4.82 mmol/L", "< 4,5 mmol/L", "12", "-.5",
+          "Negative", "TIRADS 3", "1,2,3", None]
+
+
+def test_result_type_matches_classify_result():
+    out = classify_results(pd.Series(VALUES))
+    assert list(out["Result_Type"]) == [classify_result(v) for v in VALUES]
+
+
+@pytest.mark.parametrize("result, value, unit", [
+    ("4,2", 4.2, None),
+    ("1,000", None, None),
+    ("150,000", None, None),
+    ("1e5", 1e5, None),
+    ("2.5E-3", 2.5e-3, None),
+    ("< 4,5 mmol/L", 4.5, "mmol/L"),
+    ("2e9/L", 2e9, "/L"),
+    ("Negative", None, None),
+])
+def test_result_value_and_unit(result, value, unit):
+    row = classify_results(pd.Series([result])).iloc[0]
+    if value is None:
+        assert math.isnan(row["Result_Value"])
+    else:
+        assert row["Result_Value"] == pytest.approx(value)
+    assert (row["Result_Unit"] if isinstance(row["Result_Unit"], str) else None) == unit
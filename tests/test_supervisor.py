@@ -0,0 +1,39 @@
+import time
+
+import supervisor
+from supervisor import run_isolated
+
+
+def _value(x):
+    return x * 2
+
+
+def test_result_sent_just_before_exit_is_not_lost(monkeypatch):
+    # poll(interval) luôn báo "chưa có gì" cho tới khi con đã thoát: đúng khe race giữa poll và is_alive
+    real_pipe = supervisor._ctx.Pipe
+
+    def pipe(duplex=False):
+        parent, child = real_pipe(duplex=duplex)
+
+        class LatePoll:
+            def poll(self, timeout=0):
+                if timeout:
+                    time.sleep(timeout)
+                    return False
+                return parent.poll(0)
+
+            def __getattr__(self, name):
+                return getattr(parent, name)
+
+        return LatePoll(), child
+
+    monkeypatch.setattr(supervisor._ctx, "Pipe", pipe)
+    outcome = run_isolated(_value, 21, poll_interval=0.05)
+    assert outcome["ok"], outcome["reason"]
+    assert outcome["result"] == 42
+
+
+def test_exception_reported():
+    outcome = run_isolated(int, "x")
+    assert not outcome["ok"]
+    assert outcome["reason"].startswith("ValueError")
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+pytest.importorskip("pyedflib")
+lmdb = pytest.importorskip("lmdb")
+
+import window_store
+from edf_fixtures import write_edfplus
+
+BIDS_PATH = os.path.join("sub-0001", "eeg", "sub-0001_task-rest_run-001_eeg.edf")
+
+
+def window_keys(bids_dir):
+    env = lmdb.open(os.path.join(bids_dir, window_store.STORE_DIR, "windows.lmdb"), readonly=True, lock=False)
+    try:
+        with env.begin() as txn:
+            return [key for key, _ in txn.cursor() if not key.startswith(b"__")]
+    finally:
+        env.close()
+
+
+def test_rerun_with_other_options_rewrites_and_drops_stale_windows(tmp_path):
+    os.makedirs(tmp_path / "sub-0001" / "eeg")
+    write_edfplus(tmp_path / BIDS_PATH, "X", [], seconds=60)
+    options = {"target_sfreq": 100.0, "l_freq": 0.3, "h_freq": 40.0, "window_seconds": 5.0, "channels": None,
+               "segment_windows": 4, "map_size_gb": 1}
+
+    assert window_store.build_window_store(str(tmp_path), options)[0] == 1
+    assert len(window_keys(tmp_path)) == 12
+    assert window_store.build_window_store(str(tmp_path), options)[0] == 0  # cùng option: resume bỏ qua
+
+    options["window_seconds"] = 10.0
+    assert window_store.build_window_store(str(tmp_path), options)[0] == 1
+    assert len(window_keys(tmp_path)) == 6
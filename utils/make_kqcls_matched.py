@@ -5,6 +5,7 @@ import unidecode
 import os
 import glob
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
 # === Function to extract EDF metadata ===
 def extract_edf_metadata(edf_file):
@@ -23,6 +24,119 @@ def extract_edf_metadata(edf_file):
         print(f"Error reading EDF file {edf_file}: {e}")
         return None, None
 
+# === Batch mode: harvest raw headers, no MNE ===
+def read_patient_field(edf_file):
+    """Trường patient (byte 8-88 của header EDF), đọc thẳng bằng Python, không mở file bằng MNE."""
+    try:
+        with open(edf_file, "rb") as f:
+            header = f.read(88)
+        if len(header) < 88 or header[:8].strip() != b"0":
+            return None
+        return header[8:88].decode("latin-1").strip()
+    except OSError as e:
+        print(f"Error reading EDF file {edf_file}: {e}")
+        return None
+
+
+def harvest_headers(edf_files, n_threads=16):
+    """Đọc header của mọi file song song (I/O bound) vào một DataFrame (file, patient)."""
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        patients = list(tqdm(pool.map(read_patient_field, edf_files), total=len(edf_files), desc="Reading EDF headers"))
+    return pd.DataFrame({"file": edf_files, "patient": patients})
+
+
+def split_names(headers):
+    """
+    Tách tên + đuôi năm sinh cho cả bảng bằng str.extract (cùng regex với extract_edf_metadata).
+    EDF+ lưu "code sex birthdate name" -> lấy token thứ 4 như MNE last_name; EDF thường -> cả trường.
+    """
+    last_name = headers["patient"].str.extract(r'^\S+\s+\S+\s+\S+\s+(\S+)', expand=False)
+    last_name = last_name.fillna(headers["patient"])
+    parts = last_name.str.extract(r'^(.*?)[_]?(\d+)?$')
+    name_only = parts[0].str.replace("_", " ").str.strip()
+    name_only = name_only.mask(name_only.str.upper() == "X")  # 'X' = không có tên theo chuẩn EDF+
+    # unidecode chỉ chạy một lần cho mỗi tên khác nhau
+    unique_names = name_only.dropna().unique()
+    std_map = dict(zip(unique_names, (unidecode.unidecode(n).upper() for n in unique_names)))
+    return headers.assign(EDF_NAME_STD=name_only.map(std_map), BIRTH_SUFFIX=parts[1])
+
+
+def match_batch(edf_files, aggregated_sheet, sidecars=None):
+    """
+    Khớp toàn bộ file với aggregated_sheet bằng một hash join trên tên chuẩn hóa,
+    lọc theo đuôi năm sinh giống như vòng lặp từng file. Trả về tập DOC_NO đã khớp.
+    sidecars (bảng từ utils/read_other.py: file, DOC_NO, PATIENT_NAME_STD) dùng cho file có header không có tên:
+    DOC_NO trong .log/.CMT khớp trực tiếp, nếu không thì dùng tên trong sidecar.
+    """
+    headers = split_names(harvest_headers(edf_files))
+    sidecar_docs = set()
+    if sidecars is not None:
+        headers = headers.merge(sidecars[["file", "DOC_NO", "PATIENT_NAME_STD"]].rename(
+            columns={"DOC_NO": "SIDECAR_DOC_NO", "PATIENT_NAME_STD": "SIDECAR_NAME_STD"}), on="file", how="left")
+        nameless = headers["EDF_NAME_STD"].isna() | (headers["EDF_NAME_STD"] == "")
+        sheet_docs = dict(zip(aggregated_sheet["DOC_NO"].astype(str), aggregated_sheet["DOC_NO"]))
+        doc_hit = nameless & headers["SIDECAR_DOC_NO"].astype(str).isin(sheet_docs.keys())
+        sidecar_docs = {sheet_docs[d] for d in headers.loc[doc_hit, "SIDECAR_DOC_NO"].astype(str)}
+        fill = nameless & ~doc_hit
+        headers.loc[fill, "EDF_NAME_STD"] = headers.loc[fill, "SIDECAR_NAME_STD"]
+        headers = headers[~doc_hit]
+        print(f"Sidecar metadata: {int(doc_hit.sum())} EDF files matched by DOC_NO, {int(fill.sum())} named from sidecar")
+    headers = headers[headers["EDF_NAME_STD"].notna() & (headers["EDF_NAME_STD"] != "")]
+    sheet = aggregated_sheet.assign(_order=range(len(aggregated_sheet)))
+    joined = headers.reset_index(drop=True).reset_index().merge(
+        sheet, left_on="EDF_NAME_STD", right_on="PATIENT_NAME_STD", how="inner"
+    )
+    if 'BIRTH_YEAR' in sheet.columns and sheet['BIRTH_YEAR'].notnull().any():
+        # Có đuôi năm sinh -> BIRTH_YEAR phải kết thúc bằng đuôi đó; không có -> chỉ khớp theo tên
+        suffix = joined["BIRTH_SUFFIX"]
+        birth_ok = [
+            s != s or (isinstance(y, str) and y.endswith(s))
+            for s, y in zip(suffix, joined["BIRTH_YEAR"])
+        ]
+        joined = joined[birth_ok]
+    # Mỗi file lấy dòng khớp đầu tiên như matched_row.iloc[0]
+    first = joined.sort_values(["index", "_order"]).drop_duplicates("index")
+    print(f"Matched {len(first)} / {len(edf_files)} EDF files")
+    return set(first["DOC_NO"]) | sidecar_docs
+
+
+def match_per_file(edf_files, aggregated_sheet):
+    """Cách cũ: mở từng file bằng MNE và lọc aggregated_sheet cho từng file."""
+    matched_doc_nos = set()
+
+    # Process each EDF file with progress bar
+    for edf_file in tqdm(edf_files, desc="Processing EDF files"):
+        print(f"Processing {edf_file}...")
+
+        # Extract EDF metadata
+        edf_name, edf_birth_suffix = extract_edf_metadata(edf_file)
+        if edf_name is None:
+            continue  # Skip if EDF file couldn't be read
+        edf_name_std = unidecode.unidecode(edf_name).upper()
+
+        # Match EDF with aggregated sheet
+        if edf_name_std and edf_birth_suffix and 'BIRTH_YEAR' in aggregated_sheet.columns and aggregated_sheet['BIRTH_YEAR'].notnull().any():
+            # Match with both name and birth year suffix
+            matched_row = aggregated_sheet[
+                (aggregated_sheet['PATIENT_NAME_STD'] == edf_name_std) &
+                (aggregated_sheet['BIRTH_YEAR'].str.endswith(str(edf_birth_suffix), na=False))
+            ]
+        else:
+            # Match with name only if birth year is unavailable
+            matched_row = aggregated_sheet[
+                (aggregated_sheet['PATIENT_NAME_STD'] == edf_name_std)
+            ]
+
+        if not matched_row.empty:
+            print("Matched patient:")
+            print(matched_row.iloc[0])
+
+            # Collect matched DOC_NO (unique per patient)
+            matched_doc_nos.add(matched_row['DOC_NO'].iloc[0])
+        else:
+            print("No match found for EDF:", edf_file)
+    return matched_doc_nos
+
 # === Function to extract birth year suffix ===
 def extract_birth_year_suffix(birth_date):
     try:
@@ -37,7 +151,10 @@ clinical_sheet_original = pd.read_excel("/mnt/disk1/aiotlab/hieupc/New_CBraMod/B
 clinical_sheet = clinical_sheet_original.copy()  # Work on copy for processing
 
 # Standardize names
-clinical_sheet['PATIENT_NAME_STD'] = clinical_sheet['PATIENT_NAME'].apply(lambda x: unidecode.unidecode(str(x)).upper())
+unique_sheet_names = clinical_sheet['PATIENT_NAME'].astype(str).unique()
+clinical_sheet['PATIENT_NAME_STD'] = clinical_sheet['PATIENT_NAME'].astype(str).map(
+    dict(zip(unique_sheet_names, (unidecode.unidecode(n).upper() for n in unique_sheet_names)))
+)
 
 # Try to create BIRTH_YEAR if BIRTH_DATE exists
 if 'BIRTH_DATE' in clinical_sheet.columns:
@@ -61,42 +178,14 @@ matched_patients_xlsx = "./matched_patients.xlsx"  # Output file for matched pat
 # Get list of all EDF files
 edf_files = glob.glob(os.path.join(edf_dir, "*.edf"))
 
-# List to collect matched DOC_NO
-matched_doc_nos = []
-
-# Process each EDF file with progress bar
-for edf_file in tqdm(edf_files, desc="Processing EDF files"):
-    print(f"Processing {edf_file}...")
-
-    # Extract EDF metadata
-    edf_name, edf_birth_suffix = extract_edf_metadata(edf_file)
-    if edf_name is None:
-        continue  # Skip if EDF file couldn't be read
-    edf_name_std = unidecode.unidecode(edf_name).upper()
-
-    # Match EDF with aggregated sheet
-    if edf_name_std and edf_birth_suffix and 'BIRTH_YEAR' in aggregated_sheet.columns and aggregated_sheet['BIRTH_YEAR'].notnull().any():
-        # Match with both name and birth year suffix
-        matched_row = aggregated_sheet[
-            (aggregated_sheet['PATIENT_NAME_STD'] == edf_name_std) &
-            (aggregated_sheet['BIRTH_YEAR'].str.endswith(str(edf_birth_suffix), na=False))
-        ]
-    else:
-        # Match with name only if birth year is unavailable
-        matched_row = aggregated_sheet[
-            (aggregated_sheet['PATIENT_NAME_STD'] == edf_name_std)
-        ]
+batch_mode = True  # True = đọc header song song + một hash join; False = MNE + lọc từng file như cũ
+sidecar_tsv = None  # vd "./sidecar_metadata.tsv" từ utils/read_other.py: khóa phụ cho EDF có header không tên
 
-    if not matched_row.empty:
-        print("Matched patient:")
-        print(matched_row.iloc[0])
-        
-        # Collect matched DOC_NO (unique per patient)
-        doc_no = matched_row['DOC_NO'].iloc[0]
-        if doc_no not in matched_doc_nos:
-            matched_doc_nos.append(doc_no)
-    else:
-        print("No match found for EDF:", edf_file)
+if batch_mode:
+    sidecars = pd.read_csv(sidecar_tsv, sep="\t", dtype=str) if sidecar_tsv else None
+    matched_doc_nos = match_batch(edf_files, aggregated_sheet, sidecars)
+else:
+    matched_doc_nos = match_per_file(edf_files, aggregated_sheet)
 
 # After processing all files, create new XLSX with original rows of matched patients
 if matched_doc_nos:
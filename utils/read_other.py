@@ -1,6 +1,10 @@
 import os
 import glob
 import re
+import pandas as pd
+import unidecode
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
 
 folder = "/mnt/disk1/aiotlab/hieupc/New_CBraMod/BIDS/EEG2100"
 # log_files = glob.glob(os.path.join(folder, "*.log"))
@@ -33,18 +37,68 @@ def extract_metadata_from_text(file_path):
     return meta
 
 
-# 2️⃣ In nội dung log / cmt
-# text_files = glob.glob(os.path.join(folder, "*.log")) + glob.glob(os.path.join(folder, "*.cmt"))
-text_files = glob.glob(os.path.join(folder, "*.CMT"))
+# Cả 4 trường trong một pattern compile một lần, chạy finditer trên từng dòng (một dòng có thể chứa nhiều
+# trường, vd. "Patient: ... DOC_NO: 123 Sex: Male"); tên dừng trước nhãn trường kế tiếp thay vì nuốt hết dòng.
+# Giá trị xuất hiện sau ghi đè giá trị trước
+SIDECAR_PATTERN = re.compile(
+    r'DOC_NO[:=]\s*(?P<DOC_NO>\d+)'
+    r'|BIRTH_DATE[:=]\s*(?P<BIRTH_DATE>\d{2}/\d{2}/\d{4})'
+    r'|(?i:Sex)[:=]\s*(?P<GENDER>(?i:Male|Female|Nam|Nữ))'
+    r'|Patient[:=]\s*(?P<PATIENT_NAME>.+?)(?=\s+(?:DOC_NO|BIRTH_DATE|(?i:Sex))[:=]|\s*$)'
+)
+SIDECAR_FIELDS = ["DOC_NO", "PATIENT_NAME", "BIRTH_DATE", "GENDER"]
 
-print("\n=== LOG / CMT FILES ===")
-for f in text_files:
-    print(f"\n--- {os.path.basename(f)} ---")
+
+def parse_sidecar(file_path):
+    """Đọc một file .log / .CMT, trả về dict các trường tìm được (kèm file, stem)."""
+    meta = {"file": file_path, "stem": os.path.splitext(os.path.basename(file_path))[0]}
     try:
-        with open(f, "r", encoding="utf-8", errors="ignore") as file:
-            lines = file.readlines()
-        # in 20 dòng đầu để quan sát
-        for line in lines[:20]:
-            print(line.strip())
-    except Exception as e:
-        print(f"Failed to read {f}: {e}")
\ No newline at end of file
+        with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+            lines = f.read().split("\n")
+    except OSError as e:
+        print(f"Failed to read {file_path}: {e}")
+        return meta
+    for line in lines:
+        for m in SIDECAR_PATTERN.finditer(line.strip()):
+            meta[m.lastgroup] = m.group(m.lastgroup)
+    return meta
+
+
+def recording_key(stems):
+    """Khóa join: phần stem trước dấu '_' đầu tiên (FA5550A0_1-1+ -> FA5550A0, FA5550A0.CMT -> FA5550A0)."""
+    return stems.str.extract(r'^([^_]+)', expand=False).str.upper()
+
+
+def scan_sidecars(root, n_threads=16):
+    """Quét mọi .log / .CMT dưới root song song; gộp các file cùng khóa (giá trị đầu tiên khác rỗng)."""
+    files = [f for f in glob.glob(os.path.join(root, "**", "*"), recursive=True)
+             if os.path.splitext(f)[1].lower() in (".log", ".cmt")]
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        rows = list(tqdm(pool.map(parse_sidecar, files), total=len(files), desc="Reading sidecars"))
+    df = pd.DataFrame(rows, columns=["file", "stem"] + SIDECAR_FIELDS)
+    df["key"] = recording_key(df["stem"])
+    return df.groupby("key", as_index=False)[SIDECAR_FIELDS].first()
+
+
+def join_edf_recordings(sidecars, edf_files):
+    """Gắn metadata sidecar vào từng file EDF theo khóa stem; thêm PATIENT_NAME_STD để matching."""
+    edf = pd.DataFrame({"file": edf_files})
+    edf["key"] = recording_key(edf["file"].map(lambda f: os.path.splitext(os.path.basename(f))[0]))
+    joined = edf.merge(sidecars, on="key", how="left")
+    names = joined["PATIENT_NAME"].dropna().unique()
+    std_map = dict(zip(names, (" ".join(unidecode.unidecode(n).upper().split()) for n in names)))
+    joined["PATIENT_NAME_STD"] = joined["PATIENT_NAME"].map(std_map)
+    return joined
+
+
+if __name__ == "__main__":
+    edf_root = os.path.join(folder, "edf_files")
+    sidecar_tsv = "./sidecar_metadata.tsv"  # đọc bởi utils/make_kqcls_matched.py (sidecar_tsv)
+
+    sidecars = scan_sidecars(folder)
+    edf_files = glob.glob(os.path.join(edf_root, "**", "*.edf"), recursive=True)
+    edf_files.extend(glob.glob(os.path.join(edf_root, "**", "*.EDF"), recursive=True))
+    joined = join_edf_recordings(sidecars, edf_files)
+    joined.to_csv(sidecar_tsv, sep="\t", index=False)
+    print(f"{len(sidecars)} sidecar recordings, {joined['DOC_NO'].notna().sum()} / {len(joined)} EDF files with DOC_NO")
+    print(f"Sidecar metadata saved to: {sidecar_tsv}")
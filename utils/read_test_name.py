@@ -1,10 +1,7 @@
 import pandas as pd
+import numpy as np
 import re
 
-# Load the XLSX file
-df = pd.read_excel('/mnt/disk1/aiotlab/hieupc/New_CBraMod/BIDS/clinical_sheet_cleaned.xlsx')
-print(df.columns)
-
 # Function to classify result type
 def classify_result(result):
     result = str(result).strip()
@@ -25,14 +22,74 @@ def classify_result(result):
     else:
         return 'Unknown'
 
-# Apply classification
-df['Result_Type'] = df['PARA_RESULT'].apply(classify_result)
 
-# Group by HFL_NAME and Result_Type
-result_summary = df.groupby(['HFL_NAME', 'Result_Type']).size().reset_index(name='Count')
+# Same rules as classify_result, compiled once and applied as vectorized masks (on the raw stripped text)
+NUMERIC_PATTERN = re.compile(r'^-?\d*\.?\d+$')
+TEXTUAL_PATTERN = re.compile(r'^[A-Za-z\s\.\,\-\(\)\:]+$')
+TEXTUAL_KEYWORDS = re.compile(r'positive|negative|normal|abnormal|tirads')
+MIXED_PATTERN = re.compile(r'.*\d.*[A-Za-z].*')
+# Optional comparator, the whole number (one dot or comma separator, optional exponent; anchored so the
+# exponent is not split off as unit), then the rest as unit: "< 4,5 mmol/L", "2e9/L"
+VALUE_UNIT_PATTERN = re.compile(
+    r'^(?P<comparator>[<>]=?|≤|≥)?\s*(?P<value>-?(?:\d+(?:[.,]\d+)?|[.,]\d+)(?:[eE][-+]?\d+)?)(?![\d.,])'
+    r'\s*(?P<unit>.*)$'
+)
+# "1,000" / "150,000": the comma may be a thousands separator, so no value is guessed
+THOUSANDS_PATTERN = re.compile(r'^-?\d{1,3}(?:,\d{3})+$')
+
+
+def parse_value(value):
+    """Number from the value group of VALUE_UNIT_PATTERN: a decimal comma ("4,2") becomes a dot; NaN if ambiguous."""
+    if not isinstance(value, str) or THOUSANDS_PATTERN.match(value):
+        return np.nan
+    return float(value.replace(',', '.'))
+
+
+def classify_results(results):
+    """
+    Vectorized classify_result for a whole column, plus typed value / unit columns.
+    Work is done once per distinct PARA_RESULT (pd.factorize), then broadcast back to the rows,
+    so cost scales with the number of unique strings, not the number of rows.
+    Result_Type is exactly classify_result; Result_Value is also filled for non-textual results it calls
+    Unknown (e.g. "4,2", "< 5").
+    Returns a DataFrame (Result_Type, Result_Comparator, Result_Value, Result_Unit) on results.index.
+    """
+    codes, uniques = pd.factorize(results, use_na_sentinel=False)
+    text = pd.Series(uniques, dtype=object).map(str).str.strip()
+
+    numeric = text.str.match(NUMERIC_PATTERN)
+    textual = text.str.match(TEXTUAL_PATTERN) | text.str.lower().str.contains(TEXTUAL_KEYWORDS)
+    mixed = text.str.match(MIXED_PATTERN)
+    result_type = np.select([numeric, textual, mixed], ['Numeric', 'Textual', 'Mixed'], default='Unknown')
+
+    parsed = text.str.extract(VALUE_UNIT_PATTERN)
+    value = parsed['value'].map(parse_value).where(result_type != 'Textual')
+    has_value = value.notna()
+    unit = parsed['unit'].str.strip().replace('', np.nan).where(has_value)
+    comparator = parsed['comparator'].where(has_value)
+
+    per_unique = pd.DataFrame({
+        'Result_Type': result_type,
+        'Result_Comparator': comparator,
+        'Result_Value': value.astype(float),
+        'Result_Unit': unit,
+    })
+    return per_unique.iloc[codes].set_index(results.index)
+
+
+if __name__ == "__main__":
+    # Load the XLSX file
+    df = pd.read_excel('/mnt/disk1/aiotlab/hieupc/New_CBraMod/BIDS/clinical_sheet_cleaned.xlsx')
+    print(df.columns)
+
+    # Apply classification (one pass over distinct results; also fills typed value / unit columns)
+    df = df.join(classify_results(df['PARA_RESULT']))
+
+    # Group by HFL_NAME and Result_Type
+    result_summary = df.groupby(['HFL_NAME', 'Result_Type']).size().reset_index(name='Count')
 
-# Display the summary
-print(result_summary)
+    # Display the summary
+    print(result_summary)
 
-# Save to a new Excel file
-result_summary.to_excel('test_result_classification.xlsx', index=False)
+    # Save to a new Excel file
+    result_summary.to_excel('test_result_classification.xlsx', index=False)
@@ -19,23 +19,150 @@
 # # Ghi ra file TSV mới
 # df_translated.to_csv("output.tsv", sep="\t", index=False)
 
+import sqlite3
+import threading
 import pandas as pd
-from deep_translator import GoogleTranslator
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
 
-# Đọc file Excel
-df = pd.read_excel("/mnt/disk1/aiotlab/hieupc/New_CBraMod/BIDS/kqcls.xlsx")
+source_lang = "vi"
+target_lang = "en"
+backend_name = "google"  # "google" = deep_translator; "offline" = glossary stand-in, không gọi mạng
+cache_path = "./translation_cache.sqlite"  # giữ giữa các lần chạy: sheet cập nhật chỉ gửi chuỗi mới
+batch_size = 50
+max_workers = 4  # số batch gửi song song tối đa
 
-# Hàm dịch từng ô
-def translate_text(text):
-    if pd.isna(text):  # Bỏ qua ô rỗng
-        return text
-    try:
-        return GoogleTranslator(source="vi", target="en").translate(str(text))
-    except:
-        return text
 
-# Dịch toàn bộ DataFrame
-df_translated = df.applymap(translate_text)
+class GoogleBackend:
+    """
+    Dịch theo batch bằng GoogleTranslator, một instance cho mỗi thread (deep_translator sửa state của instance
+    trong mỗi lần gọi, dùng chung giữa các thread thì các batch lẫn kết quả của nhau).
+    Batch lỗi thì dịch lại từng chuỗi; chuỗi vẫn lỗi trả về None.
+    """
 
-# Ghi ra file Excel mới
-df_translated.to_excel("translated_kqcls.xlsx", index=False)
\ No newline at end of file
+    def __init__(self, source, target):
+        from deep_translator import GoogleTranslator  # chỉ cần khi dùng backend này
+        self.make_translator = lambda: GoogleTranslator(source=source, target=target)
+        self.make_translator()  # báo lỗi tham số ngôn ngữ ngay, trước khi chạy thread
+        self._local = threading.local()
+
+    @property
+    def translator(self):
+        if not hasattr(self._local, "translator"):
+            self._local.translator = self.make_translator()
+        return self._local.translator
+
+    def translate_batch(self, texts):
+        try:
+            return self.translator.translate_batch(texts)
+        except Exception:
+            out = []
+            for text in texts:
+                try:
+                    out.append(self.translator.translate(text))
+                except Exception:
+                    out.append(None)  # lỗi tạm thời (mạng, rate limit): không cache, lần chạy sau dịch lại
+            return out
+
+
+class OfflineBackend:
+    """Stand-in khi chạy offline / thử nghiệm: tra glossary, chuỗi không có trong glossary giữ nguyên."""
+
+    GLOSSARY = {"Nam": "Male", "Nữ": "Female", "Âm tính": "Negative", "Dương tính": "Positive",
+                "Bình thường": "Normal"}
+
+    def __init__(self, source, target, glossary=None):
+        self.glossary = {**self.GLOSSARY, **(glossary or {})}
+
+    def translate_batch(self, texts):
+        return [self.glossary.get(text, text) for text in texts]
+
+
+BACKENDS = {"google": GoogleBackend, "offline": OfflineBackend}
+
+
+class TranslationCache:
+    """Cache bền vững (SQLite) (source, target, text) -> bản dịch."""
+
+    def __init__(self, path, source, target):
+        self.path, self.source, self.target = path, source, target
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS translations (source TEXT, target TEXT, text TEXT, "
+                         "translation TEXT, PRIMARY KEY (source, target, text))")
+        conn.close()
+
+    def get_many(self, texts):
+        found = {}
+        conn = sqlite3.connect(self.path)
+        try:
+            for text in texts:
+                row = conn.execute("SELECT translation FROM translations WHERE source=? AND target=? AND text=?",
+                                   (self.source, self.target, text)).fetchone()
+                if row:
+                    found[text] = row[0]
+        finally:
+            conn.close()
+        return found
+
+    def put_many(self, pairs):
+        """Ghi các cặp (text, bản dịch); bản dịch None (dịch lỗi) bị bỏ qua để lần sau thử lại."""
+        pairs = [(text, tr) for text, tr in pairs if tr is not None]
+        if not pairs:
+            return
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)",
+                                 [(self.source, self.target, text, tr) for text, tr in pairs])
+        finally:
+            conn.close()
+
+
+def translate_unique(texts, backend, cache):
+    """
+    Dịch tập chuỗi khác nhau: lấy từ cache trước, phần còn lại chia batch và gửi song song có giới hạn.
+    Chuỗi dịch lỗi không có trong kết quả (người gọi giữ nguyên bản gốc) và không được cache.
+    """
+    texts = sorted(set(texts))
+    translations = cache.get_many(texts)
+    missing = [t for t in texts if t not in translations]
+    batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+    print(f"{len(texts)} unique strings, {len(translations)} cached, {len(missing)} to translate")
+    n_failed = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for batch, result in tqdm(zip(batches, pool.map(backend.translate_batch, batches)),
+                                  total=len(batches), desc="Translating"):
+            pairs = [(text, tr) for text, tr in zip(batch, result) if tr]
+            n_failed += len(batch) - len(pairs)
+            cache.put_many(pairs)  # ghi ngay từng batch: bị ngắt giữa chừng thì lần sau không dịch lại
+            translations.update(pairs)
+    if n_failed:
+        print(f"⚠️ {n_failed} strings failed to translate (kept as-is, not cached; re-run to retry)")
+    return translations
+
+
+def translate_frame(df, backend, cache):
+    """Dịch mọi ô chuỗi của DataFrame; mỗi chuỗi khác nhau chỉ dịch một lần cho toàn bộ các cột."""
+    text_columns = [c for c in df.columns if df[c].dtype == object or pd.api.types.is_string_dtype(df[c])]
+    texts = set()
+    for col in text_columns:
+        texts.update(v for v in df[col].dropna().unique() if isinstance(v, str))
+    translations = translate_unique(texts, backend, cache)
+    out = df.copy()
+    for col in text_columns:
+        out[col] = df[col].map(lambda v: translations.get(v, v) if isinstance(v, str) else v)
+    return out
+
+
+if __name__ == "__main__":
+    # Đọc file Excel
+    df = pd.read_excel("/mnt/disk1/aiotlab/hieupc/New_CBraMod/BIDS/kqcls.xlsx")
+
+    backend = BACKENDS[backend_name](source_lang, target_lang)
+    cache = TranslationCache(cache_path, source_lang, target_lang)
+
+    # Dịch toàn bộ DataFrame (theo chuỗi khác nhau, có cache)
+    df_translated = translate_frame(df, backend, cache)
+
+    # Ghi ra file Excel mới
+    df_translated.to_excel("translated_kqcls.xlsx", index=False)
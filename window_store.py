@@ -0,0 +1,329 @@
+import os
+import glob
+import json
+import logging
+import argparse
+from fractions import Fraction
+from collections import Counter
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from scipy import signal
+from concurrent.futures import ProcessPoolExecutor
+from edf_reader import EdfMemmap
+from derivative_store import scaling_to_uv
+
+STORE_DIR = os.path.join("derivatives", "windows")
+INDEX_COLUMNS = ["bids_path", "participant_id", "age", "sex", "n_windows", "n_channels", "sfreq", "window_samples"]
+DONE_PREFIX = b"__done__/"     # đánh dấu recording đã ghi xong (resume theo recording)
+META_PREFIX = b"__meta__/"     # metadata JSON của recording
+# option quyết định nội dung cửa sổ: chạy lại với giá trị khác thì recording được xử lý lại
+SIGNAL_OPTIONS = ["target_sfreq", "l_freq", "h_freq", "window_seconds", "channels"]
+
+
+def window_key(bids_path, i):
+    return f"{bids_path}/{i:06d}".encode()
+
+
+def signal_options(options):
+    """Các option trong SIGNAL_OPTIONS, dạng như sau khi đọc lại từ JSON (để so với __meta__)."""
+    return json.loads(json.dumps({k: options.get(k) for k in SIGNAL_OPTIONS}))
+
+
+def _delete_windows_from(txn, bids_path, first):
+    """Xoá các key cửa sổ >= first của recording (còn sót từ lần chạy trước sinh nhiều cửa sổ hơn)."""
+    prefix = f"{bids_path}/".encode()
+    cursor = txn.cursor()
+    stale = []
+    if cursor.set_range(window_key(bids_path, first)):
+        for key, _ in cursor:
+            if not key.startswith(prefix):
+                break
+            stale.append(key)
+    for key in stale:
+        txn.delete(key)
+    return len(stale)
+
+
+class Preprocessor:
+    """
+    Resample (polyphase) + band-pass (Butterworth SOS, zero-phase) + cắt cửa sổ cố định, theo từng đoạn
+    segment_windows cửa sổ. Mỗi đoạn được đọc kèm lề pad ở hai đầu rồi bỏ lề sau khi lọc, nên kết quả
+    liền mạch giữa các đoạn mà RAM chỉ tốn một đoạn.
+    """
+
+    def __init__(self, sfreq, target_sfreq=200.0, l_freq=0.3, h_freq=75.0, window_seconds=30.0,
+                 segment_windows=20, pad_seconds=10.0):
+        ratio = Fraction(target_sfreq / sfreq).limit_denominator(1000)
+        self.up, self.down = ratio.numerator, ratio.denominator
+        self.sfreq, self.target_sfreq = sfreq, target_sfreq
+        self.window_samples = int(round(window_seconds * target_sfreq))
+        self.src_window = self.window_samples * self.down // self.up
+        if self.src_window * self.up != self.window_samples * self.down:
+            raise ValueError(f"window_seconds={window_seconds} is not a whole number of samples at {sfreq} Hz")
+        self.segment_windows = segment_windows
+        # lề là bội số của down để vị trí cắt sau resample là số nguyên
+        self.pad = self.down * int(np.ceil(pad_seconds * sfreq / self.down))
+        # bộ lọc chạy ở sfreq gốc: cận trên phải dưới Nyquist của cả tần số gốc lẫn tần số đích
+        nyquist = min(sfreq, target_sfreq) / 2
+        h_freq = min(h_freq, 0.95 * nyquist) if h_freq else None
+        if l_freq and h_freq:
+            self.sos = signal.butter(4, [l_freq, h_freq], btype="bandpass", fs=sfreq, output="sos")
+        elif l_freq:
+            self.sos = signal.butter(4, l_freq, btype="highpass", fs=sfreq, output="sos")
+        else:
+            self.sos = signal.butter(4, h_freq, btype="lowpass", fs=sfreq, output="sos") if h_freq else None
+
+    def n_windows(self, n_samples):
+        return n_samples // self.src_window
+
+    def iter_segments(self, read, n_samples):
+        """read(start, stop) -> (channels x samples) float; sinh (index cửa sổ đầu, mảng windows x channels x samples)."""
+        n_windows = self.n_windows(n_samples)
+        for w0 in range(0, n_windows, self.segment_windows):
+            w1 = min(w0 + self.segment_windows, n_windows)
+            start, stop = w0 * self.src_window, w1 * self.src_window
+            lo, hi = max(0, start - self.pad), min(n_samples, stop + self.pad)
+            x = read(lo, hi)
+            if self.sos is not None:
+                x = signal.sosfiltfilt(self.sos, x, axis=-1)
+            if (self.up, self.down) != (1, 1):
+                x = signal.resample_poly(x, self.up, self.down, axis=-1)
+            first = (start - lo) * self.up // self.down
+            x = x[:, first:first + (w1 - w0) * self.window_samples]
+            yield w0, x.reshape(x.shape[0], w1 - w0, self.window_samples).transpose(1, 0, 2)
+
+
+def open_env(path, map_size_gb=1024, readonly=False):
+    import lmdb  # chỉ cần cho bước này (pip install lmdb)
+    return lmdb.open(path, map_size=int(map_size_gb * 1024 ** 3), subdir=True, readonly=readonly,
+                     lock=not readonly, max_readers=512)
+
+
+def load_participants(bids_dir):
+    tsv = os.path.join(bids_dir, "participants.tsv")
+    if not os.path.exists(tsv):
+        return {}
+    df = pd.read_csv(tsv, sep="\t", dtype=str, keep_default_na=False)
+    return {row["participant_id"]: row for row in df.to_dict("records")}
+
+
+def process_recording(bids_dir, bids_path, env_path, participant, options):
+    """
+    Tiền xử lý một recording và ghi các cửa sổ (float32, uV, channels x samples) vào LMDB;
+    mỗi đoạn ghi trong một transaction, marker __done__ ở transaction cuối.
+    Chạy lại (dở dang, hoặc với option khác) ghi đè cùng các key; key cửa sổ vượt n_windows mới bị xoá
+    trước khi ghi __done__. Option tín hiệu được lưu trong __meta__ để lần sau biết có cần chạy lại không.
+    """
+    with EdfMemmap(os.path.join(bids_dir, bids_path)) as reader:
+        if not reader.n_channels:
+            raise ValueError("No signal channels")
+        if options.get("channels"):
+            missing = [c for c in options["channels"] if c not in reader.labels]
+            if missing:
+                raise ValueError(f"Missing channels: {missing}")
+            idx = reader.channel_index(options["channels"])
+        else:
+            spr = Counter(reader.samples_per_record.tolist()).most_common(1)[0][0]
+            idx = [k for k in range(reader.n_channels) if reader.samples_per_record[k] == spr]
+        sfreq = float(reader.sfreqs[idx[0]])
+        gain, offset = scaling_to_uv(reader, idx)
+        gain, offset = gain[:, None].astype(np.float32), offset[:, None].astype(np.float32)
+        prep = Preprocessor(sfreq, options["target_sfreq"], options["l_freq"], options["h_freq"],
+                            options["window_seconds"], options["segment_windows"])
+        n_samples = reader.n_records * int(reader.samples_per_record[idx[0]])
+
+        def read(start, stop):
+            return reader.digital(idx, start, stop).astype(np.float32) * gain + offset
+
+        env = open_env(env_path, options["map_size_gb"])
+        try:
+            with env.begin(write=True) as txn:
+                txn.delete(DONE_PREFIX + bids_path.encode())  # bị ngắt giữa chừng thì không còn coi là xong
+            n_windows = 0
+            for w0, windows in prep.iter_segments(read, n_samples):
+                with env.begin(write=True) as txn:
+                    for i, window in enumerate(windows.astype(np.float32)):
+                        txn.put(window_key(bids_path, w0 + i), window.tobytes())
+                n_windows = w0 + len(windows)
+            meta = {
+                "bids_path": bids_path,
+                "participant_id": participant.get("participant_id", bids_path.split(os.sep)[0]),
+                "age": participant.get("age", "n/a"),
+                "sex": participant.get("sex", "n/a"),
+                "n_windows": n_windows,
+                "n_channels": len(idx),
+                "channels": [reader.labels[k] for k in idx],
+                "sfreq": prep.target_sfreq,
+                "window_samples": prep.window_samples,
+                "dtype": "float32",
+                "unit": "uV",
+                "options": signal_options(options),
+            }
+            with env.begin(write=True) as txn:
+                n_stale = _delete_windows_from(txn, bids_path, n_windows)
+                if n_stale:
+                    logging.info(f"Removed {n_stale} stale windows of {bids_path}")
+                txn.put(META_PREFIX + bids_path.encode(), json.dumps(meta).encode())
+                txn.put(DONE_PREFIX + bids_path.encode(), b"1")
+        finally:
+            env.close()
+    return {c: meta[c] for c in INDEX_COLUMNS}
+
+
+def _process_item(item):
+    bids_dir, bids_path, env_path, participant, options = item
+    try:
+        return process_recording(bids_dir, bids_path, env_path, participant, options), None
+    except (OSError, ValueError) as e:
+        return {"bids_path": bids_path}, str(e)
+
+
+def done_recordings(env_path, options=None):
+    """
+    Recording đã có marker __done__; khi cho options, chỉ tính các recording mà option tín hiệu trong __meta__
+    trùng với options (recording ghi với target_sfreq / window_seconds / channels ... khác sẽ được xử lý lại).
+    """
+    if not os.path.exists(os.path.join(env_path, "data.mdb")):
+        return set()
+    wanted = signal_options(options) if options is not None else None
+    env = open_env(env_path, readonly=True)
+    try:
+        with env.begin() as txn:
+            cursor = txn.cursor()
+            done = []
+            if cursor.set_range(DONE_PREFIX):
+                for key, _ in cursor:
+                    if not key.startswith(DONE_PREFIX):
+                        break
+                    done.append(key[len(DONE_PREFIX):].decode())
+            if wanted is None:
+                return set(done)
+            matching = set()
+            for bids_path in done:
+                meta = txn.get(META_PREFIX + bids_path.encode())
+                if meta is not None and json.loads(meta).get("options") == wanted:
+                    matching.add(bids_path)
+            return matching
+    finally:
+        env.close()
+
+
+def build_window_store(bids_dir, options, workers=1):
+    """
+    Chạy pipeline cho mọi run chưa có marker __done__ với cùng option tín hiệu trong LMDB, song song theo recording
+    (LMDB tự tuần tự hóa các transaction ghi giữa các process). Trả về (số recording mới, failed rows).
+    index.tsv cạnh LMDB: một dòng / recording, key cửa sổ = '<bids_path>/<i:06d>'.
+    """
+    out_dir = os.path.join(bids_dir, STORE_DIR)
+    env_path = os.path.join(out_dir, "windows.lmdb")
+    os.makedirs(env_path, exist_ok=True)
+    open_env(env_path, options["map_size_gb"]).close()  # báo thiếu lmdb / tạo DB trước khi chạy pool
+
+    edf_files = glob.glob(os.path.join(bids_dir, "sub-*", "**", "*_eeg.edf"), recursive=True)
+    runs = sorted(os.path.relpath(f, bids_dir) for f in edf_files)
+    done = done_recordings(env_path, options)
+    participants = load_participants(bids_dir)
+    items = [(bids_dir, p, env_path, participants.get(p.split(os.sep)[0], {}), options)
+             for p in runs if p not in done]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(tqdm(pool.map(_process_item, items), total=len(items), desc="Windowing"))
+    else:
+        results = [_process_item(it) for it in tqdm(items, desc="Windowing")]
+
+    rows, failed = [], []
+    for row, error in results:
+        if error:
+            failed.append({"failed_file": row["bids_path"], "reason": error})
+            logging.warning(f"Failed to window {row['bids_path']}: {error}")
+        else:
+            rows.append(row)
+
+    index_tsv = os.path.join(out_dir, "index.tsv")
+    if os.path.exists(index_tsv):
+        index = pd.read_csv(index_tsv, sep="\t", keep_default_na=False, dtype={"age": str, "sex": str})
+    else:
+        index = pd.DataFrame(columns=INDEX_COLUMNS)
+    if rows:
+        new = pd.DataFrame(rows, columns=INDEX_COLUMNS)
+        index = pd.concat([index[~index["bids_path"].isin(new["bids_path"])], new], ignore_index=True)
+        index.sort_values("bids_path").to_csv(index_tsv, sep="\t", index=False)
+    return len(rows), failed
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Resample + band-pass + cắt cửa sổ cố định, ghi vào LMDB cho training")
+    parser.add_argument(
+        "--bids_dir",
+        type=str,
+        required=True,
+        help="BIDS database directory"
+    )
+    parser.add_argument(
+        "--target_sfreq",
+        type=float,
+        default=200.0,
+        help="Tần số lấy mẫu sau resample (Hz)"
+    )
+    parser.add_argument(
+        "--l_freq",
+        type=float,
+        default=0.3,
+        help="Tần số cắt dưới của band-pass (Hz), 0 = không high-pass"
+    )
+    parser.add_argument(
+        "--h_freq",
+        type=float,
+        default=75.0,
+        help="Tần số cắt trên của band-pass (Hz), 0 = không low-pass"
+    )
+    parser.add_argument(
+        "--window_seconds",
+        type=float,
+        default=30.0,
+        help="Độ dài một cửa sổ (giây)"
+    )
+    parser.add_argument(
+        "--channels",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Danh sách kênh cố định (recording thiếu kênh bị bỏ); mặc định giữ mọi kênh cùng tần số"
+    )
+    parser.add_argument(
+        "--segment_windows",
+        type=int,
+        default=20,
+        help="Số cửa sổ xử lý trong một lần (giới hạn RAM mỗi worker)"
+    )
+    parser.add_argument(
+        "--map_size_gb",
+        type=float,
+        default=1024,
+        help="LMDB map size (GB, file thưa nên không chiếm đĩa trước)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Số process song song"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    args = get_args()
+    options = {
+        "target_sfreq": args.target_sfreq,
+        "l_freq": args.l_freq or None,
+        "h_freq": args.h_freq or None,
+        "window_seconds": args.window_seconds,
+        "channels": args.channels,
+        "segment_windows": args.segment_windows,
+        "map_size_gb": args.map_size_gb,
+    }
+    n_runs, failed = build_window_store(args.bids_dir, options, args.workers)
+    print(f"{n_runs} recordings windowed into {os.path.join(args.bids_dir, STORE_DIR)} ({len(failed)} failed)")
@@ -11,6 +11,15 @@ from tqdm import tqdm
 import argparse
 import logging
 from collections import defaultdict
+from job_queue import JobQueue, run_worker
+from scheduler import group_inventory, run_lpt
+from supervisor import run_maybe_isolated
+from edf_triage import triage_edf
+from dedup import ContentIndex, dedup_edf_groups, record_duplicates
+from identity_index import IdentityIndex, identity_from_edf
+from edf_annotations import write_events
+from preview import build_preview, preview_path_for
+from nihon_kohden import find_nihon_recordings, load_patient_sidecars, convert_nihon, recording_key, nihon_identity
 
 # === Configuration ===
 # Paths
@@ -60,6 +69,96 @@ def get_args():
         required=True,
         help="Anonymous XLSX test_result directory"
     )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default="serial",
+        choices=["serial", "enqueue", "worker", "finalize"],
+        help="serial = chạy một tiến trình như cũ; enqueue/worker/finalize = chế độ job table nhiều worker"
+    )
+    parser.add_argument(
+        "--queue_db",
+        type=str,
+        default=None,
+        help="SQLite job table (mặc định: <bids_dir>/.job_queue.sqlite)"
+    )
+    parser.add_argument(
+        "--lease_seconds",
+        type=float,
+        default=300,
+        help="Thời hạn lease của một job; worker heartbeat mỗi lease/3 giây"
+    )
+    parser.add_argument(
+        "--worker_id",
+        type=str,
+        default=None,
+        help="Tên worker (mặc định: <hostname>-<pid>)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Số process chạy song song ở chế độ serial (folder lớn nhất chạy trước)"
+    )
+    parser.add_argument(
+        "--worker_mem_mb",
+        type=float,
+        default=None,
+        help="Ngân sách RAM ước tính cho mỗi worker (MB); mặc định không giới hạn"
+    )
+    parser.add_argument(
+        "--file_timeout",
+        type=float,
+        default=600,
+        help="Giới hạn thời gian (giây) để đọc header một file EDF; <= 0 để tắt"
+    )
+    parser.add_argument(
+        "--file_max_rss_mb",
+        type=float,
+        default=4096,
+        help="Giới hạn RSS (MB) của worker đọc một file EDF; <= 0 để tắt"
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Bỏ qua bản ghi trùng nội dung (hash phần data) giữa các folder / dataset, chỉ ghi tham chiếu vào duplicates.tsv (chế độ job table: truyền cho cả enqueue và finalize)"
+    )
+    parser.add_argument(
+        "--dedup_db",
+        type=str,
+        default=None,
+        help="SQLite content index dùng chung giữa các lần chạy (mặc định: <bids_dir>/.content_index.sqlite)"
+    )
+    parser.add_argument(
+        "--identity",
+        action="store_true",
+        help="Gộp các folder của cùng một bệnh nhân (tên + năm sinh [+ DOC_NO]) vào một sub-id qua identity index; "
+             "cần biến môi trường BIDS_PSEUDONYM_KEY"
+    )
+    parser.add_argument(
+        "--identity_db",
+        type=str,
+        default=None,
+        help="SQLite identity index (mặc định: <bids_dir>/.identity_index.sqlite)"
+    )
+    parser.add_argument(
+        "--input_format",
+        type=str,
+        default="edf",
+        choices=["edf", "nihon"],
+        help="edf = file .edf đã export; nihon = file gốc EEG2100 (.EEG/.PNT/.LOG) ghi thẳng ra EDF trong BIDS"
+    )
+    parser.add_argument(
+        "--nk_sidecar_tsv",
+        type=str,
+        default=None,
+        help="sidecar_metadata.tsv (utils/read_other.py): tên / ngày sinh / giới tính cho file EEG2100"
+    )
+    parser.add_argument(
+        "--preview",
+        action="store_true",
+        help="Dựng kim tự tháp min/max (derivatives/preview) cho từng run ngay khi convert; không bật thì preview.py dựng sau"
+    )
     return parser.parse_args()
 
 # def extract_edf_metadata(edf_file):
@@ -119,6 +218,18 @@ def extract_edf_metadata(edf_file):
         print(f"Error reading EDF file {edf_file}: {e}")
         return None,None, None, None, None, None , None
 
+def extract_edf_summary(edf_file):
+    """
+    Như extract_edf_metadata nhưng thay raw bằng subject_info và duration,
+    để kết quả nhỏ và pickle được khi đọc trong worker cô lập.
+    """
+    name_only, sex, birth_suffix, sampling_rate, channel_types, recording_date, raw = extract_edf_metadata(edf_file)
+    if raw is None:
+        return name_only, sex, birth_suffix, sampling_rate, channel_types, recording_date, None, None
+    subject_info = dict(raw.info.get('subject_info') or {})
+    duration = float(raw.times[-1]) if raw.times.size > 0 else "n/a"
+    return name_only, sex, birth_suffix, sampling_rate, channel_types, recording_date, subject_info, duration
+
 def extract_birth_year_suffix(birth_date):
     try:
         birth_date = pd.to_datetime(birth_date)
@@ -196,238 +307,473 @@ def standardize_name(name: str, remove_spaces: bool = False) -> str:
     return clean
 
 
-def create_bids(args):
-    """
-    Create a BIDS dataset from EDF files, grouping files in the same parent folder as one subject.
-    Match only one file per group with xlsx; if no match, use EDF metadata or placeholder.
-    Save matched rows to phenotype/results.tsv with test results from HFL_NAME, PARA_RESULT, UNIT.
-    Create phenotype/results.json. Copy original EDF files without anonymization or export.
-    """
-    edf_dir = args.edf_dir
-    bids_dir = args.bids_dir
-    doc_no_col = 'DOC_NO'
-    patient_name_col = 'PATIENT_NAME'
-    birth_date_col = 'BIRTH_DATE'
-    GENDER_col = 'GENDER'
-    hfl_name_col = 'HFL_NAME'
-    para_result_col = 'PARA_RESULT'
-    unit_col = 'UNIT'
-
-    # Create BIDS root
-    os.makedirs(bids_dir, exist_ok=True)
-
-    # Load existing participants.tsv
-    participants_tsv = os.path.join(bids_dir, "participants.tsv")
-    existing_participants = []
-    if os.path.exists(participants_tsv):
-        existing_df = pd.read_csv(participants_tsv, sep='\t')
-        existing_participants = existing_df.to_dict('records')
-        logging.info(f"Loaded existing participants.tsv with {len(existing_participants)} entries")
-
-    # Load Excel data
+def load_excel_data(args):
+    """Đọc sheet bệnh nhân và chuẩn hóa tên / năm sinh để matching."""
     df = load_patient_xlsx(args)
     df["PATIENT_NAME_STD"] = df[patient_name_col].apply(lambda x: standardize_name(x, remove_spaces=False))
     df['BIRTH_YEAR'] = df[birth_date_col].apply(extract_birth_year_suffix)
 
     # Keep all rows (no aggregation) to preserve multiple test results per DOC_NO
     # Filter relevant columns
-    excel_data = df[[doc_no_col, 'PATIENT_NAME_STD', birth_date_col, GENDER_col, hfl_name_col, para_result_col]]
+    return df[[doc_no_col, 'PATIENT_NAME_STD', birth_date_col, GENDER_col, hfl_name_col, para_result_col]]
+
 
-    # Collect EDF files recursively and group by parent folder
+def collect_edf_groups(edf_dir):
+    """Collect EDF files recursively and group by parent folder."""
     edf_files = glob.glob(os.path.join(edf_dir, "**", "*.edf"), recursive=True)
     edf_files.extend(glob.glob(os.path.join(edf_dir, "**", "*.EDF"), recursive=True))
     edf_groups = defaultdict(list)
     for f in edf_files:
         parent = os.path.dirname(f)  # Folder cha trực tiếp chứa .edf
         edf_groups[parent].append(f)
+    return edf_groups
 
-    processed_edf_files = set()
-    failed_files = []
+
+def collect_nihon_groups(edf_dir):
+    """Như collect_edf_groups cho file gốc EEG2100: mỗi .EEG (có .PNT) là một recording, nhóm theo folder cha."""
+    groups = defaultdict(list)
+    for f in find_nihon_recordings(edf_dir):
+        groups[os.path.dirname(f)].append(f)
+    return groups
+
+
+def collect_groups(args):
+    return collect_nihon_groups(args.edf_dir) if args.input_format == "nihon" else collect_edf_groups(args.edf_dir)
+
+
+def load_source(args):
+    """Thông tin nguồn truyền cho process_edf_group: định dạng + bảng bệnh nhân sidecar (EEG2100)."""
+    patients = load_patient_sidecars(args.nk_sidecar_tsv) if args.input_format == "nihon" else {}
+    return {"format": args.input_format, "patients": patients}
+
+
+def convert_nihon_group(files, eeg_dir, sub_id, run_start, patients, limits=None):
+    """
+    Ghi từng recording EEG2100 thẳng ra file run EDF của BIDS (run đánh số liên tiếp theo file thành công),
+    trong worker cô lập như khi đọc header. Trả về ({file EEG2100: EDF đã ghi}, failed rows).
+    """
+    converted, failed = {}, []
+    run = run_start
+    for eeg_file in sorted(files):
+        out_path = os.path.join(eeg_dir, f"sub-{sub_id}_task-rest_run-{run:03d}_eeg.edf")
+        outcome = run_maybe_isolated(convert_nihon, eeg_file, out_path, patients.get(recording_key(eeg_file)),
+                                     **(limits or {}))
+        if outcome["ok"]:
+            converted[eeg_file] = out_path
+            run += 1
+            logging.info(f"Converted {eeg_file} -> {out_path}")
+        else:
+            failed.append({"failed_file": eeg_file, "reason": outcome["reason"]})
+            logging.warning(f"Failed to convert {eeg_file}: {outcome['reason']}")
+            for leftover in (out_path, out_path + ".tmp"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+    return converted, failed
+
+
+def count_existing_subs(bids_dir):
     existing_subs = [d for d in os.listdir(bids_dir) if d.startswith('sub-') and os.path.isdir(os.path.join(bids_dir, d))]
-    next_sub_id = len(existing_subs) + 1
-    processed_sub_ids = {p['participant_id'] for p in existing_participants}
-    anonymous_data = existing_participants
+    return len(existing_subs)
+
 
-    # Process each group (folder cha)
-    for folder, files in tqdm(edf_groups.items(), desc="Processing EDF folders"):
+def assign_sub_ids(edf_groups, bids_dir, reserved=0):
+    """
+    Gán sub-id theo thứ tự folder trước khi xử lý, để thứ tự chạy (song song, LPT) không làm đổi sub-id.
+    reserved: sub-id lớn nhất đã giao cho job trong job table (thư mục có thể chưa được tạo), không cấp lại.
+    """
+    next_sub_id = max(count_existing_subs(bids_dir), reserved) + 1
+    sub_ids = {}
+    for folder, files in edf_groups.items():
         if not files:
             continue
+        sub_ids[folder] = f"{next_sub_id:04d}"
+        next_sub_id += 1
+    return sub_ids
 
-        # Check if group already processed
-        if any(f in processed_edf_files for f in files):
-            logging.info(f"Skipping group {folder}: Already processed")
-            continue
 
-        sub_id = f"{next_sub_id:04d}"
-        next_sub_id += 1
-        sub_dir = os.path.join(bids_dir, f"sub-{sub_id}")
-        eeg_dir = os.path.join(sub_dir, "eeg")
-        os.makedirs(eeg_dir, exist_ok=True)
+def content_index_path(args):
+    return args.dedup_db or os.path.join(args.bids_dir, ".content_index.sqlite")
 
-        participant_info = None
-        run_counter = 1
-        scans_data = []
-        matched_rows = None
 
-        # Try to extract metadata from first valid file
-        for edf_file in sorted(files):
-            try:
-                name_only, sex, birth_suffix, sampling_rate, channel_types, recording_date, raw = extract_edf_metadata(edf_file)
-                if name_only is not None:
-                    edf_name_std = unidecode.unidecode(name_only).upper()
-                    # Match with Excel
-                    if birth_suffix and 'BIRTH_YEAR' in excel_data.columns and excel_data['BIRTH_YEAR'].notnull().any():
-                        matched_rows = excel_data[
-                            (excel_data['PATIENT_NAME_STD'] == edf_name_std) &
-                            (excel_data['BIRTH_YEAR'].str.endswith(str(birth_suffix), na=False))
-                        ]
-                    else:
-                        matched_rows = excel_data[(excel_data['PATIENT_NAME_STD'] == edf_name_std)]
-
-                    if not matched_rows.empty:
-                        # Use matched info for participants.tsv
-                        birth_date = matched_rows[birth_date_col].iloc[0]
-                        age = calculate_age(birth_date, recording_date) if birth_date and recording_date else "n/a"
-                        sex_str = matched_rows[GENDER_col].iloc[0].lower() if pd.notnull(matched_rows[GENDER_col].iloc[0]) else "n/a"
-                        participant_info = {
-                            "age": str(age) if age is not None else "n/a",
-                            "sex": sex_str,
-                            "group": "n/a"
-                        }
-                        # Save test results to phenotype/results.tsv
-                        phenotype_dir = os.path.join(bids_dir, "phenotype")
-                        os.makedirs(phenotype_dir, exist_ok=True)
-                        results_tsv = os.path.join(phenotype_dir, "results.tsv")
-                        test_data = []
-                        for _, row in matched_rows.iterrows():
-                            if pd.notnull(row[hfl_name_col]) and pd.notnull(row[para_result_col]):
-                                test_data.append({
-                                    'participant_id': f"sub-{sub_id}",
-                                    'test_name': str(row[hfl_name_col]),
-                                    'result': str(row[para_result_col]),
-                                    'unit': str(row[unit_col]) if pd.notnull(row.get(unit_col)) else 'n/a'
-                                })
-                        matched_df = pd.DataFrame(test_data)
-                        if os.path.exists(results_tsv):
-                            existing_results = pd.read_csv(results_tsv, sep='\t')
-                            matched_df = pd.concat([existing_results, matched_df], ignore_index=True)
-                        matched_df.to_csv(results_tsv, sep='\t', index=False)
-                        logging.info(f"Saved matched test results for sub-{sub_id} to {results_tsv}")
-                    else:
-                        # Use EDF metadata
-                        logging.warning(f"No match for group {folder}. Using EDF metadata.")
-                        with open(os.path.join(bids_dir, "unmatched_edf_groups.txt"), 'a') as f:
-                            f.write(f"{folder}\n")
-                        birth_year = extract_birth_year_suffix(raw.info.get('subject_info', {}), birth_suffix)
-                        age = calculate_age(birth_year, recording_date) if birth_year else "n/a"
-                        sex_str = ("male" if sex == 2 else "female") if sex is not None else "n/a"
-                        participant_info = {
-                            "age": str(age) if age is not None else "n/a",
-                            "sex": sex_str,
-                            "group": "n/a"
-                        }
-                    break  # Stop after finding first valid file
-            except Exception as e:
-                logging.warning(f"Failed to read metadata from {edf_file}: {e}")
-                continue
-
-        # If no valid metadata, use placeholder
-        if participant_info is None:
-            logging.warning(f"No valid metadata for group {folder}. Using placeholder.")
-            with open(os.path.join(bids_dir, "unmatched_edf_groups.txt"), 'a') as f:
-                f.write(f"{folder}\n")
-            participant_info = {
-                "age": "n/a",
-                "sex": "n/a",
-                "group": "n/a"
-            }
+def dedup_stage(args, edf_groups):
+    """
+    Pre-pass trước khi gán sub-id: bản ghi trùng nội dung với một file khác (trong lần chạy này
+    hoặc đã convert ở lần trước) bị bỏ khỏi edf_groups, không copy lại.
+    Trả về (edf_groups đã lọc, state); state = None khi không bật --dedup.
+    """
+    if not args.dedup:
+        return edf_groups, None
+    index = ContentIndex(content_index_path(args))
+    edf_groups, partials, fulls, duplicates = dedup_edf_groups(edf_groups, index)
+    return edf_groups, (index, partials, fulls, duplicates)
+
+
+def write_duplicates(bids_dir, duplicate_rows):
+    """Thêm các dòng vào duplicates.tsv; một file nguồn chỉ giữ dòng mới nhất (đường dẫn BIDS đã biết)."""
+    if not duplicate_rows:
+        return
+    duplicates_tsv = os.path.join(bids_dir, "duplicates.tsv")
+    df = pd.DataFrame(duplicate_rows)
+    if os.path.exists(duplicates_tsv):
+        df = pd.concat([pd.read_csv(duplicates_tsv, sep='\t', keep_default_na=False), df], ignore_index=True)
+    df.drop_duplicates("file", keep="last").to_csv(duplicates_tsv, sep='\t', index=False)
+    print(f"⚠️ {len(duplicate_rows)} duplicate EDF files skipped. See duplicates.tsv")
+
+
+def register_dedup(state, edf_groups, bids_dir):
+    """
+    Trước khi convert: ghi các file sẽ convert vào content index (chưa có đường dẫn BIDS, để lần chạy sau
+    vẫn nhận ra bản trùng) và ghi các bản trùng. Bản trùng của file đã convert ở lần trước vào duplicates.tsv
+    ngay; bản trùng của file trong lần chạy này đợi resolve_dedup, khi đã biết run thực tế.
+    """
+    if state is None:
+        return
+    index, partials, fulls, duplicates = state
+    batch = {f for files in edf_groups.values() for f in files}
+    for edf_file in sorted(batch):
+        index.register(edf_file, partials[edf_file], fulls.get(edf_file))
+    duplicate_rows = record_duplicates(index, duplicates, partials)
+    write_duplicates(bids_dir, [row for row in duplicate_rows if row["duplicate_of"] not in batch])
 
-        # Add participant info
-        anonymous_data.append({
-            "participant_id": f"sub-{sub_id}",
-            **participant_info
-        })
-        processed_sub_ids.add(f"sub-{sub_id}")
 
-        # Process all files in group as runs
+def resolve_dedup(args, runs, sources):
+    """
+    Sau khi convert: ghi đường dẫn BIDS thực tế (runs: file nguồn -> run EDF tương đối so với bids_dir) vào
+    content index, rồi ghi các bản trùng của sources vào duplicates.tsv. Với --input_format nihon run chỉ tăng
+    khi convert thành công, nên không đoán trước được đường dẫn từ thứ tự file.
+    """
+    if not args.dedup:
+        return
+    index = ContentIndex(content_index_path(args))
+    for source, bids_path in runs.items():
+        index.set_bids_path(source, bids_path)
+    write_duplicates(args.bids_dir, [
+        {"file": f, "duplicate_of": canonical, "bids_path": bids_path or "n/a", "content_hash": full}
+        for f, canonical, full, bids_path in index.duplicates_of(sources)
+    ])
+
+
+def identity_index_path(args):
+    return args.identity_db or os.path.join(args.bids_dir, ".identity_index.sqlite")
+
+
+def assign_sub_ids_by_identity(edf_groups, bids_dir, identity, excel_data, identify=identity_from_edf, reserved=0):
+    """
+    Như assign_sub_ids nhưng folder của bệnh nhân đã có (trong lần chạy này hoặc trong identity index)
+    dùng lại sub-id cũ. Danh tính lấy từ trường patient trong header (không cần MNE); DOC_NO được thêm
+    vào khóa khi tên khớp đúng một DOC_NO trong xlsx.
+    Các folder cùng sub-id được gộp thành một nhóm (folder đầu tiên làm đại diện).
+    Trả về (edf_groups đã gộp, sub_ids, run_starts); run_starts = số run đầu tiên cho sub đã có trên đĩa.
+    reserved: như assign_sub_ids.
+    """
+    doc_numbers = defaultdict(set)
+    for name_std, doc_no in zip(excel_data['PATIENT_NAME_STD'], excel_data[doc_no_col]):
+        if name_std and pd.notnull(doc_no):
+            doc_numbers[name_std].add(str(doc_no))
+
+    next_sub_id = [max(count_existing_subs(bids_dir), identity.max_sub_id(), reserved) + 1]
+
+    def allocate():
+        sub_id = f"{next_sub_id[0]:04d}"
+        next_sub_id[0] += 1
+        return sub_id
+
+    merged, sub_ids, representative = {}, {}, {}
+    for folder, files in edf_groups.items():
+        if not files:
+            continue
+        name = birth_year = None
         for edf_file in sorted(files):
-            try:
-                name_only, sex, birth_suffix, sampling_rate, channel_types, recording_date, raw = extract_edf_metadata(edf_file)
-                success = True
-            except Exception:
-                name_only = None
-                success = False
-                failed_files.append(edf_file)
-
-            run_id = f"{run_counter:03d}"
-            bids_base = f"sub-{sub_id}_task-rest_run-{run_id}"
-            bids_edf = os.path.join(eeg_dir, f"{bids_base}_eeg.edf")
-
-            # Copy original file
+            name, birth_year = identify(edf_file)
+            if name:
+                break
+        if name:
+            docs = doc_numbers.get(name, set())
+            doc_no = next(iter(docs)) if len(docs) == 1 else None
+            sub_id, is_new = identity.resolve(name, birth_year, doc_no, allocate)
+            if not is_new:
+                logging.info(f"{folder}: repeat patient, reusing sub-{sub_id}")
+        else:
+            sub_id = allocate()
+        if sub_id in representative:
+            merged[representative[sub_id]].extend(files)
+        else:
+            representative[sub_id] = folder
+            merged[folder] = list(files)
+            sub_ids[folder] = sub_id
+
+    run_starts = {}
+    for folder, sub_id in sub_ids.items():
+        eeg_dir = os.path.join(bids_dir, f"sub-{sub_id}", "eeg")
+        if os.path.isdir(eeg_dir):
+            run_starts[folder] = len(glob.glob(os.path.join(eeg_dir, "*_eeg.edf"))) + 1
+    return merged, sub_ids, run_starts
+
+
+def plan_subjects(args, edf_groups, excel_data, reserved=0):
+    """
+    Gán sub-id (theo folder, hoặc theo danh tính khi bật --identity). Trả về (edf_groups, sub_ids, run_starts).
+    reserved: sub-id lớn nhất đã nằm trong job table (xem assign_sub_ids).
+    """
+    if not args.identity:
+        return edf_groups, assign_sub_ids(edf_groups, args.bids_dir, reserved), {}
+    identity = IdentityIndex(identity_index_path(args))
+    identify = identity_from_edf
+    if args.input_format == "nihon":
+        patients = load_patient_sidecars(args.nk_sidecar_tsv)
+        identify = lambda path: nihon_identity(path, patients)
+    return assign_sub_ids_by_identity(edf_groups, args.bids_dir, identity, excel_data, identify, reserved)
+
+
+def file_limits(args):
+    """Giới hạn timeout / RSS cho worker đọc từng file (None = không giới hạn)."""
+    return {
+        "timeout": args.file_timeout if args.file_timeout and args.file_timeout > 0 else None,
+        "max_rss_mb": args.file_max_rss_mb if args.file_max_rss_mb and args.file_max_rss_mb > 0 else None,
+    }
+
+
+def process_edf_group(folder, files, sub_id, bids_dir, excel_data, limits=None, run_start=1, source=None,
+                      preview=False):
+    """
+    Convert one EDF folder into sub-<sub_id>: match the first readable file with the xlsx,
+    copy every file as a run and write eeg.json / channels.tsv / scans.tsv.
+    Each file header is parsed once, in a supervised worker when limits (timeout / max_rss_mb) are set;
+    a file that hangs or blows the memory cap is killed and reported with the reason.
+    Returns (participant_row, test_rows, failed_files, runs) so the caller decides where to write them;
+    this keeps the function safe to run from several workers at once. runs maps each source file that
+    became a run to its EDF path relative to bids_dir.
+    run_start > 1 adds runs to a subject that already exists (repeat patient) and extends its scans.tsv.
+    source = {"format": "nihon", "patients": {...}}: files are native EEG2100 recordings, written straight
+    to their BIDS run EDFs first (no separate export step), then handled like copied EDFs.
+    preview=True also builds the min/max preview pyramid of each run while its pages are still cached.
+    """
+    sub_dir = os.path.join(bids_dir, f"sub-{sub_id}")
+    eeg_dir = os.path.join(sub_dir, "eeg")
+    os.makedirs(eeg_dir, exist_ok=True)
+
+    participant_info = None
+    run_counter = run_start
+    scans_data = []
+    test_data = []
+    failed_files = []
+    runs = {}
+    matched_rows = None
+    origins = {}
+
+    if source and source.get("format") == "nihon":
+        converted, convert_failed = convert_nihon_group(files, eeg_dir, sub_id, run_start,
+                                                        source.get("patients") or {}, limits)
+        failed_files.extend(convert_failed)
+        origins = {out_path: eeg_file for eeg_file, out_path in converted.items()}
+        files = list(converted.values())
+
+    # Parse every header once (isolated worker with timeout / RSS cap);
+    # files whose header triage says hopeless skip MNE entirely
+    summaries = {}
+    for edf_file in sorted(files):
+        triage = triage_edf(edf_file)
+        if triage["hopeless"]:
+            summaries[edf_file] = None
+            failed_files.append({"failed_file": edf_file, "reason": f"Triage {triage['status']}: {triage['detail']}"})
+            logging.warning(f"Skipping reader for {edf_file}: {triage['status']} ({triage['detail']})")
+            continue
+        outcome = run_maybe_isolated(extract_edf_summary, edf_file, **(limits or {}))
+        if outcome["ok"]:
+            summaries[edf_file] = outcome["result"]
+        else:
+            summaries[edf_file] = None
+            failed_files.append({"failed_file": edf_file, "reason": outcome["reason"]})
+            logging.warning(f"Failed to parse {edf_file}: {outcome['reason']}")
+
+    # Try to extract metadata from first valid file
+    for edf_file in sorted(files):
+        if summaries[edf_file] is None:
+            continue
+        try:
+            name_only, sex, birth_suffix, sampling_rate, channel_types, recording_date, subject_info, duration = summaries[edf_file]
+            if name_only is not None:
+                edf_name_std = unidecode.unidecode(name_only).upper()
+                # Match with Excel
+                if birth_suffix and 'BIRTH_YEAR' in excel_data.columns and excel_data['BIRTH_YEAR'].notnull().any():
+                    matched_rows = excel_data[
+                        (excel_data['PATIENT_NAME_STD'] == edf_name_std) &
+                        (excel_data['BIRTH_YEAR'].str.endswith(str(birth_suffix), na=False))
+                    ]
+                else:
+                    matched_rows = excel_data[(excel_data['PATIENT_NAME_STD'] == edf_name_std)]
+
+                if not matched_rows.empty:
+                    # Use matched info for participants.tsv
+                    birth_date = matched_rows[birth_date_col].iloc[0]
+                    age = calculate_age(birth_date, recording_date) if birth_date and recording_date else "n/a"
+                    sex_str = matched_rows[GENDER_col].iloc[0].lower() if pd.notnull(matched_rows[GENDER_col].iloc[0]) else "n/a"
+                    participant_info = {
+                        "age": str(age) if age is not None else "n/a",
+                        "sex": sex_str,
+                        "group": "n/a"
+                    }
+                    # Test results for phenotype/results.tsv
+                    for _, row in matched_rows.iterrows():
+                        if pd.notnull(row[hfl_name_col]) and pd.notnull(row[para_result_col]):
+                            test_data.append({
+                                'participant_id': f"sub-{sub_id}",
+                                'test_name': str(row[hfl_name_col]),
+                                'result': str(row[para_result_col]),
+                                'unit': str(row[unit_col]) if pd.notnull(row.get(unit_col)) else 'n/a'
+                            })
+                    logging.info(f"Matched {len(test_data)} test results for sub-{sub_id}")
+                else:
+                    # Use EDF metadata
+                    logging.warning(f"No match for group {folder}. Using EDF metadata.")
+                    with open(os.path.join(bids_dir, "unmatched_edf_groups.txt"), 'a') as f:
+                        f.write(f"{folder}\n")
+                    birth_year = extract_birth_year_suffix(subject_info, birth_suffix)
+                    age = calculate_age(birth_year, recording_date) if birth_year else "n/a"
+                    sex_str = ("male" if sex == 2 else "female") if sex is not None else "n/a"
+                    participant_info = {
+                        "age": str(age) if age is not None else "n/a",
+                        "sex": sex_str,
+                        "group": "n/a"
+                    }
+                break  # Stop after finding first valid file
+        except Exception as e:
+            logging.warning(f"Failed to read metadata from {edf_file}: {e}")
+            continue
+
+    # If no valid metadata, use placeholder
+    if participant_info is None:
+        logging.warning(f"No valid metadata for group {folder}. Using placeholder.")
+        with open(os.path.join(bids_dir, "unmatched_edf_groups.txt"), 'a') as f:
+            f.write(f"{folder}\n")
+        participant_info = {
+            "age": "n/a",
+            "sex": "n/a",
+            "group": "n/a"
+        }
+
+    participant_row = {
+        "participant_id": f"sub-{sub_id}",
+        **participant_info
+    }
+
+    # Process all files in group as runs
+    for edf_file in sorted(files):
+        if summaries[edf_file] is not None:
+            name_only, sex, birth_suffix, sampling_rate, channel_types, recording_date, subject_info, duration = summaries[edf_file]
+            success = True
+        else:
+            name_only = None
+            recording_date = None
+            success = False
+
+        run_id = f"{run_counter:03d}"
+        bids_base = f"sub-{sub_id}_task-rest_run-{run_id}"
+        bids_edf = os.path.join(eeg_dir, f"{bids_base}_eeg.edf")
+
+        # Copy original file (EEG2100 input is already written at its BIDS path)
+        if os.path.abspath(edf_file) != os.path.abspath(bids_edf):
             shutil.copy(edf_file, bids_edf)
             logging.info(f"Copied original EDF to {bids_edf}")
-
-            # Create eeg.json and channels.tsv
-            if name_only is None:
-                eeg_metadata = {
-                    "TaskName": "rest",
-                    "EEGReference": "unknown",
-                    "SamplingFrequency": "n/a",
-                    "PowerLineFrequency": "n/a",
-                    "EEGChannelCount": "n/a",
-                    "SoftwareFilters": "n/a",
-                    "RecordingDuration": "n/a",
-                    "Note": "⚠️ EDF file could not be parsed"
-                }
-                channels_data = pd.DataFrame([{
-                    "name": "n/a",
-                    "type": "n/a",
-                    "units": "n/a",
-                    "description": "EDF file not readable",
-                    "sampling_frequency": "n/a",
-                    "reference": "unknown"
-                }])
-            else:
-                eeg_metadata = {
-                    "TaskName": "rest",
-                    "EEGReference": "unknown",
-                    "SamplingFrequency": sampling_rate,
-                    "PowerLineFrequency": 50,
-                    "EEGChannelCount": len(channel_types),
-                    "SoftwareFilters": "n/a",
-                    "RecordingDuration": raw.times[-1] if raw.times.size > 0 else "n/a"
-                }
-                channels_data = pd.DataFrame({
-                    "name": list(channel_types.keys()),
-                    "type": list(channel_types.values()),
-                    "units": ["uV"] * len(channel_types),
-                    "description": ["EEG channel"] * len(channel_types),
-                    "sampling_frequency": [sampling_rate] * len(channel_types),
-                    "reference": ["unknown"] * len(channel_types)
-                })
-
-            with open(os.path.join(eeg_dir, f"{bids_base}_eeg.json"), 'w') as f:
-                json.dump(eeg_metadata, f, indent=4)
-            channels_data.to_csv(os.path.join(eeg_dir, f"{bids_base}_channels.tsv"), sep='\t', index=False)
-
-            # Add to scans.tsv
-            acq_time = recording_date.strftime("%Y-%m-%dT%H:%M:%S") if success and recording_date and isinstance(recording_date, datetime) else "n/a"
-            scans_data.append({
-                "filename": os.path.relpath(bids_edf, start=sub_dir),
-                "acq_time": acq_time
+        runs[origins.get(edf_file, edf_file)] = os.path.relpath(bids_edf, bids_dir)
+
+        # Create eeg.json and channels.tsv
+        if name_only is None:
+            eeg_metadata = {
+                "TaskName": "rest",
+                "EEGReference": "unknown",
+                "SamplingFrequency": "n/a",
+                "PowerLineFrequency": "n/a",
+                "EEGChannelCount": "n/a",
+                "SoftwareFilters": "n/a",
+                "RecordingDuration": "n/a",
+                "Note": "⚠️ EDF file could not be parsed"
+            }
+            channels_data = pd.DataFrame([{
+                "name": "n/a",
+                "type": "n/a",
+                "units": "n/a",
+                "description": "EDF file not readable",
+                "sampling_frequency": "n/a",
+                "reference": "unknown"
+            }])
+        else:
+            eeg_metadata = {
+                "TaskName": "rest",
+                "EEGReference": "unknown",
+                "SamplingFrequency": sampling_rate,
+                "PowerLineFrequency": 50,
+                "EEGChannelCount": len(channel_types),
+                "SoftwareFilters": "n/a",
+                "RecordingDuration": duration
+            }
+            channels_data = pd.DataFrame({
+                "name": list(channel_types.keys()),
+                "type": list(channel_types.values()),
+                "units": ["uV"] * len(channel_types),
+                "description": ["EEG channel"] * len(channel_types),
+                "sampling_frequency": [sampling_rate] * len(channel_types),
+                "reference": ["unknown"] * len(channel_types)
             })
 
-            processed_edf_files.add(edf_file)
-            run_counter += 1
+        with open(os.path.join(eeg_dir, f"{bids_base}_eeg.json"), 'w') as f:
+            json.dump(eeg_metadata, f, indent=4)
+        channels_data.to_csv(os.path.join(eeg_dir, f"{bids_base}_channels.tsv"), sep='\t', index=False)
+
+        # events.tsv từ kênh EDF Annotations (chỉ đọc byte TAL, không decode tín hiệu)
+        if success:
+            try:
+                write_events(bids_edf, os.path.join(eeg_dir, f"{bids_base}_events.tsv"))
+            except (OSError, ValueError) as e:
+                logging.warning(f"Failed to extract annotations from {edf_file}: {e}")
+        if success and preview:
+            try:
+                preview_dir = os.path.join(bids_dir, preview_path_for(os.path.relpath(bids_edf, bids_dir)))
+                os.makedirs(os.path.dirname(preview_dir), exist_ok=True)
+                build_preview(bids_edf, preview_dir)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Failed to build preview for {edf_file}: {e}")
+
+        # Add to scans.tsv
+        acq_time = recording_date.strftime("%Y-%m-%dT%H:%M:%S") if success and recording_date and isinstance(recording_date, datetime) else "n/a"
+        scans_data.append({
+            "filename": os.path.relpath(bids_edf, start=sub_dir),
+            "acq_time": acq_time
+        })
 
-        # Write scans.tsv
-        scans_df = pd.DataFrame(scans_data)
-        scans_tsv = os.path.join(sub_dir, f"sub-{sub_id}_scans.tsv")
-        scans_df.to_csv(scans_tsv, sep='\t', index=False)
+        run_counter += 1
+
+    # Write scans.tsv
+    scans_df = pd.DataFrame(scans_data)
+    scans_tsv = os.path.join(sub_dir, f"sub-{sub_id}_scans.tsv")
+    if run_start > 1 and os.path.exists(scans_tsv):
+        existing_scans = pd.read_csv(scans_tsv, sep='\t')
+        existing_scans = existing_scans[~existing_scans["filename"].isin(scans_df["filename"])]
+        scans_df = pd.concat([existing_scans, scans_df], ignore_index=True)
+    scans_df.to_csv(scans_tsv, sep='\t', index=False)
+
+    return participant_row, test_data, failed_files, runs
+
+
+def write_dataset_files(bids_dir, anonymous_data, test_data, failed_files):
+    """Write the dataset-level files (participants, phenotype, failed list, description)."""
+    participants_tsv = os.path.join(bids_dir, "participants.tsv")
+
+    # Save test results to phenotype/results.tsv
+    phenotype_dir = os.path.join(bids_dir, "phenotype")
+    os.makedirs(phenotype_dir, exist_ok=True)
+    if test_data:
+        results_tsv = os.path.join(phenotype_dir, "results.tsv")
+        matched_df = pd.DataFrame(test_data)
+        if os.path.exists(results_tsv):
+            existing_results = pd.read_csv(results_tsv, sep='\t')
+            matched_df = pd.concat([existing_results, matched_df], ignore_index=True)
+        matched_df.to_csv(results_tsv, sep='\t', index=False)
+        logging.info(f"Saved {len(test_data)} matched test results to {results_tsv}")
 
     # Write failed files
     if failed_files:
-        pd.DataFrame({"failed_file": failed_files}).to_csv(os.path.join(bids_dir, "failed_files.tsv"), sep='\t', index=False)
+        pd.DataFrame(failed_files, columns=["failed_file", "reason"]).to_csv(os.path.join(bids_dir, "failed_files.tsv"), sep='\t', index=False)
         print(f"⚠️ {len(failed_files)} EDF files failed to parse. See failed_files.tsv")
 
     # Sort and write participants.tsv
@@ -452,8 +798,6 @@ def create_bids(args):
         "result": {"Description": "Result of the lab test"},
         "unit": {"Description": "Unit of measurement for the result"}
     }
-    phenotype_dir = os.path.join(bids_dir, "phenotype")
-    os.makedirs(phenotype_dir, exist_ok=True)
     with open(os.path.join(phenotype_dir, "results.json"), 'w') as f:
         json.dump(results_json, f, indent=4)
         logging.info("Created phenotype/results.json")
@@ -472,11 +816,182 @@ def create_bids(args):
     print(f"Completed. Participants saved to: {participants_tsv}")
     logging.info(f"Completed BIDS creation. Participants saved to: {participants_tsv}")
 
+
+def load_existing_participants(bids_dir):
+    participants_tsv = os.path.join(bids_dir, "participants.tsv")
+    if os.path.exists(participants_tsv):
+        existing_df = pd.read_csv(participants_tsv, sep='\t')
+        logging.info(f"Loaded existing participants.tsv with {len(existing_df)} entries")
+        return existing_df.to_dict('records')
+    return []
+
+
+_group_worker_ctx = {}
+
+
+def _init_group_worker(bids_dir, excel_data, limits, source=None, preview=False):
+    # Gửi excel_data một lần cho mỗi process thay vì pickle theo từng job
+    _group_worker_ctx["bids_dir"] = bids_dir
+    _group_worker_ctx["excel_data"] = excel_data
+    _group_worker_ctx["limits"] = limits
+    _group_worker_ctx["source"] = source
+    _group_worker_ctx["preview"] = preview
+
+
+def _process_group_item(item):
+    return process_edf_group(item["folder"], item["files"], item["sub_id"],
+                             _group_worker_ctx["bids_dir"], _group_worker_ctx["excel_data"],
+                             _group_worker_ctx["limits"], item.get("run_start", 1), _group_worker_ctx["source"],
+                             _group_worker_ctx["preview"])
+
+
+def create_bids(args):
+    """
+    Create a BIDS dataset from EDF files, grouping files in the same parent folder as one subject.
+    Match only one file per group with xlsx; if no match, use EDF metadata or placeholder.
+    Save matched rows to phenotype/results.tsv with test results from HFL_NAME, PARA_RESULT, UNIT.
+    Create phenotype/results.json. Copy original EDF files without anonymization or export.
+    """
+    edf_dir = args.edf_dir
+    bids_dir = args.bids_dir
+
+    # Create BIDS root
+    os.makedirs(bids_dir, exist_ok=True)
+
+    # Load existing participants.tsv
+    anonymous_data = load_existing_participants(bids_dir)
+
+    # Load Excel data
+    excel_data = load_excel_data(args)
+
+    edf_groups = collect_groups(args)
+    source = load_source(args)
+    edf_groups, dedup_state = dedup_stage(args, edf_groups)
+
+    edf_groups, sub_ids, run_starts = plan_subjects(args, edf_groups, excel_data)
+    register_dedup(dedup_state, edf_groups, bids_dir)
+    limits = file_limits(args)
+
+    if args.workers > 1:
+        # Song song: folder lớn nhất chạy trước, progress/ETA tính theo byte
+        items = group_inventory({folder: edf_groups[folder] for folder in sub_ids}, sub_ids)
+        for it in items:
+            it["run_start"] = run_starts.get(it["folder"], 1)
+        worker_mem_bytes = args.worker_mem_mb * 1024 * 1024 if args.worker_mem_mb else None
+        results = {
+            it["sub_id"]: result
+            for it, result in run_lpt(items, _process_group_item, args.workers, worker_mem_bytes,
+                                      initializer=_init_group_worker, initargs=(bids_dir, excel_data, limits, source, args.preview))
+        }
+    else:
+        # Process each group (folder cha)
+        results = {}
+        for folder, sub_id in tqdm(sub_ids.items(), desc="Processing EDF folders"):
+            results[sub_id] = process_edf_group(folder, edf_groups[folder], sub_id, bids_dir, excel_data, limits,
+                                                run_starts.get(folder, 1), source, args.preview)
+
+    all_test_data = []
+    failed_files = []
+    runs = {}
+    known_ids = {p['participant_id'] for p in anonymous_data}
+    for sub_id in sorted(results):
+        participant_row, test_data, group_failed, group_runs = results[sub_id]
+        failed_files.extend(group_failed)
+        runs.update(group_runs)
+        if participant_row["participant_id"] in known_ids:
+            continue  # repeat patient: giữ dòng participants / kết quả xét nghiệm đã có
+        anonymous_data.append(participant_row)
+        all_test_data.extend(test_data)
+
+    resolve_dedup(args, runs, [f for folder in sub_ids for f in edf_groups[folder]])
+    write_dataset_files(bids_dir, anonymous_data, all_test_data, failed_files)
+
+
+# === Job-table mode (nhiều worker / nhiều máy) ===
+def queue_db_path(args):
+    return args.queue_db or os.path.join(args.bids_dir, ".job_queue.sqlite")
+
+
+def enqueue_bids(args):
+    """
+    Gán sub-id cho từng folder (theo đúng thứ tự như chế độ serial) và đưa vào job table.
+    Worker ở bất kỳ máy nào có thể chạy `--mode worker` trỏ vào cùng DB.
+    Enqueue lại: file đã có job giữ nguyên job cũ, folder mới nhận sub-id sau sub-id lớn nhất
+    của cả job table lẫn thư mục sub-* trên đĩa (job chưa chạy thì chưa có thư mục).
+    """
+    os.makedirs(args.bids_dir, exist_ok=True)
+    queue = JobQueue(queue_db_path(args))
+    queued = queue.payloads()
+    reserved = max((int(p["sub_id"]) for p in queued.values()), default=0)
+    # file đã nằm trong một job (kể cả folder đã gộp vào nhóm khác khi --identity) không lập kế hoạch lại
+    queued_files = {f for p in queued.values() for f in p["files"]}
+    edf_groups = {folder: [f for f in files if f not in queued_files] for folder, files in collect_groups(args).items()}
+    edf_groups = {folder: files for folder, files in edf_groups.items() if files and folder not in queued}
+    edf_groups, dedup_state = dedup_stage(args, edf_groups)
+    excel_data = load_excel_data(args) if args.identity else None
+    edf_groups, sub_ids, run_starts = plan_subjects(args, edf_groups, excel_data, reserved)
+    register_dedup(dedup_state, edf_groups, args.bids_dir)
+    n_new = 0
+    # priority = tổng byte của folder -> worker claim folder lớn nhất trước (LPT)
+    for it in group_inventory({folder: edf_groups[folder] for folder in sub_ids}, sub_ids):
+        payload = {"folder": it["folder"], "files": it["files"], "sub_id": it["sub_id"],
+                   "run_start": run_starts.get(it["folder"], 1)}
+        if queue.enqueue(it["folder"], payload, priority=it["bytes"]):
+            n_new += 1
+    print(f"Enqueued {n_new} EDF folders into {queue_db_path(args)}")
+
+
+def worker_bids(args):
+    """Claim folder từ job table, convert, ghi kết quả (participant row, test rows) lại vào DB."""
+    queue = JobQueue(queue_db_path(args))
+    excel_data = load_excel_data(args)
+    limits = file_limits(args)
+    source = load_source(args)
+
+    def handler(payload):
+        participant_row, test_data, failed, runs = process_edf_group(
+            payload["folder"], payload["files"], payload["sub_id"], args.bids_dir, excel_data, limits,
+            payload.get("run_start", 1), source, args.preview
+        )
+        return {"participant": participant_row, "tests": test_data, "failed": failed, "runs": runs}
+
+    run_worker(queue, handler, worker_id=args.worker_id, lease_seconds=args.lease_seconds)
+
+
+def finalize_bids(args):
+    """Gom kết quả các job done thành participants.tsv / phenotype / failed_files.tsv."""
+    queue = JobQueue(queue_db_path(args))
+    counts = queue.counts()
+    if queue.unfinished():
+        print(f"⚠️ Queue still has unfinished jobs: {counts}")
+    anonymous_data = load_existing_participants(args.bids_dir)
+    known_ids = {p['participant_id'] for p in anonymous_data}
+    all_test_data = []
+    failed_files = []
+    runs, sources = {}, []
+    for payload, result in queue.results():
+        failed_files.extend(result["failed"])
+        runs.update(result.get("runs", {}))
+        sources.extend(payload["files"])
+        if result["participant"]["participant_id"] in known_ids:
+            continue  # repeat patient: giữ dòng participants / kết quả xét nghiệm đã có
+        anonymous_data.append(result["participant"])
+        all_test_data.extend(result["tests"])
+    for payload, error in queue.failed_jobs():
+        logging.error(f"Job for {payload['folder']} failed permanently: {error}")
+        failed_files.extend({"failed_file": f, "reason": f"Job failed: {error}"} for f in payload["files"])
+        sources.extend(payload["files"])
+    resolve_dedup(args, runs, sources)
+    write_dataset_files(args.bids_dir, anonymous_data, all_test_data, failed_files)
+
+
 if __name__ == "__main__":
-    import argparse
-    parser = argparse.ArgumentParser(description="Create BIDS dataset from EDF files")
-    parser.add_argument('--edf_dir', type=str, required=True, help="Directory containing EDF files")
-    parser.add_argument('--bids_dir', type=str, required=True, help="Output BIDS directory")
-    parser.add_argument('--anonymous_xlsx_path', type=str, required=True, help="Path to Excel file with patient info")
-    args = parser.parse_args()
-    create_bids(args)
\ No newline at end of file
+    args = get_args()
+    if args.mode == "enqueue":
+        enqueue_bids(args)
+    elif args.mode == "worker":
+        worker_bids(args)
+    elif args.mode == "finalize":
+        finalize_bids(args)
+    else:
+        create_bids(args)